@@ -33,7 +33,8 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import joinedload, selectinload
 import datetime
 from models import UserBadge  # Keep specific imports if needed elsewhere
-from threading import Lock  # Import Lock for thread safety
+import json
+from core.cache import VersionedLRUCache
 from sqlalchemy.orm import aliased
 from collections import defaultdict
 
@@ -80,6 +81,9 @@ from core import data as core_data
 from core import ctfs as core_ctfs
 from core import badges as core_badges
 from core import streak as core_streak
+from core import parallel as core_parallel
+from core import response as core_response
+from core import leaderboard as core_leaderboard
 
 
 try:
@@ -93,57 +97,62 @@ except FileNotFoundError:
 
 
 # --- Caching Setup ---
-_ALL_CTFS_CACHE = None
-_ALL_BADGES_CACHE = None
-_cache_lock = Lock()
+# CTF and Badge definitions only change through migrations, so they are cached
+# under a single fixed key/version. Population is single-flight and readers get
+# the published snapshot without taking a lock.
+_STATIC_DEFINITIONS_KEY = "ctfs_and_badges"
+_STATIC_DEFINITIONS_VERSION = 0
+_static_definitions_cache = VersionedLRUCache(max_bytes=16 * 1024 * 1024)
 
 
-def _get_cached_static_definitions():
-    """Fetches and caches all CTFs and Badges if not already cached."""
-    global _ALL_CTFS_CACHE, _ALL_BADGES_CACHE
+def _load_static_definitions():
+    """Loads all CTFs and Badges from the DB. Returns ((ctfs, badges_map), cost)."""
 
     def _len(obj):
         return len(obj) if obj is not None else 0
 
-    with _cache_lock:  # Ensure thread safety when checking/updating cache
-        if _ALL_CTFS_CACHE is None or _ALL_BADGES_CACHE is None:
-            print("CACHE MISS: Populating static CTF and Badge definitions...")
-            try:
-                with app.app_context():  # Need app context for DB queries
-                    # Fetch CTFs
-                    all_ctfs_db = Ctf.query.order_by(Ctf.id).all()
-                    _ALL_CTFS_CACHE = [
-                        {
-                            "id": c.id,
-                            "title": c.title,
-                            "description": c.description,
-                            "link": c.link,
-                        }
-                        for c in all_ctfs_db
-                    ]
-
-                    # Fetch Badges
-                    all_badges_db = Badge.query.order_by(Badge.id).all()
-                    _ALL_BADGES_CACHE = {
-                        b.id: {
-                            "id": b.id,
-                            "title": b.title,
-                            "description": b.description,
-                            "image_path": b.image_path,
-                        }
-                        for b in all_badges_db
-                    }
-                    print(
-                        f"CACHE POPULATED: {_len(_ALL_CTFS_CACHE)} CTFs, {_len(_ALL_BADGES_CACHE)} Badges."
-                    )
-            except Exception as e:
-                # Log error but potentially allow app to continue without cache
-                print(f"CRITICAL: Failed to populate static definition cache: {e}")
-                # Set to empty lists/dicts to avoid repeated attempts on error?
-                _ALL_CTFS_CACHE = []
-                _ALL_BADGES_CACHE = {}
+    print("CACHE MISS: Populating static CTF and Badge definitions...")
+    try:
+        with app.app_context():  # Need app context for DB queries
+            # Fetch CTFs
+            all_ctfs_db = Ctf.query.order_by(Ctf.id).all()
+            all_ctfs = [
+                {
+                    "id": c.id,
+                    "title": c.title,
+                    "description": c.description,
+                    "link": c.link,
+                }
+                for c in all_ctfs_db
+            ]
 
-    return _ALL_CTFS_CACHE, _ALL_BADGES_CACHE
+            # Fetch Badges
+            all_badges_db = Badge.query.order_by(Badge.id).all()
+            all_badges = {
+                b.id: {
+                    "id": b.id,
+                    "title": b.title,
+                    "description": b.description,
+                    "image_path": b.image_path,
+                }
+                for b in all_badges_db
+            }
+            print(
+                f"CACHE POPULATED: {_len(all_ctfs)} CTFs, {_len(all_badges)} Badges."
+            )
+            cost = len(json.dumps(all_ctfs)) + len(json.dumps(all_badges))
+            return (all_ctfs, all_badges), cost
+    except Exception as e:
+        # Log error but allow app to continue; the next request retries the load
+        print(f"CRITICAL: Failed to populate static definition cache: {e}")
+        return ([], {}), None
+
+
+def _get_cached_static_definitions():
+    """Fetches and caches all CTFs and Badges if not already cached."""
+    return _static_definitions_cache.get_or_load(
+        _STATIC_DEFINITIONS_KEY, _STATIC_DEFINITIONS_VERSION, _load_static_definitions
+    )
 
 
 # --- End Caching Setup ---
@@ -345,7 +354,18 @@ def login():
         user = User.query.filter_by(username=request.form.get("username")).first()
         if user and user.check_password(request.form.get("password")):
             login_user(user)
-            core_streak.update_user_streak(user.id)
+            streak_data, streak_advanced = core_streak.advance_user_streak(user.id)
+            if streak_advanced:
+                # Later mutations today won't advance it again, so streak badges are awarded here
+                core_badges.award_event_badges(
+                    user.id,
+                    None,
+                    [core_badges.EVENT_STREAK_ADVANCED],
+                    streak_data,
+                    all_badge_defs_map=_get_cached_static_definitions()[1],
+                )
+            _rebuild_state_snapshots(user.id)  # Stale from the streak or a graph edit
+            db.session.commit()
             next_page = request.args.get("next")
             return redirect(next_page or url_for("index"))
         else:
@@ -376,13 +396,38 @@ def index():
 
 
 # --- MODIFIED State Calculation ---
-def _get_full_user_state(user_id, graph_id):
-    """Fetches all data and computes the full user state for the API."""
+def _get_full_user_state(user_id, graph_id, allow_concurrent=False):
+    """
+    Fetches all data and computes the full user state for the API.
+    With `allow_concurrent` (read-only callers whose session has no pending
+    writes), a cold static cache may be loaded concurrently with the user
+    inputs, see core.parallel. Warm caches never use the pool.
+    """
     try:
-        # --- Use Cached Static Definitions ---
-        all_ctfs_list_cached, all_badge_defs_map_cached = (
-            _get_cached_static_definitions()
+        graph = db.session.get(Graph, graph_id)  # Usually already in the identity map
+        graph_version = graph.version if graph else None
+
+        # User inputs (one round-trip), the graph-static data and the static
+        # definitions don't depend on each other. The static ones are cached,
+        # so only a miss is worth a pooled connection and a worker
+        cold_cache = not (
+            core_data.is_static_graph_cached(graph_id, graph_version)
+            and _static_definitions_cache.contains(
+                _STATIC_DEFINITIONS_KEY, _STATIC_DEFINITIONS_VERSION
+            )
         )
+        inputs, (static_nodes_list, static_links_list, compiled_graph), static_definitions = (
+            core_parallel.run_independent(
+                lambda: core_data.get_user_state_inputs(user_id, graph_id, graph_version),
+                # Graph-specific cache, invalidated by graph version
+                lambda: core_data.get_cached_static_graph(graph_id, graph_version),
+                _get_cached_static_definitions,
+                concurrent=None if allow_concurrent and cold_cache else False,
+            )
+        )
+
+        # --- Use Cached Static Definitions ---
+        all_ctfs_list_cached, all_badge_defs_map_cached = static_definitions
         if all_ctfs_list_cached is None or all_badge_defs_map_cached is None:
             # Handle case where cache failed to populate
             print("Warning: Static definitions cache not ready.")
@@ -399,40 +444,23 @@ def _get_full_user_state(user_id, graph_id):
                 for b in badges_db
             }
         # --- End Cache Usage ---
-        current_user_obj = db.session.get(User, user_id)  # Fetch the user object
-        if not current_user_obj:
+        if inputs is None:
             return {"error": "User not found"}
-        print(current_user_obj.__dict__)
-        highest_level_shown = (
-            current_user_obj.highest_level_popup_shown
-        )  # Get the value
-        # --- Fetch user-specific and graph-specific data ---
-        streak_data = core_streak.update_user_streak(
-            user_id
-        )  # Updates and returns streak
-        user_node_status_map, completed_exercise_ids = core_data.get_user_progress(
-            user_id, graph_id
+        highest_level_shown = inputs.highest_level_popup_shown
+        user_node_status_map = inputs.node_status_map
+        # The engine works on completion bitsets: a stored bitmap is used as is
+        completed_exercises = (
+            inputs.completed_exercise_ids
+            if inputs.completion_mask is None
+            else inputs.completion_mask
         )
-        user_ctf_completions = core_ctfs.get_user_ctf_completions(user_id)
-        user_badge_ids = {
-            ub.badge_id
-            for ub in UserBadge.query.filter_by(user_id=user_id)
-            .with_entities(UserBadge.badge_id)
-            .all()
-        }
-        static_nodes_list, static_links_list = core_data.get_cached_static_graph_data(
-            graph_id
-        )  # Graph-specific cache
-
-        # Fetch exercises (already graph-specific)
-        exercises_with_cats = (
-            db.session.query(Exercise)
-            .options(selectinload(Exercise.categories))
-            .join(Node)
-            .filter(Node.graph_id == graph_id)
-            .all()
+        user_ctf_completions = inputs.ctf_completions
+        # Read only: the streak is updated by login and the mutation endpoints
+        streak_data = (
+            core_streak.format_streak(*inputs.streak)
+            if inputs.streak
+            else {"streak": 0, "last_used": ""}
         )
-        required_exercises = [ex for ex in exercises_with_cats if not ex.optional]
 
         # --- Compute dynamic state ---
         nodes, links, unlocked, discovered = core_nodes.compute_user_graph_state(
@@ -441,41 +469,33 @@ def _get_full_user_state(user_id, graph_id):
             static_nodes_list,
             static_links_list,
             user_node_status_map,
-            completed_exercise_ids,
+            completed_exercises,
+            compiled_graph,
         )
-        abilities = core_nodes.compute_abilities(
-            user_id, completed_exercise_ids, user_ctf_completions, exercises_with_cats
+        # Exercise categories come with the cached graph, no per-request query
+        abilities = core_nodes.compute_graph_abilities(
+            user_id, compiled_graph, completed_exercises, user_ctf_completions
         )
 
-        # Pass cached badge definitions to badge check function
-        newly_awarded_badge_defs_list = core_badges.check_and_award_badges(
-            user_id,
-            graph_id,
-            streak_data,
-            user_ctf_completions,
-            user_node_status_map,
-            completed_exercise_ids,
-            required_exercises,
-            user_badge_ids,
-            all_badge_defs_map_cached,  # Pass cached map
+        # Badges are awarded by the mutation endpoints (see _persist_derived_user_state)
+        final_user_badges_list = core_badges.format_user_badges(
+            inputs.user_badges, all_badge_defs_map_cached
         )
 
-        # Commit any changes made during state computation (streak updates, badge awards, node status updates)
-        db.session.commit()
-
-        # Fetch the final list of user badges after potential awards
-        # TODO: Optimization - Can we avoid this second query if we use the cached badge defs?
-        # Maybe check_and_award_badges returns the full UserBadge object (incl badge details from cache)?
-        # For now, keeping the separate query.
-        final_user_badges_list = core_badges.get_user_badges(user_id)
-
         # Combine CTF definitions (from cache) with user progress
         combined_ctfs = [
             {**ctf_def, "completed": user_ctf_completions.get(ctf_def["id"], 0)}
             for ctf_def in all_ctfs_list_cached  # Use cached list
         ]
-        graph = db.session.get(Graph, graph_id)
         graph_name = graph.name if graph else "x"
+        # Kept by the write paths. A counter never written yet, or computed for
+        # an older graph version (points may have changed), is computed on the
+        # fly; the next mutation from this graph rewrites it
+        xp = inputs.xp
+        if xp is None:
+            xp = core_badges.graph_xp(
+                compiled_graph, completed_exercises, user_ctf_completions
+            )
 
         # Assemble the final state dictionary
         state = {
@@ -489,8 +509,8 @@ def _get_full_user_state(user_id, graph_id):
             "badges": final_user_badges_list,
             "current_graph": graph_name,
             "highest_level_popup_shown": highest_level_shown,
-            # Add newly awarded badges for popup?
-            # "newly_awarded_badges": newly_awarded_badge_defs_list # Pass badge *objects* or just IDs? Frontend needs details.
+            "xp": xp,
+            "level": core_badges.shown_level(xp),  # Numbered like highest_level_popup_shown
         }
         return state
 
@@ -498,10 +518,227 @@ def _get_full_user_state(user_id, graph_id):
         print(
             f"Error in _get_full_user_state for user {user_id}, graph {graph_id}: {e}"
         )
-        db.session.rollback()  # Rollback on error
         return {"error": "Failed to compute state"}
 
 
+def _persist_derived_user_state(
+    user_id, graph_id, exercise_id=None, recompute_nodes=True, events=()
+):
+    """
+    Recomputes and stages everything derived from a user's progress after a
+    mutation: node statuses (percent, unlocked, discovered), the streak and
+    badge awards. GET /data never writes, so this is the only place that
+    state is persisted. The caller commits.
+
+    When a single exercise was toggled and the stored node statuses were
+    derived from the current graph version, only the affected nodes are
+    recomputed; otherwise the whole graph is. The user's user_graph_state row
+    for the graph is locked first (see core.data.lock_derived_graph_state),
+    so the statuses an incremental update starts from can't be changed by a
+    concurrent mutation before this one commits. recompute_nodes=False skips
+    the node statuses (for updates that can't change them, e.g. CTFs).
+    With COMPLETION_BITMAPS, the user's completion bitmap for the graph is
+    rebuilt along with the node statuses.
+
+    The user's XP counter for the graph is set from the same completions, in
+    the same transaction (core.ctfs keeps it current for CTF changes).
+
+    Badges are evaluated for `events` (core.badges EVENT_* names raised by
+    the caller) plus the ones detected here: a main node reaching 100% and
+    the streak advancing. Only the rule families these affect are evaluated.
+
+    Returns True on success.
+    """
+    graph = db.session.get(Graph, graph_id)
+    if not graph:
+        print(f"Warning: Graph {graph_id} not found, derived state not updated.")
+        return True
+
+    events = set(events)
+    if recompute_nodes:
+        # Taken before reading the statuses the update builds on, so concurrent
+        # mutations of this user and graph serialize instead of racing
+        derived_version = core_data.lock_derived_graph_state(user_id, graph_id)
+    user_node_status_map, completed_exercise_ids = core_data.get_user_progress(
+        user_id, graph_id
+    )
+    _, _, compiled_graph = core_data.get_cached_static_graph(graph_id, graph.version)
+    completed_mask = compiled_graph.exercise_mask(completed_exercise_ids)
+    if recompute_nodes:
+        if exercise_id is not None and derived_version == graph.version:
+            node_status_updates, _ = core_nodes.compute_exercise_toggle_update(
+                compiled_graph, user_node_status_map, completed_mask, exercise_id
+            )
+        else:
+            node_status_updates = core_nodes.compute_node_status_updates(
+                compiled_graph, user_node_status_map, completed_mask
+            )
+            core_data.set_derived_graph_version(user_id, graph_id, graph.version)
+
+        if node_status_updates:
+            if not core_data.update_user_node_status_bulk(
+                user_id, node_status_updates, compiled_graph.node_pks
+            ):
+                return False
+            if core_badges.reaches_main_completion(
+                node_status_updates, graph_id, compiled_graph
+            ):
+                events.add(core_badges.EVENT_NODE_COMPLETED)
+            # Stale now; re-read by the badge evaluation if it needs the statuses
+            user_node_status_map = None
+        if core_data.COMPLETION_BITMAPS:
+            core_data.store_completion_bitmap(
+                user_id, graph_id, compiled_graph, completed_mask
+            )
+
+    user_ctf_completions = core_ctfs.get_user_ctf_completions(user_id)
+    core_data.set_user_graph_xp(
+        user_id,
+        graph_id,
+        core_badges.graph_xp(compiled_graph, completed_mask, user_ctf_completions),
+        graph.version,
+    )
+
+    streak_data, streak_advanced = core_streak.advance_user_streak(user_id)
+    if streak_advanced:
+        events.add(core_badges.EVENT_STREAK_ADVANCED)
+    if events:
+        _, all_badge_defs_map_cached = _get_cached_static_definitions()
+        core_badges.award_event_badges(
+            user_id,
+            graph_id,
+            events,
+            streak_data,
+            user_ctf_completions,
+            user_node_status_map,
+            completed_mask,
+            compiled_graph,
+            all_badge_defs_map_cached,
+        )
+    return True
+
+
+def _rebuild_state_snapshots(user_id, graph_ids=()):
+    """
+    Rebuilds the user's materialized GET /data responses after a mutation,
+    for `graph_ids` plus every graph whose snapshot is stale (a progress
+    version bump makes all of them stale, a graph edit that graph's one).
+    GET /data never stores one, so this is the only place snapshots are
+    written. Must run after the mutation's writes are staged; the caller
+    commits. Failures only lose the snapshot.
+
+    Returns {graph_id: state} for the states that were rebuilt.
+    """
+    states = {}
+    try:
+        progress_version = core_data.get_user_progress_version(user_id)
+        stale_graph_ids = core_data.get_stale_snapshot_graph_ids(user_id, progress_version)
+        for graph_id in set(graph_ids) | set(stale_graph_ids):
+            graph = db.session.get(Graph, graph_id)
+            if not graph:
+                continue
+            state = _get_full_user_state(user_id, graph_id)
+            if "error" in state:
+                continue
+            states[graph_id] = state
+            core_data.store_state_snapshot(
+                user_id,
+                graph_id,
+                graph.version,
+                progress_version,
+                _encode_user_state(state, graph),
+            )
+    except Exception as e:
+        print(f"Error rebuilding state snapshots for user {user_id}: {e}")
+    return states
+
+
+def _encode_user_state(state, graph):
+    """JSON bytes of a GET /data state, reusing the graph's pre-encoded parts."""
+    _, _, compiled_graph = core_data.get_cached_static_graph(graph.id, graph.version)
+    return core_response.encode_state(state, compiled_graph)
+
+
+def _load_user_state(user_id, graph):
+    """The user's GET /data state for a graph, from the snapshot when it is current."""
+    snapshot = core_data.get_state_snapshot(
+        user_id, graph.id, graph.version, core_data.get_user_progress_version(user_id)
+    )
+    if snapshot is not None:
+        return json.loads(snapshot)
+    return _get_full_user_state(user_id, graph.id)
+
+
+def _state_delta(old_state, new_state):
+    """
+    What changed between two GET /data states of the same graph, in the
+    shape static/state.js merges back into the client's copy:
+    changed node fields, unlock/discovery flips, newly earned badges,
+    changed CTF entries, and the current abilities, streak, XP and level.
+
+    Returns None when the states differ in ways the delta can't carry: nodes,
+    links or CTFs added or removed (a graph or CTF edit in between), or
+    badges taken away. The client then fetches the full state instead.
+    """
+    old_nodes = {node["id"]: node for node in old_state["nodes"]}
+    if (
+        old_nodes.keys() != {node["id"] for node in new_state["nodes"]}
+        or old_state["links"] != new_state["links"]
+    ):
+        return None
+    old_ctfs = {ctf["id"]: ctf for ctf in old_state["ctfs"]}
+    old_badge_ids = {badge["id"] for badge in old_state["badges"]}
+    if old_ctfs.keys() != {ctf["id"] for ctf in new_state["ctfs"]} or not (
+        old_badge_ids <= {badge["id"] for badge in new_state["badges"]}
+    ):
+        return None
+
+    nodes = {}
+    for node in new_state["nodes"]:
+        old_node = old_nodes[node["id"]]
+        changes = {
+            key: node[key]
+            for key in ("percent", "unlocked", "discovered")
+            if node[key] != old_node[key]
+        }
+        popup_changes = {
+            key: node["popup"][key]
+            for key in ("userNotes", "exercises")
+            if node["popup"][key] != old_node["popup"][key]
+        }
+        if popup_changes:
+            changes["popup"] = popup_changes
+        if changes:
+            nodes[node["id"]] = changes
+
+    old_unlocked = {nid for nid, status in old_state["unlocked"].items() if status}
+    new_unlocked = {nid for nid, status in new_state["unlocked"].items() if status}
+    old_discovered, new_discovered = set(old_state["discovered"]), set(new_state["discovered"])
+    return {
+        "nodes": nodes,
+        "unlocked": {nid: nid in new_unlocked for nid in old_unlocked ^ new_unlocked},
+        "discovered": {nid: nid in new_discovered for nid in old_discovered ^ new_discovered},
+        "new_badges": [b for b in new_state["badges"] if b["id"] not in old_badge_ids],
+        "ctfs": [ctf for ctf in new_state["ctfs"] if old_ctfs.get(ctf["id"]) != ctf],
+        "abilities": new_state["abilities"],
+        "streak": new_state["streak"],
+        "xp": new_state["xp"],
+        "level": new_state["level"],
+    }
+
+
+def _requested_graph():
+    """Resolves the ?graph=<name> query parameter to a Graph (defaults to graph 1)."""
+    graph_name = request.args.get("graph", "x")
+    return Graph.query.filter_by(name=graph_name).first() or db.session.get(Graph, 1)
+
+
+def _requested_graph_id():
+    """Resolves the ?graph=<name> query parameter to a graph id (defaults to 1)."""
+    graph = _requested_graph()
+    return graph.id if graph else 1
+
+
 # --- End MODIFIED State Calculation ---
 
 
@@ -509,13 +746,43 @@ def _get_full_user_state(user_id, graph_id):
 @login_required
 def get_data():
     # --- Keep get_data logic (calls the optimized _get_full_user_state) ---
-    graph_name = request.args.get("graph", "x")
-    graph = Graph.query.filter_by(name=graph_name).first()
+    graph = _requested_graph()
     graph_id = graph.id if graph else 1
-    state = _get_full_user_state(current_user.id, graph_id)
-    if "error" in state:
-        return jsonify(state), 500
-    return jsonify(state)
+    if not graph:
+        state = _get_full_user_state(current_user.id, graph_id)
+        if "error" in state:
+            return jsonify(state), 500
+        return jsonify(state)
+
+    # The state only changes with the graph or the user's progress version
+    etag = _state_etag(current_user, graph)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        # Served as stored while neither the graph nor the user's progress changed
+        snapshot = core_data.get_state_snapshot(
+            current_user.id, graph_id, graph.version, current_user.progress_version
+        )
+        if snapshot is not None:
+            response = app.response_class(snapshot, mimetype="application/json")
+        else:
+            state = _get_full_user_state(current_user.id, graph_id, allow_concurrent=True)
+            if "error" in state:
+                return jsonify(state), 500
+            # Served without storing it: snapshots are written by the mutations
+            response = app.response_class(
+                _encode_user_state(state, graph), mimetype="application/json"
+            )
+    response.set_etag(etag)
+    # Browsers keep the response but revalidate it with If-None-Match on every fetch
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+
+def _state_etag(user, graph):
+    """Strong ETag for a user's GET /data response on a graph."""
+    return f"{user.id}-{graph.id}-{graph.version}-{user.progress_version}"
 
 
 @app.route("/data", methods=["POST"])
@@ -526,14 +793,34 @@ def post_data():
     payload = request.json
     update_successful = True
     try:
+        # ?delta=1: answer with what changed instead of just "ok" (saves the follow-up GET)
+        graph = _requested_graph()
+        old_state = (
+            _load_user_state(user_id, graph)
+            if graph and request.args.get("delta") == "1"
+            else None
+        )
         if "exercise_update" in payload:
             ex_data = payload["exercise_update"]
             exercise_id = ex_data.get("exercise_id")
             is_completed = ex_data.get("completed")
             if exercise_id is not None and is_completed is not None:
+                # Stage the completion and its derived state, then commit both together
                 update_successful &= core_data.update_user_exercise_completion(
-                    user_id, exercise_id, is_completed
+                    user_id, exercise_id, is_completed, commit=False
                 )
+                if update_successful:
+                    exercise_graph_id = core_data.get_exercise_graph_id(exercise_id) or (
+                        graph.id if graph else 1
+                    )
+                    update_successful &= _persist_derived_user_state(
+                        user_id,
+                        exercise_graph_id,
+                        exercise_id=exercise_id,
+                        events=(
+                            [core_badges.EVENT_EXERCISE_COMPLETED] if is_completed else []
+                        ),
+                    )
             else:
                 update_successful = False
                 print(f"Invalid exercise update payload")
@@ -554,8 +841,14 @@ def post_data():
         if not update_successful:
             db.session.rollback()
             return jsonify({"error": "Failed to apply update"}), 400
+        new_states = _rebuild_state_snapshots(user_id, [graph.id] if graph else [])
         db.session.commit()  # Commit successful update
-        return jsonify({"status": "ok"})  # Return minimal confirmation
+        response = {"status": "ok"}  # Minimal confirmation
+        if old_state and "error" not in old_state and graph.id in new_states:
+            delta = _state_delta(old_state, new_states[graph.id])
+            if delta is not None:
+                response["delta"] = delta
+        return jsonify(response)
 
     except Exception as e:
         db.session.rollback()
@@ -588,6 +881,8 @@ def update_level_shown_status():
         # Update only if the new level shown is higher than the stored one
         if level_shown > user.highest_level_popup_shown:
             user.highest_level_popup_shown = level_shown
+            core_data.bump_user_progress_version(user_id)
+            _rebuild_state_snapshots(user_id)
             db.session.commit()
             print(
                 f"Updated highest_level_popup_shown for user {user_id} to {level_shown}"
@@ -623,6 +918,14 @@ def post_ctfs():
             400,
         )
     try:
+        # ?delta=1: answer with what changed instead of just "ok" (saves the follow-up GET)
+        graph = _requested_graph()
+        old_state = (
+            _load_user_state(user_id, graph)
+            if graph and request.args.get("delta") == "1"
+            else None
+        )
+        new_state = old_state
         current_completions = core_ctfs.get_user_ctf_completions(user_id)
         update_failed = False
         any_updates_made = False
@@ -645,8 +948,25 @@ def post_ctfs():
                 f"Warning: One or more CTF updates failed..."
             )  # Decide on rollback/partial commit
         if any_updates_made:
-            db.session.commit()  # Commit if changes were made
-        return jsonify({"status": "ok"})  # Return minimal confirmation
+            # CTFs don't affect node statuses, only XP/CTF badges and the streak
+            graph_id = graph.id if graph else 1
+            if _persist_derived_user_state(
+                user_id,
+                graph_id,
+                recompute_nodes=False,
+                events=[core_badges.EVENT_CTF_CHANGED],
+            ):
+                new_state = _rebuild_state_snapshots(user_id, [graph_id]).get(graph_id)
+                db.session.commit()  # Commit if changes were made
+            else:
+                db.session.rollback()
+                new_state = None
+        response = {"status": "ok"}  # Minimal confirmation
+        if old_state and new_state and "error" not in old_state:
+            delta = _state_delta(old_state, new_state)
+            if delta is not None:
+                response["delta"] = delta
+        return jsonify(response)
 
     except Exception as e:
         db.session.rollback()
@@ -675,6 +995,7 @@ def update_badges_shown_status():
                 if success:
                     updated_count += 1
         if updated_count > 0:
+            _rebuild_state_snapshots(user_id)
             db.session.commit()  # Commit only if changes were made
         return jsonify({"status": "ok", "updated": updated_count > 0})
     except Exception as e:
@@ -716,7 +1037,7 @@ def get_all_notes():
 
         # Create a map for quick lookup: node_id -> {title, notes, type} ONLY for nodes WITH notes
         notes_map = {
-            status.node_id: {
+            status.node.id: {
                 "title": status.node.title,
                 "notes": status.user_notes,
                 "type": status.node.type,
@@ -743,17 +1064,19 @@ def get_all_notes():
 
         # 4. Find relationships to determine hierarchy (within this graph)
         # Build a full parent -> children map for traversal
+        parent_node, child_node = aliased(Node), aliased(Node)
         relationships = (
-            db.session.query(
-                NodeRelationship.parent_node_id, NodeRelationship.child_node_id
-            )
+            db.session.query(parent_node.id, child_node.id)
+            .select_from(NodeRelationship)
             .join(
-                Node,
-                NodeRelationship.parent_node_id
-                == Node.id,  # Join to filter by graph_id implicitly via Node
+                parent_node,
+                NodeRelationship.parent_pk
+                == parent_node.pk,  # Join to filter by graph_id implicitly via Node
             )
+            .join(child_node, NodeRelationship.child_pk == child_node.pk)
             .filter(
-                Node.graph_id == graph_id, NodeRelationship.relationship_type == "CHILD"
+                parent_node.graph_id == graph_id,
+                NodeRelationship.relationship_type == "CHILD",
             )
             .all()
         )
@@ -831,6 +1154,37 @@ def get_all_notes():
         )
 
 
+@app.route("/leaderboard")
+@login_required
+def get_leaderboard():
+    """
+    Top-K and the current user's rank on one board:
+    ?board=global (default), ?board=graph&graph=<name> or ?board=category&category=<name>,
+    with ?k=<count> (default 10).
+    """
+    user_id = current_user.id
+    board_type = request.args.get("board", "global")
+    if board_type == "global":
+        board = core_leaderboard.BOARD_GLOBAL
+    elif board_type == "graph":
+        graph = _requested_graph()
+        if not graph:
+            return jsonify({"error": "Graph not found"}), 404
+        board = core_leaderboard.graph_board(graph.id)
+    elif board_type == "category" and request.args.get("category"):
+        board = core_leaderboard.category_board(request.args["category"])
+    else:
+        return jsonify({"error": "Unknown board or missing category"}), 400
+    k = request.args.get("k", 10, type=int)
+    return jsonify(
+        {
+            "board": board,
+            "top": core_leaderboard.get_top(board, k),
+            "me": core_leaderboard.get_rank(board, user_id),
+        }
+    )
+
+
 @app.route("/static/<path:path>")
 def static_files(path):
     # --- Keep static_files logic ---
@@ -940,7 +1294,7 @@ from flask import Flask  # Assuming your app instance might be created different
 from models import Graph, Node, NodeRelationship  # Import your specific models
 
 
-def process_node_uuid(node_data, graph_id, parent_node_id=None):
+def process_node_uuid(node_data, graph_id, parent_node=None):
     """
     Recursively processes a node and its children from the JSON data,
     generating a UUID for each new node and creating Node and
@@ -963,7 +1317,7 @@ def process_node_uuid(node_data, graph_id, parent_node_id=None):
         f"Creating Node: ID='{generated_node_id}', Title='{title}', Type='{node_type}'"
     )
     new_node = Node(
-        id=generated_node_id,  # Use the generated UUID as the primary key
+        id=generated_node_id,  # Use the generated UUID as the external id
         graph_id=graph_id,
         title=title,
         type=node_type,
@@ -971,26 +1325,23 @@ def process_node_uuid(node_data, graph_id, parent_node_id=None):
         pdf_link=node_data.get("pdf_link", None),
     )
     db.session.add(new_node)
-    current_node_id_for_children = generated_node_id  # Use new ID for children
 
     # --- Create Relationship if it has a parent ---
-    if parent_node_id:
+    if parent_node is not None:
         print(
-            f"  Creating Relationship: Parent='{parent_node_id}' -> Child='{generated_node_id}'"
+            f"  Creating Relationship: Parent='{parent_node.id}' -> Child='{generated_node_id}'"
         )
         relationship = NodeRelationship(
-            parent_node_id=parent_node_id,
-            child_node_id=generated_node_id,  # Link to the newly generated child ID
+            parent_node=parent_node,
+            child_node=new_node,  # Integer keys are filled in on flush
             relationship_type="CHILD",
         )
         db.session.add(relationship)
 
     # --- Recursively process children ---
     for child_data in children:
-        # Pass the *generated* ID of the current node as the parent_id for its children
-        process_node_uuid(
-            child_data, graph_id, parent_node_id=current_node_id_for_children
-        )
+        # The current node is the parent of its children
+        process_node_uuid(child_data, graph_id, parent_node=new_node)
 
 
 @app.cli.command("upload-graph-uuid")
@@ -1047,7 +1398,10 @@ def upload_graph_data_uuid(json_filepath, graph_name):
     try:
         for root_node_data in data:
             # Start recursion, no parent for root nodes
-            process_node_uuid(root_node_data, graph_id, parent_node_id=None)
+            process_node_uuid(root_node_data, graph_id, parent_node=None)
+
+        # Invalidate cached static data for this graph in every app process
+        core_data.bump_graph_version(graph_id)
 
         # --- 4. Commit Changes ---
         print("Committing changes to the database...")
@@ -1063,6 +1417,20 @@ def upload_graph_data_uuid(json_filepath, graph_name):
         traceback.print_exc()
 
 
+@app.cli.command("rebuild-leaderboards")
+@click.option("--batch-size", default=500, show_default=True, help="Users per transaction.")
+def rebuild_leaderboards_command(batch_size):
+    """
+    Rebuilds every user's leaderboard counters from the completion rows, in
+    batches of users. Run once after deploying leaderboards, or to repair drift.
+    """
+    try:
+        processed = core_leaderboard.rebuild_scores(core_ctfs.CTF_XP, batch_size)
+        print(f"Rebuilt the leaderboard counters of {processed} users.")
+    except Exception as e:
+        print(f"Error rebuilding leaderboard counters: {e}")
+
+
 if __name__ == "__main__":
     # --- Keep main execution block ---
     # --- Populate Cache At Startup ---
@@ -1,12 +1,14 @@
 
 import os
 import json
+from bisect import bisect_right
+from itertools import accumulate
 from datetime import datetime
-from models import db, Badge, UserBadge, UserExerciseCompletion, UserCtfCompletion, UserStreak, UserNodeStatus, Node, Exercise 
+from models import db, Badge, UserBadge, UserExerciseCompletion, UserCtfCompletion, UserStreak, UserNodeStatus, Node 
 from core import streak as core_streak 
 from core import data as core_data 
 from core import ctfs as core_ctfs 
-from sqlalchemy.orm import joinedload
+from core.cache import VersionedLRUCache
 
 
 
@@ -24,28 +26,25 @@ def get_all_badges():
         return []
 
 
-def get_user_badges(user_id):
-    """Fetches all badges earned by a specific user, eager loading Badge details."""
-    try: 
-        user_badges = UserBadge.query.options(
-            joinedload(UserBadge.badge) 
-        ).filter_by(user_id=user_id).all()
-
-        
-        return [
-            {
-                'id': ub.badge.id, 
-                'title': ub.badge.title,
-                'description': ub.badge.description,
-                'image': ub.badge.image_path, 
-                'earnedAt': ub.earned_at.isoformat() if ub.earned_at else None,
-                'shown': ub.shown
-            }
-            for ub in user_badges if ub.badge 
-        ]
-    except Exception as e:
-        print(f"Error fetching badges for user {user_id}: {e}")
-        return []
+def format_user_badges(user_badges, all_badge_defs_map):
+    """
+    The user's badges for the API, built from (badge_id, earned_at, shown)
+    tuples and the cached badge definitions instead of a query.
+    """
+    badges = []
+    for badge_id, earned_at, shown in user_badges:
+        badge_def = all_badge_defs_map.get(badge_id)
+        if not badge_def:
+            continue
+        badges.append({
+            'id': badge_def['id'],
+            'title': badge_def['title'],
+            'description': badge_def['description'],
+            'image': badge_def['image_path'],
+            'earnedAt': earned_at.isoformat() if earned_at else None,
+            'shown': shown
+        })
+    return badges
 
 def mark_user_badge_shown(user_id, badge_id):
     """Marks a specific badge as shown for a user."""
@@ -53,6 +52,7 @@ def mark_user_badge_shown(user_id, badge_id):
         user_badge = UserBadge.query.filter_by(user_id=user_id, badge_id=badge_id).first()
         if user_badge and not user_badge.shown:
             user_badge.shown = True
+            core_data.bump_user_progress_version(user_id)
             db.session.commit()
             return True
         return False 
@@ -61,141 +61,269 @@ def mark_user_badge_shown(user_id, badge_id):
         print(f"Error marking badge shown for user {user_id}, badge {badge_id}: {e}")
         return False
 
-def award_badge(user_id, badge_id, existing_badge_ids_set, awarded_in_this_run_set):
+# The XP at which each level starts: level i needs 50 + 10 * i more XP than
+# level i - 1. Same table as static/sidebar.js.
+LEVEL_COUNT = 50
+LEVEL_THRESHOLDS = tuple(accumulate((50 + 10 * i for i in range(LEVEL_COUNT)), initial=0))
+
+
+def calculate_level(xp):
+    """Level reached with `xp` (0 below 50 XP, at most LEVEL_COUNT - 1), as the level-N badges count it."""
+    return bisect_right(LEVEL_THRESHOLDS, xp, 0, LEVEL_COUNT) - 1
+
+
+def shown_level(xp):
     """
-    Adds a badge to the session if the user doesn't already have it in the DB
-    and it hasn't been added in this run.
+    Level as the sidebar shows it and highest_level_popup_shown records it:
+    one above calculate_level (level 1 at 0 XP), up to LEVEL_COUNT + 1.
     """
-    if badge_id in awarded_in_this_run_set or badge_id in existing_badge_ids_set:
-        return False 
+    return bisect_right(LEVEL_THRESHOLDS, xp)
+
 
+def graph_xp(compiled_graph, completed_exercise_ids, user_ctf_completions):
+    """
+    XP counted for levels in a graph: the points of its completed required
+    exercises plus core.ctfs.CTF_XP per CTF completion. `completed_exercise_ids`
+    may also be a completion bitset.
+    """
+    completed_required = compiled_graph.as_exercise_mask(completed_exercise_ids) & compiled_graph.required_mask
+    ctf_xp = sum(user_ctf_completions.values()) * core_ctfs.CTF_XP
+    return compiled_graph.exercise_points_in(completed_required) + ctf_xp
+
+def get_main_node_ids(graph_id, compiled_graph=None):
+    """Ids of the graph's main nodes, from the compiled graph when given (no query)."""
+    if compiled_graph is not None:
+        return {compiled_graph.ids[m] for m in compiled_graph.main_ordinals}
     try:
-        
-        badge_def = db.session.get(Badge, badge_id)
-        if badge_def:
-            new_user_badge = UserBadge(user_id=user_id, badge_id=badge_id)
-            db.session.add(new_user_badge) 
-            awarded_in_this_run_set.add(badge_id)
-            print(f"Staging badge '{badge_id}' for user {user_id}")
-            return True
-        else:
-            print(f"Warning: Badge definition '{badge_id}' not found. Cannot award.")
-            return False
+        rows = db.session.query(Node.id).filter(Node.graph_id == graph_id, Node.type == "main").all()
+        return {row[0] for row in rows}
     except Exception as e:
-        print(f"Error trying to award badge {badge_id} to user {user_id}: {e}")
-        return False
+        print(f"Error fetching main nodes for graph {graph_id}: {e}")
+        return set()
 
+# Rule families, in evaluation order. Each compares one metric to its badges' thresholds.
+METRIC_MAIN = "main"            # Per main node: its percent complete
+METRIC_LEVEL = "level"          # Level from XP (see calculate_level)
+METRIC_EXERCISES = "exercises"  # Completed required exercises in the graph
+METRIC_CTF = "ctf"              # Total CTF completions
+METRIC_STREAK = "streak"        # Current streak in days
+BADGE_METRICS = (METRIC_MAIN, METRIC_LEVEL, METRIC_EXERCISES, METRIC_CTF, METRIC_STREAK)
 
+# Domain events raised by the write paths, and the rule families each one can affect
+EVENT_EXERCISE_COMPLETED = "exercise_completed"
+EVENT_CTF_CHANGED = "ctf_changed"
+EVENT_STREAK_ADVANCED = "streak_advanced"
+EVENT_NODE_COMPLETED = "node_completed"  # A main node reached 100%
+EVENT_FAMILIES = {
+    EVENT_EXERCISE_COMPLETED: (METRIC_EXERCISES, METRIC_LEVEL),
+    EVENT_CTF_CHANGED: (METRIC_CTF, METRIC_LEVEL),
+    EVENT_STREAK_ADVANCED: (METRIC_STREAK,),
+    EVENT_NODE_COMPLETED: (METRIC_MAIN,),
+}
 
-def calculate_level(xp):
-    
-    thresholds = [0]
-    current_threshold = 0
-    for i in range(1, 50): 
-        level_xp = 50 + (i - 1) * 10
-        current_threshold += level_xp
-        thresholds.append(current_threshold)
-
-    for i in range(len(thresholds)):
-        if xp < thresholds[i]:
-            return i - 1 
-    return len(thresholds) - 1 
-
-def get_required_exercises_db(graph_id):
-    """Fetches required exercises for a graph from DB."""
-    try:
-        exercises = Exercise.query.join(Node).filter(
-            Node.graph_id == graph_id,
-            Exercise.optional == False
-        ).all()
-        return exercises
-    except Exception as e:
-        print(f"Error fetching required exercises for graph {graph_id}: {e}")
-        return []
+_MAIN_PREFIX = "main-"
 
-def check_and_award_badges(
-    user_id,
-    graph_id, 
+_RULES_KEY = "badge_rules"
+_RULES_VERSION = 0 # Badge rows only change through migrations; see invalidate_badge_rules
+_rules_cache = VersionedLRUCache(max_bytes=4 * 1024 * 1024)
+
+
+def rule_from_badge_id(badge_id):
+    """
+    The (metric, threshold) rule of a badge id following the legacy naming
+    convention ('level-5', 'exercises-10', 'ctf-5', 'streak-7', 'main-<node_id>'),
+    or (None, None). Used to fill in the rule columns of existing badges.
+    """
+    if badge_id.startswith(_MAIN_PREFIX):
+        return METRIC_MAIN, 100
+    metric, _, threshold = badge_id.partition("-")
+    if metric in BADGE_METRICS and threshold.isdigit():
+        return metric, int(threshold)
+    return None, None
+
+
+class BadgeRules:
+    """
+    Badge rules compiled into one sorted threshold table per metric, so the
+    badges a metric value earns are a prefix found by bisection. 'main' rules
+    are indexed by node id instead.
+    """
+
+    def __init__(self, rules):
+        rules = sorted((badge_id, metric, threshold) for badge_id, metric, threshold in rules
+                       if metric in BADGE_METRICS and threshold is not None)
+        tables = {metric: [] for metric in BADGE_METRICS if metric != METRIC_MAIN}
+        self.main_rules = {} # node id -> (threshold, badge id)
+        for badge_id, metric, threshold in rules:
+            if metric == METRIC_MAIN:
+                if badge_id.startswith(_MAIN_PREFIX):
+                    self.main_rules[badge_id[len(_MAIN_PREFIX):]] = (threshold, badge_id)
+            else:
+                tables[metric].append((threshold, badge_id))
+        self.thresholds = {}
+        self.badge_ids = {}
+        for metric, table in tables.items():
+            table.sort()
+            self.thresholds[metric] = [threshold for threshold, _ in table]
+            self.badge_ids[metric] = [badge_id for _, badge_id in table]
+
+    def earned(self, metric, value):
+        """Ids of the metric's badges whose threshold `value` reaches, lowest threshold first."""
+        return self.badge_ids[metric][:bisect_right(self.thresholds[metric], value)]
+
+    def earned_main(self, node_percents):
+        """Ids of the 'main' badges earned, given {node_id: percent} for the graph's main nodes."""
+        earned = []
+        for node_id, percent in node_percents.items():
+            rule = self.main_rules.get(node_id)
+            if rule is not None and percent >= rule[0]:
+                earned.append(rule[1])
+        return earned
+
+
+def _load_badge_rules():
+    rows = db.session.query(Badge.id, Badge.metric, Badge.threshold).all()
+    return BadgeRules(rows), 64 * (len(rows) + 1)
+
+
+def get_badge_rules():
+    """The compiled badge rules, loaded from the Badge rows once per process."""
+    return _rules_cache.get_or_load(_RULES_KEY, _RULES_VERSION, _load_badge_rules)
+
+
+def invalidate_badge_rules():
+    """Drops the compiled badge rules, e.g. after badge definitions changed."""
+    _rules_cache.invalidate()
+
+
+def families_for_events(events):
+    """The rule families (metrics) affected by the given events, in evaluation order."""
+    affected = {metric for event in events for metric in EVENT_FAMILIES.get(event, ())}
+    return tuple(metric for metric in BADGE_METRICS if metric in affected)
+
+
+def reaches_main_completion(node_status_updates, graph_id, compiled_graph=None):
+    """Whether the node status updates (see core.nodes) bring a main node to 100%."""
+    completed = [node_id for node_id, updates in node_status_updates.items()
+                 if updates.get('percent_complete') == 100]
+    if not completed:
+        return False
+    main_node_ids = get_main_node_ids(graph_id, compiled_graph)
+    return any(node_id in main_node_ids for node_id in completed)
+
+
+def compute_badge_metrics(
+    graph_id,
     user_streak_data,
     user_ctf_completions,
     user_node_status_map,
     completed_exercise_ids,
-    required_exercises,     
-    existing_badge_ids,     
-    all_badge_defs_map      
+    compiled_graph=None,
+    families=BADGE_METRICS
     ):
-    """Checks criteria and stages badge awards using only passed arguments."""
-    newly_awarded_badge_defs = []
-    awarded_in_this_run = set() 
-    try:
-        
-
-        
-        exercise_xp = sum(ex.points for ex in required_exercises if ex.id in completed_exercise_ids)
-        ctf_xp = sum(count * 30 for count in user_ctf_completions.values())
-        total_xp = exercise_xp + ctf_xp
-        level = calculate_level(total_xp)
-
-        
-
-        
-        for node_id, status in user_node_status_map.items():
-            node = db.session.get(Node, node_id) 
-            if node and node.type == "main" and status.percent_complete == 100:
-                badge_id = f"main-{node_id}"
-                
-                if award_badge(user_id, badge_id, existing_badge_ids, awarded_in_this_run):
-                     badge_def = all_badge_defs_map.get(badge_id) 
-                     if badge_def: newly_awarded_badge_defs.append(badge_def)
+    """
+    The values the badge rules compare to their thresholds, {metric: value}
+    for the rule families in `families`. Inputs only other families read are
+    ignored and may be None. The 'main' metric is the sorted list of the
+    graph's main nodes at 100%.
 
-        
-        for lvl in [5, 10, 15, 20, 25, 30]:
-            if level >= lvl:
-                badge_id = f"level-{lvl}"
-                if award_badge(user_id, badge_id, existing_badge_ids, awarded_in_this_run):
-                     badge_def = all_badge_defs_map.get(badge_id)
-                     if badge_def: newly_awarded_badge_defs.append(badge_def)
+    The 'level' and 'exercises' families read the required exercises from
+    `compiled_graph`, so it must be given for them; `completed_exercise_ids`
+    may be ids or a completion bitset.
+    """
+    metrics = {}
+    if METRIC_MAIN in families:
+        main_node_ids = get_main_node_ids(graph_id, compiled_graph)
+        metrics[METRIC_MAIN] = sorted(node_id for node_id, status in user_node_status_map.items()
+                                      if node_id in main_node_ids and status.percent_complete == 100)
+    if METRIC_LEVEL in families or METRIC_EXERCISES in families:
+        completed_required = (compiled_graph.as_exercise_mask(completed_exercise_ids)
+                              & compiled_graph.required_mask)
+        exercise_xp = compiled_graph.exercise_points_in(completed_required)
+        completed_count = completed_required.bit_count()
+        if METRIC_LEVEL in families:
+            ctf_xp = sum(user_ctf_completions.values()) * core_ctfs.CTF_XP
+            metrics[METRIC_LEVEL] = calculate_level(exercise_xp + ctf_xp)
+        if METRIC_EXERCISES in families:
+            metrics[METRIC_EXERCISES] = completed_count
+    if METRIC_CTF in families:
+        metrics[METRIC_CTF] = sum(user_ctf_completions.values())
+    if METRIC_STREAK in families:
+        metrics[METRIC_STREAK] = user_streak_data.get("streak", 0)
+    return metrics
 
-        
-        completed_count = len(completed_exercise_ids.intersection({ex.id for ex in required_exercises}))
-        total_req_count = len(required_exercises)
-        
-        ex_milestones = [10, 25, 50, 75, 100]
-        if total_req_count > 0: ex_milestones.append(total_req_count)
-        for count in sorted(list(set(ex_milestones))):
-             if count == 0: continue
-             if completed_count >= count:
-                badge_id = f"exercises-{count}"
-                if award_badge(user_id, badge_id, existing_badge_ids, awarded_in_this_run):
-                     badge_def = all_badge_defs_map.get(badge_id)
-                     if badge_def: newly_awarded_badge_defs.append(badge_def)
 
+def evaluate_badges(user_id, metrics, existing_badge_ids, all_badge_defs_map, rules=None):
+    """
+    Awards the badges earned at `metrics` (see compute_badge_metrics); only the
+    rule families present in `metrics` are evaluated. Badges in
+    `existing_badge_ids` (may be None) or missing from `all_badge_defs_map`
+    are left out, and the rest are written with one insert that skips the ones
+    the user already has (see core.data.insert_user_badges).
 
-        
-        total_ctf_completed = sum(user_ctf_completions.values())
-        
-        for count in [5, 10, 15, 20, 25, 30]:
-            if total_ctf_completed >= count:
-                badge_id = f"ctf-{count}"
-                if award_badge(user_id, badge_id, existing_badge_ids, awarded_in_this_run):
-                     badge_def = all_badge_defs_map.get(badge_id)
-                     if badge_def: newly_awarded_badge_defs.append(badge_def)
+    Returns the definitions of the newly awarded badges.
+    """
+    rules = rules or get_badge_rules()
+    existing_badge_ids = existing_badge_ids or ()
+    earned = []
+    for metric in BADGE_METRICS:
+        if metric not in metrics:
+            continue
+        if metric == METRIC_MAIN:
+            earned.extend(rules.earned_main(dict.fromkeys(metrics[metric], 100)))
+        else:
+            earned.extend(rules.earned(metric, metrics[metric]))
+    candidates = [badge_id for badge_id in earned if badge_id not in existing_badge_ids
+                  and (all_badge_defs_map is None or badge_id in all_badge_defs_map)]
+    inserted = core_data.insert_user_badges(user_id, candidates)
+    if inserted:
+        core_data.bump_user_progress_version(user_id)
+        print(f"Staging badges {inserted} for user {user_id}")
+    if not all_badge_defs_map:
+        return []
+    return [all_badge_defs_map[badge_id] for badge_id in inserted if badge_id in all_badge_defs_map]
 
-        
-        current_streak = user_streak_data.get("streak", 0)
-        
-        for days in [7, 14, 21, 28]:
-            if current_streak >= days:
-                badge_id = f"streak-{days}"
-                if award_badge(user_id, badge_id, existing_badge_ids, awarded_in_this_run):
-                     badge_def = all_badge_defs_map.get(badge_id)
-                     if badge_def: newly_awarded_badge_defs.append(badge_def)
 
-        
+def award_event_badges(
+    user_id,
+    graph_id,
+    events,
+    user_streak_data=None,
+    user_ctf_completions=None,
+    user_node_status_map=None,
+    completed_exercise_ids=None,
+    compiled_graph=None,
+    all_badge_defs_map=None
+    ):
+    """
+    Evaluates the rule families affected by `events` (EVENT_* names raised by
+    a write path) and stages the badges they award. Only the inputs those
+    families read are used; the ones passed as None are loaded when needed.
+    `graph_id` and `compiled_graph` may be None when no graph-level family is
+    affected (e.g. a streak advanced at login).
 
+    Returns the definitions of the newly awarded badges.
+    """
+    try:
+        families = families_for_events(events)
+        if not families:
+            return []
+        if user_streak_data is None and METRIC_STREAK in families:
+            user_streak_data = core_streak.get_user_streak(user_id)
+        if user_ctf_completions is None and (METRIC_CTF in families or METRIC_LEVEL in families):
+            user_ctf_completions = core_ctfs.get_user_ctf_completions(user_id)
+        needs_completions = METRIC_LEVEL in families or METRIC_EXERCISES in families
+        if ((user_node_status_map is None and METRIC_MAIN in families)
+                or (completed_exercise_ids is None and needs_completions)):
+            status_map, completed = core_data.get_user_progress(user_id, graph_id)
+            if user_node_status_map is None:
+                user_node_status_map = status_map
+            if completed_exercise_ids is None:
+                completed_exercise_ids = completed
+        metrics = compute_badge_metrics(
+            graph_id, user_streak_data, user_ctf_completions, user_node_status_map,
+            completed_exercise_ids, compiled_graph, families)
+        return evaluate_badges(user_id, metrics, None, all_badge_defs_map)
     except Exception as e:
-        print(f"Error during check_and_award_badges (staging) for user {user_id}: {e}")
+        print(f"Error evaluating badges for events {sorted(events)} of user {user_id}: {e}")
         return []
-
-    
-    return newly_awarded_badge_defs
\ No newline at end of file
@@ -0,0 +1,159 @@
+import itertools
+from threading import Event, Lock
+
+
+class _Flight:
+    """One in-progress load that concurrent callers for the same key wait on."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class VersionedLRUCache:
+    """
+    Small in-process LRU cache whose entries are tagged with a version.
+
+    An entry is only returned when the caller asks for the same version it
+    was stored under, so bumping a version in the database is enough to make
+    every worker reload. Entries carry an approximate size in bytes and the
+    least recently used ones are evicted once `max_bytes` is exceeded.
+
+    Reads never take a lock: writers build a new entry map and swap it in
+    with a single assignment (read-copy-update), so readers always see a
+    complete snapshot. Misses go through `get_or_load`, which runs at most
+    one loader per key at a time; other keys are never blocked by it.
+    Cached values are shared between threads and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = {}  # key -> (version, value, cost); replaced, never mutated
+        self._last_used = {}  # key -> tick, for LRU ordering
+        self._ticks = itertools.count()
+        self._inflight = {}  # (key, version) -> _Flight
+        self._lock = Lock()  # Serializes writers and in-flight bookkeeping only
+        # Counters are updated without locking and may be slightly off under contention
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    def get(self, key, version):
+        """Returns the cached value for key at `version`, or None."""
+        value = self._lookup(key, version)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def contains(self, key, version):
+        """Whether key is cached at `version`, without counting a hit or miss."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] == version
+
+    def _lookup(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        self._last_used[key] = next(self._ticks)
+        return entry[1]
+
+    def get_or_load(self, key, version, loader):
+        """
+        Returns the cached value for key/version, calling `loader()` on a miss.
+        `loader` returns (value, cost); a cost of None means "don't cache".
+        Concurrent misses for the same key/version share a single loader call,
+        and an exception raised by it is re-raised in every waiting caller.
+        """
+        value = self.get(key, version)
+        if value is not None:
+            return value
+
+        flight_key = (key, version)
+        with self._lock:
+            flight = self._inflight.get(flight_key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._inflight[flight_key] = flight
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            # Another thread may have finished loading just before we registered
+            # (not counted again: this caller's miss is already recorded)
+            value = self._lookup(key, version)
+            if value is None:
+                self.loads += 1
+                value, cost = loader()
+                if cost is not None:
+                    self.put(key, version, value, cost)
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(flight_key, None)
+            flight.done.set()
+
+    def put(self, key, version, value, cost):
+        """Stores value under key/version and evicts LRU entries over budget."""
+        if cost > self.max_bytes:
+            print(f"Cache entry {key!r} ({cost} bytes) exceeds budget of {self.max_bytes} bytes. Not caching.")
+            return False
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current[0] > version:
+                # A slow load of an older version must not replace a newer one
+                return False
+            entries = dict(self._entries)
+            entries[key] = (version, value, cost)
+            self._last_used[key] = next(self._ticks)
+            self._evict_over_budget(entries, keep=key)
+            self._entries = entries
+            return True
+
+    def invalidate(self, key=None):
+        """Drops one key, or the whole cache when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries = {}
+                self._last_used = {}
+            elif key in self._entries:
+                entries = dict(self._entries)
+                del entries[key]
+                self._last_used.pop(key, None)
+                self._entries = entries
+
+    def stats(self):
+        entries = self._entries
+        return {
+            'entries': len(entries),
+            'bytes': sum(entry[2] for entry in entries.values()),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
+
+    def _evict_over_budget(self, entries, keep):
+        # Caller must hold self._lock; `entries` is the new, not yet published map
+        total_bytes = sum(entry[2] for entry in entries.values())
+        while total_bytes > self.max_bytes and len(entries) > 1:
+            oldest_key = min(
+                (k for k in entries if k != keep),
+                key=lambda k: self._last_used.get(k, -1),
+            )
+            total_bytes -= entries.pop(oldest_key)[2]
+            self._last_used.pop(oldest_key, None)
+            self.evictions += 1
@@ -2,7 +2,11 @@
 import json
 import os
 from models import db, Ctf, UserCtfCompletion 
+from core import data as core_data
+from core import leaderboard as core_leaderboard
 
+# XP per CTF completion; it counts towards the level in every graph
+CTF_XP = 30
 
 
 def get_all_ctfs():
@@ -31,13 +35,18 @@ def update_user_ctf_completion(user_id, ctf_id, delta):
     try:
         completion = UserCtfCompletion.query.filter_by(user_id=user_id, ctf_id=ctf_id).first()
 
+        old_count = completion.completed_count if completion else 0
         if completion:
             completion.completed_count = max(0, completion.completed_count + delta) 
         elif delta > 0:
             
             completion = UserCtfCompletion(user_id=user_id, ctf_id=ctf_id, completed_count=delta)
             db.session.add(completion)
-        
+        new_count = completion.completed_count if completion else 0
+        # CTF XP counts in every graph; committed together with the count
+        core_data.add_user_xp(user_id, (new_count - old_count) * CTF_XP)
+        core_leaderboard.record_ctf_completions(user_id, new_count - old_count, CTF_XP)
+        core_data.bump_user_progress_version(user_id)
 
         db.session.commit()
         return True 
@@ -1,8 +1,15 @@
-
+import collections
 import json
 import os
-from models import db, Node, Exercise, NodeRelationship, UserExerciseCompletion, UserNodeStatus 
-from sqlalchemy.orm import joinedload, selectinload 
+from models import (db, User, Graph, Node, Exercise, NodeRelationship, UserExerciseCompletion, UserNodeStatus,
+                    UserGraphState, UserStreak, UserCtfCompletion, UserBadge)
+from sqlalchemy import select, union_all, literal, cast, type_coerce, null, false, Integer, Text, Date, DateTime, LargeBinary
+from sqlalchemy.orm import joinedload, selectinload, aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from core.cache import VersionedLRUCache
+from core.graph import compile_graph
+from core import leaderboard as core_leaderboard
 
 
 
@@ -10,54 +17,132 @@ from sqlalchemy.orm import joinedload, selectinload
 
 
 
-from threading import Lock
-_static_cache = {}
-_cache_lock = Lock()
+# Approximate memory budget (bytes of serialized JSON) shared by all cached graphs.
+STATIC_GRAPH_CACHE_MAX_BYTES = int(os.environ.get("STATIC_GRAPH_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+_static_cache = VersionedLRUCache(STATIC_GRAPH_CACHE_MAX_BYTES)
 
-def get_cached_static_graph_data(graph_id):
-    cache_key = f"graph_{graph_id}"
-    
-    # if cache_key in _static_cache:
-        # print(f"CACHE HIT for {cache_key}")
-        # return _static_cache[cache_key]
+# Opt-in: read the user's completed exercises of a graph from the per-(user, graph)
+# bitmap in user_graph_state instead of the user_exercise_completion rows. The rows
+# stay the source of truth; bitmaps are rebuilt from them by the mutation endpoints.
+COMPLETION_BITMAPS = os.environ.get("COMPLETION_BITMAPS", "False").lower() == "true"
 
-    
-    with _cache_lock:
 
-        print(f"CACHE MISS for {cache_key}. Fetching from DB...")
-        
-        
-        nodes_list, links_list = get_static_graph_data(graph_id) 
-        if nodes_list: 
-             _static_cache[cache_key] = (nodes_list, links_list)
-        return nodes_list, links_list
+def get_graph_version(graph_id):
+    """Returns the current version counter of a graph (0 if it doesn't exist)."""
+    try:
+        version = db.session.query(Graph.version).filter(Graph.id == graph_id).scalar()
+        return version or 0
+    except Exception as e:
+        print(f"Error fetching version for graph {graph_id}: {e}")
+        return 0
+
+
+def bump_graph_version(graph_id):
+    """
+    Increments the graph's version counter so cached static data for it is
+    reloaded by every process. Does not commit; the caller's transaction does.
+    """
+    db.session.query(Graph).filter(Graph.id == graph_id).update(
+        {Graph.version: Graph.version + 1}, synchronize_session=False
+    )
+    _static_cache.invalidate(graph_id)
+
+
+def get_user_progress_version(user_id):
+    """Returns the user's progress version counter (0 if the user doesn't exist)."""
+    try:
+        version = db.session.query(User.progress_version).filter(User.id == user_id).scalar()
+        return version or 0
+    except Exception as e:
+        print(f"Error fetching progress version for user {user_id}: {e}")
+        return 0
+
+
+def bump_user_progress_version(user_id):
+    """
+    Increments the user's progress version, which makes their materialized
+    /data snapshots stale. Called by every write to the user's progress.
+    Does not commit; the caller's transaction does.
+    """
+    db.session.query(User).filter(User.id == user_id).update(
+        {User.progress_version: User.progress_version + 1}, synchronize_session=False
+    )
+
+
+def invalidate_static_graph_cache(graph_id=None):
+    """Drops cached static data for one graph, or for all graphs."""
+    _static_cache.invalidate(graph_id)
+
+
+def _estimate_size(nodes_list, links_list):
+    return len(json.dumps(nodes_list)) + len(json.dumps(links_list))
+
+
+def get_cached_static_graph(graph_id, graph_version=None):
+    """
+    Returns (nodes_list, links_list, compiled_graph) for a graph from the
+    per-process cache, loading and compiling it on a miss. Entries are keyed
+    by graph id and only served while `graph_version` matches; pass it when
+    the Graph row is already at hand to avoid the extra version lookup.
+    Everything returned is shared between requests and must not be mutated.
+    """
+    if graph_version is None:
+        graph_version = get_graph_version(graph_id)
+
+    def load():
+        print(f"CACHE MISS for graph {graph_id} (version {graph_version}). Fetching from DB...")
+        nodes_list, links_list = get_static_graph_data(graph_id)
+        compiled_graph = compile_graph(nodes_list, links_list, graph_version)
+        cost = _estimate_size(nodes_list, links_list) if nodes_list else None # Don't cache empty graphs
+        return (nodes_list, links_list, compiled_graph), cost
+
+    # Single-flight per graph: concurrent misses share one DB load, other graphs aren't blocked
+    return _static_cache.get_or_load(graph_id, graph_version, load)
+
+
+def is_static_graph_cached(graph_id, graph_version):
+    """Whether get_cached_static_graph would return without touching the database."""
+    return graph_version is not None and _static_cache.contains(graph_id, graph_version)
+
+
+def get_cached_static_graph_data(graph_id, graph_version=None):
+    """Returns the cached (nodes_list, links_list) for a graph. See get_cached_static_graph."""
+    nodes_list, links_list, _ = get_cached_static_graph(graph_id, graph_version)
+    return nodes_list, links_list
     
 def get_static_graph_data(graph_id):
     """
     Fetches static data for a given graph_id from the database.
-    Uses eager loading for exercises and categories.
+    Uses eager loading for exercises and categories. Nodes and exercises come
+    in key order, so every process compiles the same exercise ordinals.
     """
     try: 
         nodes_with_exercises = db.session.query(Node).options(
             selectinload(Node.exercises).options( 
                selectinload(Exercise.categories) 
             )
-        ).filter(Node.graph_id == graph_id).all()
+        ).filter(Node.graph_id == graph_id).order_by(Node.pk).all()
 
         
-        node_ids = {node.id for node in nodes_with_exercises}
-        if not node_ids: return [], [] 
+        node_pks = {node.pk for node in nodes_with_exercises}
+        if not node_pks: return [], [] 
 
-        relationships = db.session.query(NodeRelationship).filter(
-            (NodeRelationship.parent_node_id.in_(node_ids)) |
-            (NodeRelationship.child_node_id.in_(node_ids))
+        # Links are keyed by the nodes' external ids; either end may belong to another graph
+        parent, child = aliased(Node), aliased(Node)
+        relationships = db.session.query(
+            parent.id, child.id, NodeRelationship.relationship_type
+        ).select_from(NodeRelationship).join(parent, parent.pk == NodeRelationship.parent_pk).join(
+            child, child.pk == NodeRelationship.child_pk
+        ).filter(
+            (NodeRelationship.parent_pk.in_(node_pks)) |
+            (NodeRelationship.child_pk.in_(node_pks))
         ).all()
 
         
         nodes_dict_list = []
         for node in nodes_with_exercises:
              node_dict = {
-                 'id': node.id, 'graph_id': node.graph_id, 'title': node.title,
+                 'id': node.id, 'pk': node.pk, 'graph_id': node.graph_id, 'title': node.title,
                  'type': node.type, 'popup_text': node.popup_text, 'pdf_link': node.pdf_link,
                  
                  'popup': {
@@ -67,7 +152,7 @@ def get_static_graph_data(graph_id):
                            { 'id': ex.id, 'label': ex.label, 'points': ex.points,
                              'optional': ex.optional,
                              'categories': [cat.name for cat in ex.categories] 
-                           } for ex in node.exercises 
+                           } for ex in sorted(node.exercises, key=lambda ex: ex.pk)
                       ]
                  }
              }
@@ -75,8 +160,8 @@ def get_static_graph_data(graph_id):
 
         
         links_dict_list = [
-            {'source': rel.parent_node_id, 'target': rel.child_node_id, 'type': rel.relationship_type}
-            for rel in relationships
+            {'source': source, 'target': target, 'type': relationship_type}
+            for source, target, relationship_type in relationships
         ]
 
         return nodes_dict_list, links_dict_list
@@ -86,48 +171,244 @@ def get_static_graph_data(graph_id):
 
 def get_user_progress(user_id, graph_id):
     """
-    Fetches user-specific progress data for a given graph.
-    Loads related Node data for filtering.
+    Fetches user-specific progress data for a given graph, as the mutation
+    paths need it. Both queries are restricted to the graph in SQL and only
+    select the columns that are used, so no ORM entities are loaded. The
+    status columns are those of ix_user_node_status_progress, so that side
+    is an index-only scan; notes are only read for GET /data
+    (see get_user_state_inputs).
+
+    Returns:
+        tuple: (node_status_map, completed_exercise_ids)
+               - node_status_map: {node_id: row} where each row has the attributes
+                 node_id, percent_complete, unlocked and discovered.
+               - completed_exercise_ids: Set of the user's completed exercise IDs in this graph.
     """
     try: 
-        
-        node_statuses = db.session.query(UserNodeStatus).options(
-            joinedload(UserNodeStatus.node) 
-        ).filter(UserNodeStatus.user_id == user_id).all() 
-
-        
-        node_status_map = {
-            status.node_id: status
-            for status in node_statuses
-            
-            if status.node and status.node.graph_id == graph_id
-        }
-
-        
-        completed_exercises = db.session.query(UserExerciseCompletion.exercise_id).filter(
-            UserExerciseCompletion.user_id == user_id
+        node_statuses = db.session.query(
+            Node.id.label('node_id'),
+            UserNodeStatus.percent_complete,
+            UserNodeStatus.unlocked,
+            UserNodeStatus.discovered,
+        ).join(Node, Node.pk == UserNodeStatus.node_pk).filter(
+            UserNodeStatus.user_id == user_id,
+            Node.graph_id == graph_id
         ).all()
-        completed_exercise_ids = {ex_id[0] for ex_id in completed_exercises}
+        node_status_map = {status.node_id: status for status in node_statuses}
 
-        return node_status_map, completed_exercise_ids
+        return node_status_map, _get_completed_exercise_ids(user_id, graph_id)
     except Exception as e:
         print(f"Error in get_user_progress for user {user_id}, graph {graph_id}: {e}")
         return {}, set() 
 
 
-def update_user_exercise_completion(user_id, exercise_id, completed):
-    """Updates the completion status for a user's exercise."""
+def _get_completed_exercise_ids(user_id, graph_id):
+    completed_exercises = db.session.query(Exercise.id).join(
+        UserExerciseCompletion, UserExerciseCompletion.exercise_pk == Exercise.pk
+    ).join(Node, Node.pk == Exercise.node_pk).filter(
+        UserExerciseCompletion.user_id == user_id,
+        Node.graph_id == graph_id
+    ).all()
+    return {ex_id[0] for ex_id in completed_exercises}
+
+
+# Row kinds of the get_user_state_inputs query
+(_INPUT_USER, _INPUT_STREAK, _INPUT_NODE_STATUS, _INPUT_COMPLETION, _INPUT_CTF, _INPUT_BADGE,
+ _INPUT_BITMAP, _INPUT_XP) = range(8)
+
+NodeStatusRow = collections.namedtuple(
+    'NodeStatusRow', 'node_id percent_complete unlocked discovered user_notes')
+UserStateInputs = collections.namedtuple(
+    'UserStateInputs',
+    'highest_level_popup_shown streak node_status_map completed_exercise_ids ctf_completions user_badges '
+    'completion_mask xp')
+
+
+def _input_rows(kind, key=None, num1=None, num2=None, num3=None, text=None, day=None, ts=None, blob=None):
+    """One branch of the get_user_state_inputs UNION ALL, padded to the common column layout."""
+    def column(value, type_, name):
+        # Typed NULL padding keeps PostgreSQL's UNION type resolution happy; real columns
+        # are only retyped on the Python side (SQLite's CAST to DATE would mangle them).
+        if value is None:
+            return cast(null(), type_).label(name)
+        return type_coerce(value, type_).label(name)
+    return select(
+        literal(kind, Integer).label('kind'),
+        column(key, Text, 'key'),
+        column(num1, Integer, 'num1'),
+        column(num2, Integer, 'num2'),
+        column(num3, Integer, 'num3'),
+        column(text, Text, 'text'),
+        column(day, Date, 'day'),
+        column(ts, DateTime(timezone=True), 'ts'),
+        column(blob, LargeBinary, 'blob'),
+    )
+
+
+def _flag(value):
+    return None if value is None else bool(value)
+
+
+def get_user_state_inputs(user_id, graph_id, graph_version=None):
+    """
+    Fetches every per-user input of the GET /data state for one graph in a
+    single round-trip: one UNION ALL over the user, streak, node status,
+    exercise completion, CTF completion and badge rows and the graph's XP
+    counter, each tagged with its kind and padded to a common column layout.
+    The XP counter is only read if it was computed for `graph_version`.
+
+    With COMPLETION_BITMAPS and a `graph_version`, the user's completion
+    bitmap for that graph version replaces the completion rows. If there is
+    no such bitmap (never built, or built for an older graph version), the
+    completions are read from the rows with a second query.
+
+    Returns:
+        UserStateInputs, or None if the user doesn't exist (or on error):
+            - highest_level_popup_shown (int)
+            - streak: (current_streak, last_used_date), or None without a streak record.
+            - node_status_map: {node_id: NodeStatusRow} for the graph's nodes.
+            - completed_exercise_ids: Set of completed exercise IDs in the graph,
+              or None when completion_mask is given.
+            - ctf_completions: {ctf_id: completed_count}
+            - user_badges: List of (badge_id, earned_at, shown), in award order.
+            - completion_mask: Completion bitset (int) over the exercise ordinals of
+              the graph version's CompiledGraph, or None.
+            - xp: The user's XP counter for the graph (UserGraphState.xp), or None
+              if it was never computed or is from another graph version.
+    """
+    use_bitmap = COMPLETION_BITMAPS and graph_version is not None
+    if use_bitmap:
+        completions = _input_rows(_INPUT_BITMAP, blob=UserGraphState.completion_bitmap).where(
+            UserGraphState.user_id == user_id,
+            UserGraphState.graph_id == graph_id,
+            UserGraphState.completion_bitmap_version == graph_version
+        )
+    else:
+        completions = (
+            _input_rows(_INPUT_COMPLETION, key=Exercise.id)
+                .select_from(UserExerciseCompletion)
+                .join(Exercise, Exercise.pk == UserExerciseCompletion.exercise_pk)
+                .join(Node, Node.pk == Exercise.node_pk)
+                .where(UserExerciseCompletion.user_id == user_id, Node.graph_id == graph_id)
+        )
+    # An XP counter is only valid for the graph version it was computed for
+    xp_is_current = (UserGraphState.xp_graph_version == graph_version
+                     if graph_version is not None else false())
     try:
+        stmt = union_all(
+            _input_rows(_INPUT_USER, num1=User.highest_level_popup_shown).where(User.id == user_id),
+            _input_rows(_INPUT_STREAK, num1=UserStreak.current_streak, day=UserStreak.last_used_date)
+                .where(UserStreak.user_id == user_id),
+            _input_rows(
+                _INPUT_NODE_STATUS, key=Node.id, num1=UserNodeStatus.percent_complete,
+                num2=cast(UserNodeStatus.unlocked, Integer), num3=cast(UserNodeStatus.discovered, Integer),
+                text=UserNodeStatus.user_notes,
+            ).select_from(UserNodeStatus).join(Node, Node.pk == UserNodeStatus.node_pk)
+                .where(UserNodeStatus.user_id == user_id, Node.graph_id == graph_id),
+            completions,
+            _input_rows(_INPUT_CTF, num1=UserCtfCompletion.ctf_id, num2=UserCtfCompletion.completed_count)
+                .where(UserCtfCompletion.user_id == user_id),
+            _input_rows(
+                _INPUT_BADGE, key=UserBadge.badge_id, num1=cast(UserBadge.shown, Integer),
+                num2=UserBadge.user_badge_id, ts=UserBadge.earned_at,
+            ).where(UserBadge.user_id == user_id),
+            _input_rows(_INPUT_XP, num1=UserGraphState.xp).where(
+                UserGraphState.user_id == user_id,
+                UserGraphState.graph_id == graph_id,
+                xp_is_current
+            ),
+        )
+        rows = db.session.execute(stmt).all()
+    except Exception as e:
+        print(f"Error fetching state inputs for user {user_id}, graph {graph_id}: {e}")
+        return None
+
+    highest_level_popup_shown = None
+    streak = None
+    node_status_map = {}
+    completed_exercise_ids = set()
+    ctf_completions = {}
+    badge_rows = []
+    completion_mask = None
+    xp = None
+    for kind, key, num1, num2, num3, text, day, ts, blob in rows:
+        if kind == _INPUT_NODE_STATUS:
+            node_status_map[key] = NodeStatusRow(key, num1, _flag(num2), _flag(num3), text)
+        elif kind == _INPUT_COMPLETION:
+            completed_exercise_ids.add(key)
+        elif kind == _INPUT_BITMAP:
+            completion_mask = int.from_bytes(blob or b'', 'little')
+        elif kind == _INPUT_CTF:
+            ctf_completions[num1] = num2
+        elif kind == _INPUT_BADGE:
+            badge_rows.append((num2, key, ts, _flag(num1)))
+        elif kind == _INPUT_STREAK:
+            streak = (num1, day)
+        elif kind == _INPUT_USER:
+            highest_level_popup_shown = num1
+        elif kind == _INPUT_XP:
+            xp = num1
+
+    if highest_level_popup_shown is None:
+        return None
+    if completion_mask is not None:
+        completed_exercise_ids = None
+    elif use_bitmap:
+        try:
+            completed_exercise_ids = _get_completed_exercise_ids(user_id, graph_id)
+        except Exception as e:
+            print(f"Error fetching completions for user {user_id}, graph {graph_id}: {e}")
+            return None
+    badge_rows.sort(key=lambda row: row[0])
+    return UserStateInputs(
+        highest_level_popup_shown,
+        streak,
+        node_status_map,
+        completed_exercise_ids,
+        ctf_completions,
+        [row[1:] for row in badge_rows],
+        completion_mask,
+        xp,
+    )
+
+
+def update_user_exercise_completion(user_id, exercise_id, completed, commit=True):
+    """
+    Updates the completion status for a user's exercise.
+    With commit=False the change is only staged, so the caller can persist the
+    derived node statuses in the same transaction.
+    """
+    try:
+        # Completions reference the exercise's integer key, resolved within the same statement
+        exercise_pk = select(Exercise.pk).where(Exercise.id == exercise_id)
         if completed:
-            
-            
-            completion = UserExerciseCompletion(user_id=user_id, exercise_id=exercise_id)
-            db.session.merge(completion)
+            insert = _upsert_inserts.get(db.session.get_bind().dialect.name)
+            if insert is not None:
+                changed = db.session.execute(
+                    insert(UserExerciseCompletion).from_select(
+                        ['user_id', 'exercise_pk'],
+                        select(literal(user_id), Exercise.pk).where(Exercise.id == exercise_id)
+                    ).on_conflict_do_nothing(index_elements=['user_id', 'exercise_pk'])
+                ).rowcount
+            else:
+                pk = db.session.scalar(exercise_pk)
+                changed = pk is not None and not UserExerciseCompletion.query.filter_by(
+                    user_id=user_id, exercise_pk=pk
+                ).first()
+                if changed:
+                    db.session.add(UserExerciseCompletion(user_id=user_id, exercise_pk=pk))
         else:
-            
-            UserExerciseCompletion.query.filter_by(user_id=user_id, exercise_id=exercise_id).delete()
+            changed = UserExerciseCompletion.query.filter(
+                UserExerciseCompletion.user_id == user_id,
+                UserExerciseCompletion.exercise_pk == exercise_pk.scalar_subquery()
+            ).delete(synchronize_session='fetch')
+        if changed:
+            # Leaderboard counters move with the row, in the same transaction
+            core_leaderboard.record_exercise_completion(user_id, exercise_id, completed)
+        bump_user_progress_version(user_id)
 
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return True 
     except Exception as e:
         db.session.rollback()
@@ -137,13 +418,19 @@ def update_user_exercise_completion(user_id, exercise_id, completed):
 def update_user_node_notes(user_id, node_id, notes):
     """Updates the user's notes for a specific node."""
     try:
-        status = UserNodeStatus.query.filter_by(user_id=user_id, node_id=node_id).first()
+        status = UserNodeStatus.query.join(Node).filter(
+            UserNodeStatus.user_id == user_id, Node.id == node_id
+        ).first()
         if status:
             status.user_notes = notes
         else:
-            
-            status = UserNodeStatus(user_id=user_id, node_id=node_id, user_notes=notes)
+            node_pk = db.session.scalar(select(Node.pk).where(Node.id == node_id))
+            if node_pk is None:
+                print(f"Error updating notes for user {user_id}: node {node_id} not found")
+                return False
+            status = UserNodeStatus(user_id=user_id, node_pk=node_pk, user_notes=notes)
             db.session.add(status)
+        bump_user_progress_version(user_id)
         db.session.commit()
         return True
     except Exception as e:
@@ -151,37 +438,303 @@ def update_user_node_notes(user_id, node_id, notes):
         print(f"Error updating notes for user {user_id}, node {node_id}: {e}")
         return False
 
-def update_user_node_status_bulk(user_id, node_status_updates):
+# Derived columns written by update_user_node_status_bulk, and the rows per upsert statement
+# (kept well under the bind parameter limits of PostgreSQL and SQLite).
+NODE_STATUS_FIELDS = ('unlocked', 'discovered', 'percent_complete')
+NODE_STATUS_UPSERT_BATCH_SIZE = 500
+
+_upsert_inserts = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+
+def get_node_pks(node_ids):
+    """Returns {node_id: pk} for the given external node ids (unknown ids are left out)."""
+    if not node_ids:
+        return {}
+    rows = db.session.query(Node.id, Node.pk).filter(Node.id.in_(list(node_ids))).all()
+    return dict(rows)
+
+
+def update_user_node_status_bulk(user_id, node_status_updates, node_pks=None):
     """
     Updates multiple node statuses (unlocked, discovered, percent) for a user.
     `node_status_updates` should be a dictionary like:
     { node_id: {'unlocked': True, 'discovered': True, 'percent_complete': 50}, ... }
+    Only the changed nodes should be passed (see core.nodes.compute_node_status_updates).
+    `node_pks` maps node ids to their integer keys (CompiledGraph.node_pks);
+    without it they are looked up with one extra query.
+
+    On PostgreSQL and SQLite the rows are written with one
+    INSERT ... ON CONFLICT (user_id, node_pk) DO UPDATE per batch; other
+    databases fall back to per-row ORM updates. Does not commit.
     """
+    if not node_status_updates:
+        return True
     try:
-        existing_statuses = UserNodeStatus.query.filter(
-            UserNodeStatus.user_id == user_id,
-            UserNodeStatus.node_id.in_(node_status_updates.keys())
-        ).all()
-        existing_map = {s.node_id: s for s in existing_statuses}
-
+        if node_pks is None:
+            node_pks = get_node_pks(node_status_updates.keys())
+        updates_by_pk = {}
         for node_id, updates in node_status_updates.items():
-            status = existing_map.get(node_id)
-            if not status:
-                
-                status = UserNodeStatus(user_id=user_id, node_id=node_id)
-                db.session.add(status)
+            node_pk = node_pks.get(node_id)
+            if node_pk is None:
+                print(f"Warning: skipping status update for unknown node {node_id}")
+                continue
+            updates_by_pk[node_pk] = updates
 
-            
-            if 'unlocked' in updates:
-                status.unlocked = updates['unlocked']
-            if 'discovered' in updates:
-                status.discovered = updates['discovered']
-            if 'percent_complete' in updates:
-                status.percent_complete = updates['percent_complete']
-            
+        insert = _upsert_inserts.get(db.session.get_bind().dialect.name)
+        if insert is None:
+            return _update_user_node_status_orm(user_id, updates_by_pk)
+
+        # Rows sharing the same set of fields go into the same statement
+        rows_by_fields = {}
+        for node_pk, updates in updates_by_pk.items():
+            fields = tuple(f for f in NODE_STATUS_FIELDS if f in updates)
+            row = {'user_id': user_id, 'node_pk': node_pk}
+            row.update((f, updates[f]) for f in fields)
+            rows_by_fields.setdefault(fields, []).append(row)
+
+        for fields, rows in rows_by_fields.items():
+            for start in range(0, len(rows), NODE_STATUS_UPSERT_BATCH_SIZE):
+                stmt = insert(UserNodeStatus).values(rows[start:start + NODE_STATUS_UPSERT_BATCH_SIZE])
+                if fields:
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=['user_id', 'node_pk'],
+                        set_={f: stmt.excluded[f] for f in fields}
+                    )
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=['user_id', 'node_pk'])
+                db.session.execute(stmt)
 
+        # The upsert bypassed the ORM: make already loaded statuses reload
+        for obj in list(db.session.identity_map.values()):
+            if (isinstance(obj, UserNodeStatus) and obj.__dict__.get('user_id') == user_id
+                    and obj.__dict__.get('node_pk') in updates_by_pk):
+                db.session.expire(obj)
         return True
     except Exception as e:
         print(f"Error bulk updating node status for user {user_id}: {e}")
         return False
 
+
+def _update_user_node_status_orm(user_id, updates_by_pk):
+    existing_statuses = UserNodeStatus.query.filter(
+        UserNodeStatus.user_id == user_id,
+        UserNodeStatus.node_pk.in_(updates_by_pk.keys())
+    ).all()
+    existing_map = {s.node_pk: s for s in existing_statuses}
+
+    for node_pk, updates in updates_by_pk.items():
+        status = existing_map.get(node_pk)
+        if not status:
+            
+            status = UserNodeStatus(user_id=user_id, node_pk=node_pk)
+            db.session.add(status)
+
+        
+        if 'unlocked' in updates:
+            status.unlocked = updates['unlocked']
+        if 'discovered' in updates:
+            status.discovered = updates['discovered']
+        if 'percent_complete' in updates:
+            status.percent_complete = updates['percent_complete']
+
+    return True
+
+
+def get_exercise_graph_id(exercise_id):
+    """Returns the id of the graph an exercise belongs to, or None."""
+    try:
+        return db.session.query(Node.graph_id).join(Exercise).filter(Exercise.id == exercise_id).scalar()
+    except Exception as e:
+        print(f"Error fetching graph of exercise {exercise_id}: {e}")
+        return None
+
+
+def get_derived_graph_version(user_id, graph_id):
+    """
+    Returns the graph version the user's stored node statuses for this graph
+    were derived from, or None if they were never derived.
+    """
+    try:
+        return db.session.query(UserGraphState.derived_graph_version).filter(
+            UserGraphState.user_id == user_id,
+            UserGraphState.graph_id == graph_id
+        ).scalar()
+    except Exception as e:
+        print(f"Error fetching derived state version for user {user_id}, graph {graph_id}: {e}")
+        return None
+
+
+def set_derived_graph_version(user_id, graph_id, graph_version):
+    """Records which graph version the user's node statuses were derived from. Does not commit."""
+    state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+    if not state:
+        state = UserGraphState(user_id=user_id, graph_id=graph_id)
+        db.session.add(state)
+    state.derived_graph_version = graph_version
+
+
+def lock_derived_graph_state(user_id, graph_id):
+    """
+    Locks the user's user_graph_state row for the graph (SELECT ... FOR UPDATE,
+    inserting the row first if there is none) and returns its
+    derived_graph_version (0 if the node statuses were never derived).
+
+    Mutations that derive node statuses from the persisted ones call this
+    before reading them, so concurrent updates of the same user and graph run
+    one after the other instead of both building on the same base. The lock
+    is held until the caller commits or rolls back. Returns None on error.
+    """
+    def locked_version():
+        return db.session.query(UserGraphState.derived_graph_version).filter(
+            UserGraphState.user_id == user_id,
+            UserGraphState.graph_id == graph_id
+        ).with_for_update().scalar()
+
+    try:
+        version = locked_version()
+        if version is None:
+            insert = _upsert_inserts.get(db.session.get_bind().dialect.name)
+            if insert is None:
+                db.session.add(UserGraphState(user_id=user_id, graph_id=graph_id, derived_graph_version=0))
+                db.session.flush()
+            else:
+                # A concurrent first mutation may insert it too; either way, lock the one row
+                db.session.execute(
+                    insert(UserGraphState)
+                    .values(user_id=user_id, graph_id=graph_id, derived_graph_version=0)
+                    .on_conflict_do_nothing(index_elements=['user_id', 'graph_id'])
+                )
+            version = locked_version()
+        return version
+    except Exception as e:
+        print(f"Error locking derived state for user {user_id}, graph {graph_id}: {e}")
+        return None
+
+
+def set_user_graph_xp(user_id, graph_id, xp, graph_version):
+    """
+    Sets the user's XP counter for the graph (see core.badges.graph_xp), as
+    computed for `graph_version`. Does not commit.
+    """
+    state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+    if not state:
+        state = UserGraphState(user_id=user_id, graph_id=graph_id)
+        db.session.add(state)
+    state.xp = xp
+    state.xp_graph_version = graph_version
+
+
+def add_user_xp(user_id, delta):
+    """
+    Adds `delta` to every XP counter of the user in one UPDATE, for XP that
+    counts in all graphs (CTF completions). Counters that were never computed
+    stay NULL; counters of an older graph version are ignored when read and
+    rewritten by the next mutation from their graph. Does not commit.
+    """
+    if not delta:
+        return
+    UserGraphState.query.filter(
+        UserGraphState.user_id == user_id,
+        UserGraphState.xp.isnot(None)
+    ).update({UserGraphState.xp: UserGraphState.xp + delta}, synchronize_session='fetch')
+
+
+def insert_user_badges(user_id, badge_ids):
+    """
+    Awards the badges to the user. On PostgreSQL and SQLite this is a single
+    INSERT ... ON CONFLICT (user_id, badge_id) DO NOTHING, so badges the user
+    already has are skipped by the database; other databases fall back to a
+    lookup plus ORM inserts. Returns the ids of the badges actually inserted.
+    Does not commit.
+    """
+    badge_ids = list(dict.fromkeys(badge_ids))
+    if not badge_ids:
+        return []
+    insert = _upsert_inserts.get(db.session.get_bind().dialect.name)
+    if insert is None:
+        existing = {
+            row[0] for row in db.session.query(UserBadge.badge_id).filter(
+                UserBadge.user_id == user_id, UserBadge.badge_id.in_(badge_ids)
+            )
+        }
+        inserted = [badge_id for badge_id in badge_ids if badge_id not in existing]
+        db.session.add_all(UserBadge(user_id=user_id, badge_id=badge_id) for badge_id in inserted)
+        return inserted
+    stmt = insert(UserBadge).values(
+        [{'user_id': user_id, 'badge_id': badge_id} for badge_id in badge_ids]
+    ).on_conflict_do_nothing(index_elements=['user_id', 'badge_id']).returning(UserBadge.badge_id)
+    return [row[0] for row in db.session.execute(stmt)]
+
+
+def store_completion_bitmap(user_id, graph_id, compiled_graph, completed_exercise_ids):
+    """
+    Stores the user's completions in the graph as a bitmap over the exercise
+    ordinals of `compiled_graph`, tagged with its version. `completed_exercise_ids`
+    may also be the bitset itself. Does not commit.
+    """
+    mask = compiled_graph.as_exercise_mask(completed_exercise_ids)
+    state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+    if not state:
+        state = UserGraphState(user_id=user_id, graph_id=graph_id)
+        db.session.add(state)
+    state.completion_bitmap = mask.to_bytes((len(compiled_graph.exercise_ids) + 7) // 8, 'little')
+    state.completion_bitmap_version = compiled_graph.version
+
+
+def get_stale_snapshot_graph_ids(user_id, progress_version):
+    """
+    Returns the ids of the graphs the user has a materialized /data snapshot
+    for that was not built from `progress_version` and the graph's current
+    version.
+    """
+    try:
+        rows = db.session.query(UserGraphState.graph_id).join(
+            Graph, Graph.id == UserGraphState.graph_id
+        ).filter(
+            UserGraphState.user_id == user_id,
+            UserGraphState.snapshot.isnot(None),
+            (UserGraphState.snapshot_progress_version != progress_version)
+            | (UserGraphState.snapshot_graph_version != Graph.version)
+        ).all()
+        return [row[0] for row in rows]
+    except Exception as e:
+        print(f"Error fetching stale snapshots for user {user_id}: {e}")
+        return []
+
+
+def get_state_snapshot(user_id, graph_id, graph_version, progress_version):
+    """
+    Returns the user's materialized /data response (JSON bytes) for a graph if
+    it was built from exactly these graph and progress versions, else None.
+    """
+    try:
+        return db.session.query(UserGraphState.snapshot).filter(
+            UserGraphState.user_id == user_id,
+            UserGraphState.graph_id == graph_id,
+            UserGraphState.snapshot_graph_version == graph_version,
+            UserGraphState.snapshot_progress_version == progress_version
+        ).scalar()
+    except Exception as e:
+        print(f"Error fetching state snapshot for user {user_id}, graph {graph_id}: {e}")
+        return None
+
+
+def store_state_snapshot(user_id, graph_id, graph_version, progress_version, snapshot):
+    """
+    Stores the user's materialized /data response for a graph. Does not commit.
+    Runs in a savepoint so a failure (e.g. a concurrent first insert) only
+    loses the snapshot, never the caller's transaction.
+    """
+    try:
+        with db.session.begin_nested():
+            state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+            if not state:
+                state = UserGraphState(user_id=user_id, graph_id=graph_id)
+                db.session.add(state)
+            state.snapshot = snapshot
+            state.snapshot_graph_version = graph_version
+            state.snapshot_progress_version = progress_version
+        return True
+    except Exception as e:
+        print(f"Error storing state snapshot for user {user_id}, graph {graph_id}: {e}")
+        return False
@@ -0,0 +1,271 @@
+import collections
+import json
+from array import array
+
+START_ID = "Start"
+
+# Node type codes stored in CompiledGraph.types
+TYPE_START = 0
+TYPE_MAIN = 1
+TYPE_SUB = 2
+TYPE_OTHER = 3
+
+_TYPE_CODES = {'start': TYPE_START, 'main': TYPE_MAIN, 'sub': TYPE_SUB}
+
+
+class CompiledGraph:
+    """
+    User-independent topology of one graph version, built once from the
+    static node/link dicts and shared read-only by every request.
+
+    Nodes are addressed by dense integer ordinals; ordinal 0 is always the
+    'Start' pseudo-node. Adjacency lists only contain nodes of this graph.
+    Links pointing at unknown nodes are still reflected in the
+    `has_parent_links` / `has_prereq_links` / `missing_prereq` flags, because
+    the unlock rules look at them.
+
+    Attributes:
+        ids (list): ordinal -> node id.
+        index (dict): node id -> ordinal.
+        node_pks (dict): node id -> integer database key, for nodes loaded
+            from the database (static node dicts carrying a 'pk').
+        types (bytearray): ordinal -> TYPE_* code.
+        static_nodes (list): ordinal -> static node dict (None for Start).
+        parents / children / prereqs (list of tuples): CHILD parents, CHILD
+            children and PREREQUISITE sources, per ordinal.
+        dependents (list of tuples): reverse dependency lists, i.e. the nodes
+            whose unlock rule reads a given node (its CHILD children, the nodes
+            it is a prerequisite of, and for Start the root nodes).
+        exercise_ids (list): exercise ordinal -> exercise id. Ordinals follow
+            the order of the static data, which core.data loads deterministically
+            (by node and exercise key), so they are stable for a graph version
+            and double as bit positions of completion bitsets.
+        exercise_index (dict): exercise id -> exercise ordinal.
+        exercise_node (array): exercise ordinal -> owning node ordinal.
+        exercise_optional (bytearray): exercise ordinal -> 1 if optional.
+        exercise_points (array): exercise ordinal -> points.
+        required_mask (int): bitset of the non-optional exercise ordinals.
+        exercise_categories (list of tuples): exercise ordinal -> category names.
+        ex_start / ex_end (array): per node, its [start, end) exercise range.
+        roots (tuple): ordinals with neither parent nor prerequisite links.
+        main_ordinals (tuple): ordinals of 'main' nodes.
+        main_offsets / main_members (array): CSR index of the sub nodes whose
+            percentages roll up into each main node; for main ordinal m they are
+            main_members[main_offsets[m]:main_offsets[m + 1]].
+        rollup_offsets / rollup_mains (array): the reverse CSR index, i.e. the
+            main nodes each sub node rolls up into.
+        start_node (dict): the 'Start' entry of the frontend node list.
+        output_links (list): the frontend link list, i.e. the distinct CHILD
+            links plus links from Start to the roots. Shared by every user.
+        output_links_json (bytes): output_links encoded as compact JSON with
+            sorted keys, for splicing into responses (see core.response).
+    """
+
+    def __init__(self, static_nodes_list, static_links_list, version=None):
+        self.version = version
+
+        self.ids = [START_ID]
+        self.static_nodes = [None]
+        for node in static_nodes_list:
+            if node['id'] == START_ID:
+                continue
+            self.ids.append(node['id'])
+            self.static_nodes.append(node)
+        self.index = {node_id: i for i, node_id in enumerate(self.ids)}
+        self.node_pks = {
+            node['id']: node['pk'] for node in self.static_nodes[1:] if node.get('pk') is not None
+        }
+        n = len(self.ids)
+
+        self.types = bytearray(n)
+        for i in range(1, n):
+            self.types[i] = _TYPE_CODES.get(self.static_nodes[i].get('type'), TYPE_OTHER)
+
+        # --- Adjacency ---
+        parents = [[] for _ in range(n)]
+        children = [[] for _ in range(n)]
+        prereqs = [[] for _ in range(n)]
+        self.has_parent_links = bytearray(n)
+        self.has_prereq_links = bytearray(n)
+        self.missing_prereq = bytearray(n)
+
+        index = self.index
+        seen_links = set()
+        for link in static_links_list:
+            source, target, link_type = link['source'], link['target'], link['type']
+            if (source, target, link_type) in seen_links:
+                continue
+            seen_links.add((source, target, link_type))
+            s, t = index.get(source), index.get(target)
+
+            if link_type == 'CHILD':
+                if t is not None:
+                    self.has_parent_links[t] = 1
+                if s is not None and t is not None:
+                    children[s].append(t)
+                    parents[t].append(s)
+            elif link_type == 'PREREQUISITE':
+                if t is not None:
+                    self.has_prereq_links[t] = 1
+                    if s is None:
+                        # An unknown prerequisite can never be unlocked
+                        self.missing_prereq[t] = 1
+                    else:
+                        prereqs[t].append(s)
+
+        self.parents = [tuple(p) for p in parents]
+        self.children = [tuple(c) for c in children]
+        self.prereqs = [tuple(p) for p in prereqs]
+
+        self.roots = tuple(
+            i for i in range(1, n)
+            if not self.has_parent_links[i] and not self.has_prereq_links[i]
+        )
+
+        dependents = [list(c) for c in children]
+        for i in range(n):
+            for p in prereqs[i]:
+                dependents[p].append(i)
+        dependents[0].extend(self.roots)
+        self.dependents = [tuple(dict.fromkeys(d)) for d in dependents]
+
+        # --- Exercises ---
+        self.exercise_ids = []
+        self.exercise_node = array('i')
+        self.exercise_optional = bytearray()
+        self.exercise_points = array('i')
+        self.exercise_categories = []
+        self.ex_start = array('i', [0]) * n
+        self.ex_end = array('i', [0]) * n
+        for i in range(1, n):
+            self.ex_start[i] = len(self.exercise_ids)
+            for ex in self.static_nodes[i].get('popup', {}).get('exercises', []):
+                self.exercise_ids.append(ex['id'])
+                self.exercise_node.append(i)
+                self.exercise_optional.append(1 if ex.get('optional') else 0)
+                self.exercise_points.append(ex.get('points') or 0)
+                self.exercise_categories.append(tuple(ex.get('categories', ())))
+            self.ex_end[i] = len(self.exercise_ids)
+        self.exercise_index = {ex_id: e for e, ex_id in enumerate(self.exercise_ids)}
+        self.required_mask = _pack_flags(not optional for optional in self.exercise_optional)
+
+        # --- User-independent output ---
+        self.start_node = {
+            'id': START_ID, 'title': START_ID, 'type': 'start',
+            'percent': 100, 'unlocked': True, 'discovered': True, # Start is always discovered
+            'popup': {'text': '', 'pdf_link': '', 'userNotes': '', 'exercises': []}
+        }
+        self.output_links = self._output_links(static_links_list)
+        self.output_links_json = encode_json(self.output_links)
+
+        self.main_ordinals = tuple(i for i in range(n) if self.types[i] == TYPE_MAIN)
+        self.main_offsets, self.main_members = self._main_membership()
+        self.rollup_offsets, self.rollup_mains = self._reverse_membership()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def exercise_mask(self, exercise_ids):
+        """Completion bitset (int) of the given exercise ids; ids of other graphs are ignored."""
+        bits = bytearray((len(self.exercise_ids) + 7) // 8)
+        index = self.exercise_index
+        for ex_id in exercise_ids:
+            e = index.get(ex_id)
+            if e is not None:
+                bits[e >> 3] |= 1 << (e & 7)
+        return int.from_bytes(bits, 'little')
+
+    def as_exercise_mask(self, completed):
+        """`completed` as a completion bitset: either already one (int) or a collection of exercise ids."""
+        if isinstance(completed, int):
+            return completed
+        return self.exercise_mask(completed)
+
+    def exercise_ids_in(self, mask):
+        """Set of the exercise ids whose bits are set in `mask`."""
+        exercise_ids = self.exercise_ids
+        return {exercise_ids[e] for e in bit_positions(mask)}
+
+    def exercise_points_in(self, mask):
+        """Total points of the exercises whose bits are set in `mask`."""
+        points = self.exercise_points
+        return sum(points[e] for e in bit_positions(mask))
+
+    def _output_links(self, static_links_list):
+        """CHILD links (including ones to nodes of other graphs) and Start -> root links, deduplicated."""
+        pairs = [(link['source'], link['target']) for link in static_links_list if link['type'] == 'CHILD']
+        pairs.extend((START_ID, self.ids[root]) for root in self.roots)
+        return [{'source': source, 'target': target} for source, target in dict.fromkeys(pairs)]
+
+    def _main_membership(self):
+        """
+        Collects, for every main node, the sub nodes reachable through CHILD
+        links without passing another main node (intermediate mains stop the
+        descent; sub and other node types are traversed). Each sub is listed
+        at most once per main, so diamonds in the graph are not double counted.
+        """
+        n = len(self.ids)
+        types, children = self.types, self.children
+        offsets = array('i', [0]) * (n + 1)
+        members = array('i')
+        for m in range(n):
+            offsets[m] = len(members)
+            if types[m] != TYPE_MAIN:
+                continue
+            queue = collections.deque(children[m])
+            visited = {m}
+            while queue:
+                d = queue.popleft()
+                if d in visited or types[d] == TYPE_MAIN:
+                    visited.add(d)
+                    continue
+                visited.add(d)
+                if types[d] == TYPE_SUB:
+                    members.append(d)
+                queue.extend(c for c in children[d] if c not in visited)
+        offsets[n] = len(members)
+        return offsets, members
+
+    def _reverse_membership(self):
+        n = len(self.ids)
+        mains_of = [[] for _ in range(n)]
+        for m in self.main_ordinals:
+            for s in self.main_members[self.main_offsets[m]:self.main_offsets[m + 1]]:
+                mains_of[s].append(m)
+        offsets = array('i', [0]) * (n + 1)
+        mains = array('i')
+        for i in range(n):
+            offsets[i] = len(mains)
+            mains.extend(mains_of[i])
+        offsets[n] = len(mains)
+        return offsets, mains
+
+
+def encode_json(value):
+    """Compact JSON with sorted keys, as Flask's JSON provider writes responses."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def bit_positions(mask):
+    """Yields the positions of the set bits of an int bitset, in increasing order."""
+    for byte_index, byte in enumerate(mask.to_bytes((mask.bit_length() + 7) // 8, 'little')):
+        while byte:
+            low = byte & -byte
+            yield (byte_index << 3) + low.bit_length() - 1
+            byte ^= low
+
+
+def _pack_flags(flags):
+    """Int bitset with bit i set for every truthy flags[i]."""
+    bits = bytearray()
+    for i, flag in enumerate(flags):
+        if i & 7 == 0:
+            bits.append(0)
+        if flag:
+            bits[-1] |= 1 << (i & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def compile_graph(static_nodes_list, static_links_list, version=None):
+    """Builds the CompiledGraph for a graph's static nodes and links."""
+    return CompiledGraph(static_nodes_list, static_links_list, version)
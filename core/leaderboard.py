@@ -0,0 +1,295 @@
+import collections
+import os
+import time
+from sqlalchemy import select, func, case, and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import (db, User, Node, Exercise, ExerciseCategory, exercise_category_map, UserExerciseCompletion,
+                    UserCtfCompletion, LeaderboardScore)
+from core.cache import VersionedLRUCache
+
+# Boards: every user's total, one per graph and one per exercise category.
+# Each keeps two counters per user: XP (points of completed required exercises,
+# plus CTF XP on the global board) and completions (completed exercises, plus
+# CTF completions on the global board).
+BOARD_GLOBAL = "global"
+_GRAPH_PREFIX = "graph:"
+_CATEGORY_PREFIX = "category:"
+
+# How long a process may serve a cached top-K list before reading the index again.
+LEADERBOARD_CACHE_SECONDS = int(os.environ.get("LEADERBOARD_CACHE_SECONDS", 30))
+LEADERBOARD_MAX_K = 100
+_top_cache = VersionedLRUCache(max_bytes=4 * 1024 * 1024)
+
+_upsert_inserts = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+
+def graph_board(graph_id):
+    return f"{_GRAPH_PREFIX}{graph_id}"
+
+
+def category_board(category):
+    return f"{_CATEGORY_PREFIX}{category}"
+
+
+def _exercise_xp(points, optional):
+    """Leaderboard XP of an exercise: its points if required, as for levels."""
+    return 0 if optional else (points or 0)
+
+
+def add_scores(user_id, deltas):
+    """
+    Adds {board: (xp, completions)} to the user's counters. On PostgreSQL and
+    SQLite this is a single INSERT ... ON CONFLICT (board, user_id) DO UPDATE
+    that adds to the stored values, so concurrent writers don't lose updates;
+    other databases fall back to ORM updates. Does not commit.
+    """
+    _add_user_scores({user_id: deltas})
+
+
+def _add_user_scores(user_deltas):
+    """add_scores for {user_id: {board: (xp, completions)}}, in one statement."""
+    user_deltas = {
+        user_id: {board: delta for board, delta in deltas.items() if any(delta)}
+        for user_id, deltas in user_deltas.items()
+    }
+    rows = [
+        {'board': board, 'user_id': user_id, 'xp': xp, 'completions': completions}
+        for user_id, deltas in user_deltas.items()
+        for board, (xp, completions) in deltas.items()
+    ]
+    if not rows:
+        return
+    insert = _upsert_inserts.get(db.session.get_bind().dialect.name)
+    if insert is None:
+        for user_id, deltas in user_deltas.items():
+            existing = {
+                score.board: score for score in LeaderboardScore.query.filter(
+                    LeaderboardScore.user_id == user_id, LeaderboardScore.board.in_(list(deltas))
+                )
+            }
+            for board, (xp, completions) in deltas.items():
+                score = existing.get(board)
+                if score is None:
+                    score = LeaderboardScore(board=board, user_id=user_id, xp=0, completions=0)
+                    db.session.add(score)
+                score.xp += xp
+                score.completions += completions
+        return
+    stmt = insert(LeaderboardScore).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['board', 'user_id'],
+        set_={
+            'xp': LeaderboardScore.xp + stmt.excluded.xp,
+            'completions': LeaderboardScore.completions + stmt.excluded.completions,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def record_exercise_completion(user_id, exercise_id, completed):
+    """
+    Updates the user's counters after a completion row of the exercise was
+    inserted (completed=True) or deleted (completed=False): the global board,
+    the exercise's graph and each of its categories. Only call it when a row
+    actually changed. Does not commit.
+    """
+    rows = db.session.execute(
+        select(Exercise.points, Exercise.optional, Node.graph_id, ExerciseCategory.name)
+        .join(Node, Node.pk == Exercise.node_pk)
+        .outerjoin(exercise_category_map, exercise_category_map.c.exercise_pk == Exercise.pk)
+        .outerjoin(ExerciseCategory, ExerciseCategory.category_id == exercise_category_map.c.category_id)
+        .where(Exercise.id == exercise_id)
+    ).all()
+    if not rows:
+        return
+    points, optional, graph_id, _ = rows[0]
+    sign = 1 if completed else -1
+    delta = (sign * _exercise_xp(points, optional), sign)
+    deltas = {BOARD_GLOBAL: delta, graph_board(graph_id): delta}
+    deltas.update((category_board(row[3]), delta) for row in rows if row[3] is not None)
+    add_scores(user_id, deltas)
+
+
+def record_ctf_completions(user_id, count_delta, xp_per_completion):
+    """Updates the user's global counters after their CTF completion count changed. Does not commit."""
+    add_scores(user_id, {BOARD_GLOBAL: (count_delta * xp_per_completion, count_delta)})
+
+
+def exercise_scores(exercise_pks):
+    """
+    What the completion rows of the given exercises add to the counters, as
+    the exercises are defined now: {user_id: {board: (xp, completions)}}.
+    Taken before and after the graph editor deletes, reprices or
+    recategorises exercises, see apply_score_changes.
+    """
+    scores = collections.defaultdict(dict)
+    _add_completion_scores(scores, UserExerciseCompletion.exercise_pk.in_(list(exercise_pks)))
+    return dict(scores)
+
+
+def apply_score_changes(before, after):
+    """
+    Moves the counters from `before` to `after` (exercise_scores results for
+    the same exercises), in one upsert for all users. Does not commit.
+    """
+    user_deltas = collections.defaultdict(dict)
+    for sign, scores in ((-1, before), (1, after)):
+        for user_id, boards in scores.items():
+            for board, (xp, completions) in boards.items():
+                _add_score(user_deltas, user_id, board, sign * xp, sign * completions)
+    _add_user_scores(user_deltas)
+
+
+def _load_top(board, k):
+    rows = db.session.execute(
+        select(LeaderboardScore.user_id, User.username, LeaderboardScore.xp, LeaderboardScore.completions)
+        .join(User, User.id == LeaderboardScore.user_id)
+        .where(LeaderboardScore.board == board, LeaderboardScore.xp > 0)
+        .order_by(LeaderboardScore.xp.desc(), LeaderboardScore.user_id)
+        .limit(k)
+    ).all()
+    top = [
+        {'rank': rank, 'username': username, 'xp': xp, 'completions': completions}
+        for rank, (_, username, xp, completions) in enumerate(rows, start=1)
+    ]
+    return top, 128 * (len(top) + 1)
+
+
+def get_top(board, k=10):
+    """
+    The board's top `k` users (at most LEADERBOARD_MAX_K) as a list of
+    {rank, username, xp, completions}, ordered by XP, then user id.
+    Users without XP are not listed. Lists are cached per process for up to
+    LEADERBOARD_CACHE_SECONDS, so they may lag recent completions by as much.
+    """
+    k = max(1, min(k, LEADERBOARD_MAX_K))
+    try:
+        if LEADERBOARD_CACHE_SECONDS <= 0:
+            return _load_top(board, k)[0]
+        # Entries expire by moving to the next time bucket
+        bucket = int(time.monotonic() // LEADERBOARD_CACHE_SECONDS)
+        return _top_cache.get_or_load((board, k), bucket, lambda: _load_top(board, k))
+    except Exception as e:
+        print(f"Error fetching leaderboard {board}: {e}")
+        return []
+
+
+def get_rank(board, user_id):
+    """
+    The user's {rank, xp, completions} on the board, read from the index
+    (never cached), or None if the user has no XP there (get_top does not
+    list them either). Rank 1 is the top; ties in XP are broken by user id,
+    as in get_top.
+    """
+    try:
+        mine = db.session.execute(
+            select(LeaderboardScore.xp, LeaderboardScore.completions)
+            .where(LeaderboardScore.board == board, LeaderboardScore.user_id == user_id)
+        ).first()
+        if mine is None or mine.xp <= 0:
+            return None
+        xp, completions = mine
+        ahead = db.session.scalar(
+            select(func.count()).select_from(LeaderboardScore).where(
+                LeaderboardScore.board == board,
+                or_(LeaderboardScore.xp > xp,
+                    and_(LeaderboardScore.xp == xp, LeaderboardScore.user_id < user_id))
+            )
+        )
+        return {'rank': ahead + 1, 'xp': xp, 'completions': completions}
+    except Exception as e:
+        print(f"Error fetching rank of user {user_id} on leaderboard {board}: {e}")
+        return None
+
+
+def invalidate_leaderboard_cache():
+    """Drops this process's cached top-K lists, e.g. after a rebuild."""
+    _top_cache.invalidate()
+
+
+def compute_user_scores(user_ids, xp_per_ctf_completion):
+    """
+    Recomputes the counters of the given users from the completion rows:
+    {user_id: {board: (xp, completions)}}. Three grouped queries, whatever
+    the number of users.
+    """
+    user_ids = list(user_ids)
+    scores = {user_id: {} for user_id in user_ids}
+    _add_completion_scores(scores, UserExerciseCompletion.user_id.in_(user_ids))
+    ctfs = (
+        select(UserCtfCompletion.user_id, func.sum(UserCtfCompletion.completed_count))
+        .where(UserCtfCompletion.user_id.in_(user_ids))
+        .group_by(UserCtfCompletion.user_id)
+    )
+    for user_id, count in db.session.execute(ctfs):
+        _add_score(scores, user_id, BOARD_GLOBAL, (count or 0) * xp_per_ctf_completion, count)
+    return scores
+
+
+def _add_score(scores, user_id, board, xp, completions):
+    old_xp, old_completions = scores[user_id].get(board, (0, 0))
+    scores[user_id][board] = (old_xp + (xp or 0), old_completions + (completions or 0))
+
+
+def _add_completion_scores(scores, condition):
+    """Adds the counters of the exercise completion rows matching `condition` to `scores`. Two grouped queries."""
+    exercise_xp = case((Exercise.optional.is_(True), 0), else_=func.coalesce(Exercise.points, 0))
+    completions = (
+        select(UserExerciseCompletion.user_id, Node.graph_id, func.sum(exercise_xp), func.count())
+        .join(Exercise, Exercise.pk == UserExerciseCompletion.exercise_pk)
+        .join(Node, Node.pk == Exercise.node_pk)
+        .where(condition)
+        .group_by(UserExerciseCompletion.user_id, Node.graph_id)
+    )
+    for user_id, graph_id, xp, count in db.session.execute(completions):
+        _add_score(scores, user_id, graph_board(graph_id), xp, count)
+        _add_score(scores, user_id, BOARD_GLOBAL, xp, count)
+
+    categories = (
+        select(UserExerciseCompletion.user_id, ExerciseCategory.name, func.sum(exercise_xp), func.count())
+        .join(Exercise, Exercise.pk == UserExerciseCompletion.exercise_pk)
+        .join(exercise_category_map, exercise_category_map.c.exercise_pk == Exercise.pk)
+        .join(ExerciseCategory, ExerciseCategory.category_id == exercise_category_map.c.category_id)
+        .where(condition)
+        .group_by(UserExerciseCompletion.user_id, ExerciseCategory.name)
+    )
+    for user_id, category, xp, count in db.session.execute(categories):
+        _add_score(scores, user_id, category_board(category), xp, count)
+
+
+def rebuild_scores(xp_per_ctf_completion, batch_size=500):
+    """
+    Rebuilds every user's counters from the completion rows, `batch_size`
+    users per transaction (their old counters are replaced in the same
+    commit). For the initial fill and for repairing drift; the write paths
+    keep the counters current otherwise. Returns the number of users processed.
+    """
+    processed = 0
+    last_user_id = None
+    while True:
+        query = select(User.id).order_by(User.id).limit(batch_size)
+        if last_user_id is not None:
+            query = query.where(User.id > last_user_id)
+        user_ids = db.session.scalars(query).all()
+        if not user_ids:
+            break
+        try:
+            scores = compute_user_scores(user_ids, xp_per_ctf_completion)
+            LeaderboardScore.query.filter(LeaderboardScore.user_id.in_(user_ids)).delete(
+                synchronize_session=False
+            )
+            db.session.add_all(
+                LeaderboardScore(board=board, user_id=user_id, xp=xp, completions=completions)
+                for user_id, boards in scores.items()
+                for board, (xp, completions) in boards.items()
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        processed += len(user_ids)
+        last_user_id = user_ids[-1]
+        print(f"Rebuilt leaderboard counters of {processed} users")
+    invalidate_leaderboard_cache()
+    return processed
@@ -1,18 +1,36 @@
 # tmp/core/nodes.py
+import os
 import collections
+from itertools import compress
 from models import db, Node, NodeRelationship, UserNodeStatus, UserExerciseCompletion, Exercise
 from core import data as core_data
-from core.utils import build_child_map
+from core.cache import VersionedLRUCache
+from core.graph import compile_graph, bit_positions, TYPE_START, TYPE_MAIN, TYPE_SUB
 
 UNLOCK_PERCENT = 50
 
+# Cumulative per-process counters for monitoring the state engine
+engine_stats = collections.Counter()
 
+# Approximate memory budget of the progress memo: the user-independent part of
+# compute_user_graph_state's result, shared by every user with the same completed
+# exercises in the same graph version. 0 disables it.
+STATE_MEMO_MAX_BYTES = int(os.environ.get("STATE_MEMO_MAX_BYTES", 32 * 1024 * 1024))
+_state_memo = VersionedLRUCache(STATE_MEMO_MAX_BYTES)
 
-def compute_user_graph_state(user_id, graph_id, static_nodes_list, static_links_list, user_node_status_map, completed_exercise_ids):
+
+
+def compute_user_graph_state(user_id, graph_id, static_nodes_list, static_links_list, user_node_status_map, completed_exercise_ids, compiled_graph=None):
     """
     Computes the complete graph state for a specific user and graph,
     using pre-fetched static data and user progress data.
-    Updates user node status (percent, unlocked, discovered) in the database based on new logic.
+    This is a pure read: nothing is written to the database. The derived node
+    statuses are persisted by the mutation endpoints (see compute_node_status_updates).
+
+    Everything but the user's notes only depends on the completed exercises, so
+    with a versioned compiled graph that part is memoized per (graph, completion
+    bitset) and shared between users; only the node dicts carrying notes are
+    copied. Returned node and link dicts must be treated as read-only.
 
     Args:
         user_id (int): The ID of the user.
@@ -20,7 +38,12 @@ def compute_user_graph_state(user_id, graph_id, static_nodes_list, static_links_
         static_nodes_list (list): List of node dictionaries (including exercises) from get_static_graph_data.
         static_links_list (list): List of link dictionaries from get_static_graph_data.
         user_node_status_map (dict): Dict {node_id: UserNodeStatus obj} for the user from get_user_progress.
-        completed_exercise_ids (set): Set of completed exercise IDs for the user from get_user_progress.
+            Only used for the user's notes; the derived fields are recomputed.
+        completed_exercise_ids (set or int): Set of completed exercise IDs for the user from
+            get_user_progress, or the equivalent completion bitset over the graph's exercise
+            ordinals (see CompiledGraph.exercise_mask).
+        compiled_graph (CompiledGraph, optional): Topology of the graph version, normally the
+            cached one from core_data.get_cached_static_graph. Compiled on the fly if omitted.
 
     Returns:
         tuple: (final_nodes_list, final_links_list, unlocked_map, discovered_ids)
@@ -34,237 +57,28 @@ def compute_user_graph_state(user_id, graph_id, static_nodes_list, static_links_
             print(f"Warning: No static nodes provided for graph_id {graph_id}")
             return [], [], {}, set()
 
-        # --- Pre-computation ---
-        static_node_map = {node['id']: node for node in static_nodes_list}
-        static_node_map["Start"] = {"id": "Start", "type": "start", "title": "Start"} # Add Start node
-
-        # Build relationship maps
-        child_map = collections.defaultdict(list)
-        prereq_map = collections.defaultdict(list)
-        node_parents = collections.defaultdict(list) # Stores immediate parents based on CHILD links
-        for link in static_links_list:
-            if link['type'] == 'CHILD':
-                child_map[link['source']].append(link['target'])
-                node_parents[link['target']].append(link['source'])
-            elif link['type'] == 'PREREQUISITE':
-                prereq_map[link['target']].append(link['source'])
-
-        # --- Calculate Node Percentages ---
-        node_percentages = {}
-        # Calculate percentages for 'sub' nodes based on exercises
-        for node_id, node_data in static_node_map.items():
-            if node_data.get('type') == 'sub':
-                exercises = node_data.get('popup', {}).get('exercises', [])
-                total_exercises = len(exercises)
-                if total_exercises == 0:
-                    node_percentages[node_id] = 0 # Or 100 if empty sub node means complete? Assuming 0.
-                else:
-                    completed_count = sum(1 for ex in exercises if ex['id'] in completed_exercise_ids)
-                    node_percentages[node_id] = round((completed_count / total_exercises) * 100)
-
-        # Calculate percentages for 'main' nodes based on descendant 'sub' nodes
-        for node_id, node_data in static_node_map.items():
-             if node_data.get('type') == 'main':
-                total_percent_sum = 0
-                sub_node_count = 0
-                # Use BFS/DFS to find all descendant sub-nodes, avoiding cycles
-                queue = collections.deque(child_map.get(node_id, []))
-                visited_in_calc = {node_id} # Prevent infinite loops in cyclic graphs
-                while queue:
-                    descendant_id = queue.popleft()
-                    if descendant_id in visited_in_calc: continue
-                    visited_in_calc.add(descendant_id)
-
-                    descendant_node_data = static_node_map.get(descendant_id)
-                    if not descendant_node_data: continue
-
-                    if descendant_node_data.get('type') == 'sub':
-                        # Found a sub-node descendant
-                        total_percent_sum += node_percentages.get(descendant_id, 0)
-                        sub_node_count += 1
-                        # Continue traversal from sub-nodes as well (Rule 3 dependency)
-                        for child_id in child_map.get(descendant_id, []):
-                           if child_id not in visited_in_calc: queue.append(child_id)
-                    elif descendant_node_data.get('type') != 'main': # Traverse through other intermediate nodes if needed
-                         for child_id in child_map.get(descendant_id, []):
-                            if child_id not in visited_in_calc: queue.append(child_id)
-                # Calculate average percentage from descendant sub-nodes
-                node_percentages[node_id] = round(total_percent_sum / sub_node_count) if sub_node_count else 0
-
-
-        # --- Calculate Unlocked Status (Iterative based on new rules) ---
-        # This logic remains the same as the previous version which user confirmed was OK.
-        unlocked_map = {"Start": True} # Start node is always unlocked
-        changed_in_pass = True
-        max_passes = len(static_node_map) + 2 # Allow extra passes for complex dependencies
-        current_pass = 0
-
-        while changed_in_pass and current_pass < max_passes:
-            changed_in_pass = False
-            current_pass += 1
-
-            for node_id, node_data in static_node_map.items():
-                if node_id == "Start": continue
-                if unlocked_map.get(node_id, False): continue # Skip if already unlocked
-
-                current_status = False
-                node_type = node_data.get('type')
-                parents = node_parents.get(node_id, [])
-                prerequisites = prereq_map.get(node_id, [])
-
-                prereqs_unlocked = True
-                if prerequisites:
-                    for prereq_id in prerequisites:
-                        if not unlocked_map.get(prereq_id, False):
-                            prereqs_unlocked = False
-                            break
-                elif not parents and not prerequisites:
-                     prereqs_unlocked = unlocked_map.get("Start", False)
-
-                if not prereqs_unlocked: continue
-
-                potential_unlock_status = False
-
-                if node_type == 'main':
-                    if not prerequisites:
-                         potential_unlock_status = True
-                    else:
-                         all_prereqs_sufficient_percent = True
-                         for prereq_id in prerequisites:
-                             prereq_percent = node_percentages.get(prereq_id, 0)
-                             if prereq_percent < UNLOCK_PERCENT:
-                                 all_prereqs_sufficient_percent = False
-                                 break
-                         potential_unlock_status = all_prereqs_sufficient_percent
-
-                elif node_type == 'sub':
-                    if not parents:
-                         if not prerequisites:
-                             potential_unlock_status = unlocked_map.get("Start", False)
-                    else:
-                        for parent_id in parents:
-                            parent_node_data = static_node_map.get(parent_id)
-                            if not parent_node_data: continue
-
-                            parent_unlocked = unlocked_map.get(parent_id, False)
-                            parent_type = parent_node_data.get('type')
-
-                            if parent_type == 'main' and parent_unlocked:
-                                potential_unlock_status = True; break
-                            elif parent_type == 'sub':
-                                parent_percent = node_percentages.get(parent_id, 0)
-                                if parent_unlocked and parent_percent >= UNLOCK_PERCENT:
-                                    potential_unlock_status = True; break
-                            elif parent_type == 'start' and parent_unlocked:
-                                potential_unlock_status = True; break
-
-                if potential_unlock_status and not unlocked_map.get(node_id, False):
-                    unlocked_map[node_id] = True
-                    changed_in_pass = True
-            # End of loop through nodes
-
-        if current_pass == max_passes and changed_in_pass:
-            print(f"Warning: Unlock status did not stabilize within {max_passes} passes for user {user_id}, graph {graph_id}.")
-
-
-        # --- Calculate Discovered Status (Fog of War - REVISED) ---
-        # Use the newly computed unlock_map
-        discovered_ids = compute_discovered_nodes(unlocked_map, static_links_list, static_node_map)
-
-
-        # --- Update Database ---
-        # Check if any status needs updating in the DB
-        node_status_updates = {}
-        for node_id, node_data in static_node_map.items():
-            if node_id == "Start": continue # Don't store status for pseudo-node 'Start'
-
-            current_db_status = user_node_status_map.get(node_id) # Get from initially fetched map
-            new_percent = node_percentages.get(node_id, 0)
-            new_unlocked = unlocked_map.get(node_id, False)
-            new_discovered = node_id in discovered_ids # Use the result from revised function
-
-            needs_update = False
-            if not current_db_status:
-                 if new_percent > 0 or new_unlocked or new_discovered:
-                     needs_update = True
-            elif (current_db_status.percent_complete != new_percent or
-                  current_db_status.unlocked != new_unlocked or
-                  current_db_status.discovered != new_discovered): # Check discovered status too
-                  needs_update = True
-
-            if needs_update:
-                 node_status_updates[node_id] = {
-                    'percent_complete': new_percent,
-                    'unlocked': new_unlocked,
-                    'discovered': new_discovered
-                 }
-
-        # Perform bulk update if changes are needed
-        if node_status_updates:
-             print(f"Updating node statuses in DB for user {user_id}: {len(node_status_updates)} nodes")
-             update_success = core_data.update_user_node_status_bulk(user_id, node_status_updates)
-             if not update_success:
-                 print(f"ERROR: Failed to update node statuses for user {user_id}")
-             # OPTIONAL: Re-fetch user_node_status_map after update for consistency in returned data
-             # user_node_status_map, _ = core_data.get_user_progress(user_id, graph_id)
-
-
-        # --- Format Final Output ---
-        final_nodes = []
-        final_links = []
-
-        # Add 'Start' node to the list if it's used in links
-        if "Start" in static_node_map:
-            final_nodes.append({
-                'id': 'Start', 'title': 'Start', 'type': 'start',
-                'percent': 100, 'unlocked': True, 'discovered': True, # Start is always discovered
-                'popup': {'text': '', 'pdf_link': '', 'userNotes': '', 'exercises': []}
-            })
-
-
-        for node_data in static_nodes_list: # Iterate original list, excluding Start initially
-            node_id = node_data['id']
-            user_status = user_node_status_map.get(node_id)
-
-            percent = node_percentages.get(node_id, 0)
-            is_unlocked = unlocked_map.get(node_id, False)
-            is_discovered = node_id in discovered_ids # Use result from revised function
-            notes = user_status.user_notes if user_status else ''
-
-
-            final_node = {
-                'id': node_id, 'title': node_data['title'], 'type': node_data.get('type','sub'),
-                'percent': percent,
-                'unlocked': is_unlocked,
-                'discovered': is_discovered, # Reflect the new discovered status
-                'popup': {
-                    'text': node_data.get('popup',{}).get('text',''),
-                    'pdf_link': node_data.get('popup',{}).get('pdf_link',''),
-                    'userNotes': notes,
-                    'exercises': [
-                        {**ex, 'completed': ex['id'] in completed_exercise_ids}
-                        for ex in node_data.get('popup', {}).get('exercises', [])
-                    ]
-                }
-            }
-            final_nodes.append(final_node)
-
-        # Format links (only CHILD relationships for the graph visualization)
-        for link in static_links_list:
-             if link['type'] == 'CHILD':
-                 # Optional: Only include links where BOTH source and target are discovered?
-                 # if link['source'] in discovered_ids and link['target'] in discovered_ids:
-                 final_links.append({'source': link['source'], 'target': link['target']})
-
-        # Add links from Start to root nodes
-        root_nodes = {n['id'] for n in static_nodes_list if not node_parents.get(n['id']) and not prereq_map.get(n['id'])}
-        for root_id in root_nodes:
-            # Optional: Only link Start to discovered root nodes?
-            # if root_id in discovered_ids:
-            final_links.append({'source': 'Start', 'target': root_id})
-
-        # Remove duplicate links
-        final_links = [dict(t) for t in {tuple(sorted(d.items())) for d in final_links}]
+        # --- Pre-computation (user independent, normally cached per graph version) ---
+        graph = compiled_graph or compile_graph(static_nodes_list, static_links_list)
+        completed_mask = graph.as_exercise_mask(completed_exercise_ids)
+
+        if graph.version is None or STATE_MEMO_MAX_BYTES <= 0:
+            shared_state = _compute_shared_state(graph, completed_mask)
+        else:
+            shared_state = _get_memoized_shared_state(graph_id, graph, completed_mask)
+        shared_nodes, shared_unlocked, shared_discovered = shared_state
+
+        # --- Overlay the per-user fields (node ordinals are positions in the node list) ---
+        final_nodes = list(shared_nodes)
+        index = graph.index
+        for node_id, user_status in user_node_status_map.items():
+            i = index.get(node_id)
+            if i and user_status.user_notes != '':
+                node = final_nodes[i]
+                final_nodes[i] = {**node, 'popup': {**node['popup'], 'userNotes': user_status.user_notes}}
+        # Links only depend on the graph: precompiled once per version, shared as is
+        final_links = graph.output_links
+        unlocked_map = dict(shared_unlocked)
+        discovered_ids = set(shared_discovered)
 
         # for testing...
         if user_id == 1:
@@ -277,86 +91,434 @@ def compute_user_graph_state(user_id, graph_id, static_nodes_list, static_links_
         print(f"FATAL Error computing user graph state for user {user_id}, graph {graph_id}: {e}")
         import traceback
         traceback.print_exc()
-        db.session.rollback()
         return [], [], {"Start": True}, {"Start"}
 
 
 
-def compute_abilities(user_id, completed_exercise_ids, user_ctf_completions, exercises_with_cats):
-    """Computes ability scores based *only* on provided arguments."""
-    # This function remains unchanged.
+def _compute_shared_state(graph, completed_mask):
+    """
+    The user-independent part of compute_user_graph_state: the formatted nodes
+    (with empty notes), unlocked map and discovered ids for a completion
+    bitset. The result may be shared between users and is never mutated.
+    """
+    node_ids = graph.ids
+    node_count = len(node_ids)
+
+    # --- Calculate Percentages, Unlocked and Discovered Status ---
+    node_percentages, unlocked, discovered = _compute_derived_state(graph, completed_mask)
+    unlocked_map = dict.fromkeys(compress(node_ids, unlocked), True)
+    discovered_ids = frozenset(compress(node_ids, discovered))
+
+    # --- Format Final Output ---
+    # 'Start' node first (always ordinal 0 of the compiled graph)
+    final_nodes = [graph.start_node]
+
+    for i in range(1, node_count): # Static nodes, in their original order
+        completed_bits = completed_mask >> graph.ex_start[i] # Bit k: k-th exercise of the node
+        final_nodes.append(format_node(
+            graph, i, node_percentages[i], bool(unlocked[i]), bool(discovered[i]), '',
+            [bool(completed_bits >> k & 1) for k in range(graph.ex_end[i] - graph.ex_start[i])]))
+
+    return final_nodes, unlocked_map, discovered_ids
+
+
+def format_node(graph, i, percent, is_unlocked, is_discovered, notes, completed_flags):
+    """
+    The frontend dict of static node ordinal `i`, given its per-user values;
+    `completed_flags` holds the completed flag of each of the node's exercises.
+    """
+    node_data = graph.static_nodes[i]
+    popup = node_data.get('popup', {})
+    return {
+        'id': graph.ids[i], 'title': node_data['title'], 'type': node_data.get('type','sub'),
+        'percent': percent,
+        'unlocked': is_unlocked,
+        'discovered': is_discovered,
+        'popup': {
+            'text': popup.get('text',''),
+            'pdf_link': popup.get('pdf_link',''),
+            'userNotes': notes,
+            'exercises': [
+                {**ex, 'completed': completed}
+                for ex, completed in zip(popup.get('exercises', []), completed_flags)
+            ]
+        }
+    }
+
+
+def _get_memoized_shared_state(graph_id, graph, completed_mask):
+    """
+    _compute_shared_state through the progress memo. The completion bitset is
+    the canonical form of the user's completed exercises in the graph, so it is
+    used as the key itself; the graph version tags the entry.
+    """
+    def load():
+        return (graph, _compute_shared_state(graph, completed_mask)), \
+            _estimate_shared_state_size(graph)
+
+    key = (graph_id, completed_mask)
+    memo_graph, shared_state = _state_memo.get_or_load(key, graph.version, load)
+    if memo_graph is not graph:
+        # Computed for another compilation of the same version (e.g. after the static
+        # cache was dropped): its ordinals may not match this one's
+        (memo_graph, shared_state), cost = load()
+        _state_memo.put(key, graph.version, (memo_graph, shared_state), cost)
+    return shared_state
+
+
+def _estimate_shared_state_size(graph):
+    """Rough in-memory size of a memoized shared state, for the memo's byte budget."""
+    return 600 * len(graph) + 300 * len(graph.exercise_ids)
+
+
+def get_state_memo_stats():
+    """Returns the progress memo counters, with its hit rate."""
+    stats = _state_memo.stats()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def invalidate_state_memo():
+    """Drops every memoized shared state."""
+    _state_memo.invalidate()
+
+
+
+def _compute_derived_state(graph, completed_mask):
+    """
+    Runs the full engine for one user: percentages, unlocks and discovery.
+    Returns (node_percentages, unlocked, discovered), the flags being
+    bytearrays indexed by node ordinal.
+    """
+    node_percentages = _compute_node_percentages(graph, completed_mask)
+
+    unlocked, evaluations = propagate_unlocks(graph, node_percentages)
+    engine_stats['unlock_runs'] += 1
+    engine_stats['unlock_evaluations'] += evaluations
+
+    # Fog of war: derived from the unlocked flags
+    discovered = _discovered_flags(unlocked)
+    return node_percentages, unlocked, discovered
+
+
+def compute_node_status_updates(compiled_graph, user_node_status_map, completed_exercise_ids):
+    """
+    Recomputes the derived node fields (percent, unlocked, discovered) from
+    scratch and diffs them against the user's stored statuses.
+
+    Args:
+        compiled_graph (CompiledGraph): Topology of the graph version.
+        user_node_status_map (dict): {node_id: UserNodeStatus} as currently stored.
+        completed_exercise_ids (set or int): The user's completed exercise IDs, or their
+            completion bitset.
+
+    Returns:
+        dict: {node_id: {'percent_complete', 'unlocked', 'discovered'}} for the nodes
+              whose stored status is out of date, as expected by update_user_node_status_bulk.
+    """
+    graph = compiled_graph
+    node_ids = graph.ids
+    node_percentages, unlocked, discovered = _compute_derived_state(
+        graph, graph.as_exercise_mask(completed_exercise_ids))
+
+    node_status_updates = {}
+    for i in range(1, len(graph)): # Ordinal 0 is the pseudo-node 'Start', not stored
+        node_id = node_ids[i]
+
+        current_db_status = user_node_status_map.get(node_id)
+        new_percent = node_percentages[i]
+        new_unlocked = bool(unlocked[i])
+        new_discovered = bool(discovered[i])
+
+        needs_update = False
+        if not current_db_status:
+             if new_percent > 0 or new_unlocked or new_discovered:
+                 needs_update = True
+        elif (current_db_status.percent_complete != new_percent or
+              current_db_status.unlocked != new_unlocked or
+              current_db_status.discovered != new_discovered):
+              needs_update = True
+
+        if needs_update:
+             node_status_updates[node_id] = {
+                'percent_complete': new_percent,
+                'unlocked': new_unlocked,
+                'discovered': new_discovered
+             }
+    return node_status_updates
+
+
+
+def compute_graph_abilities(user_id, compiled_graph, completed_exercise_ids, user_ctf_completions):
+    """
+    Ability scores: completed required exercises per category, read from the
+    compiled graph, plus the total number of CTF completions.
+    `completed_exercise_ids` may also be a completion bitset.
+    """
     try:
+        graph = compiled_graph
         abilities = collections.defaultdict(int)
-        for ex in exercises_with_cats:
-            if ex.id in completed_exercise_ids and not ex.optional:
-                for cat in ex.categories:
-                    abilities[cat.name] += 1
+        exercise_categories = graph.exercise_categories
+        completed_required = graph.as_exercise_mask(completed_exercise_ids) & graph.required_mask
+        for e in bit_positions(completed_required):
+            for category in exercise_categories[e]:
+                abilities[category] += 1
         abilities["CTFs"] = sum(user_ctf_completions.values())
         return dict(abilities)
     except Exception as e:
-        print(f"Error computing abilities for user {user_id} (using passed data): {e}")
+        print(f"Error computing abilities for user {user_id} (using compiled graph): {e}")
         return {"CTFs": 0}
 
 
 
-def compute_discovered_nodes(unlocked_map, links_list_of_dicts, static_node_map):
+def _sub_percent(graph, i, completed_mask):
+    start, end = graph.ex_start[i], graph.ex_end[i]
+    total_exercises = end - start
+    if total_exercises == 0:
+        return 0 # Or 100 if empty sub node means complete? Assuming 0.
+    # The node's exercises are a contiguous run of bits: popcount of that window
+    completed_count = ((completed_mask >> start) & ((1 << total_exercises) - 1)).bit_count()
+    return round((completed_count / total_exercises) * 100)
+
+
+def _main_percent(graph, m, node_percentages):
+    start, end = graph.main_offsets[m], graph.main_offsets[m + 1]
+    if end == start:
+        return 0
+    return round(sum(node_percentages[s] for s in graph.main_members[start:end]) / (end - start))
+
+
+def _compute_node_percentages(graph, completed_mask):
+    """Returns a list of completion percentages indexed by node ordinal."""
+    types = graph.types
+    node_percentages = [0] * len(graph)
+
+    # Calculate percentages for 'sub' nodes based on exercises
+    for i in range(1, len(graph)):
+        if types[i] == TYPE_SUB:
+            node_percentages[i] = _sub_percent(graph, i, completed_mask)
+
+    # Calculate percentages for 'main' nodes as the average of their rolled-up
+    # sub nodes (membership is precomputed per graph version, see CompiledGraph)
+    for m in graph.main_ordinals:
+        node_percentages[m] = _main_percent(graph, m, node_percentages)
+
+    return node_percentages
+
+
+def _can_unlock(graph, i, unlocked, node_percentages):
+    """Applies the unlock rules to node ordinal `i` given the current unlocked flags."""
+    prerequisites = graph.prereqs[i]
+    has_prerequisites = graph.has_prereq_links[i]
+    has_parents = graph.has_parent_links[i]
+
+    if has_prerequisites:
+        if graph.missing_prereq[i]:
+            return False
+        for p in prerequisites:
+            if not unlocked[p]:
+                return False
+    elif not has_parents and not unlocked[0]:
+        return False
+
+    node_type = graph.types[i]
+    if node_type == TYPE_MAIN:
+        if not has_prerequisites:
+            return True
+        return all(node_percentages[p] >= UNLOCK_PERCENT for p in prerequisites)
+
+    if node_type == TYPE_SUB:
+        if not has_parents:
+            return not has_prerequisites and bool(unlocked[0])
+        for p in graph.parents[i]:
+            if not unlocked[p]:
+                continue
+            parent_type = graph.types[p]
+            if parent_type == TYPE_MAIN or parent_type == TYPE_START:
+                return True
+            if parent_type == TYPE_SUB and node_percentages[p] >= UNLOCK_PERCENT:
+                return True
+
+    return False
+
+
+def propagate_unlocks(graph, node_percentages, unlocked=None, seeds=None, newly_unlocked=None):
+    """
+    Computes unlocked flags with a worklist: a node is (re-)evaluated only
+    when something its unlock rule reads has just been unlocked, found via
+    the graph's reverse dependency lists. Percentages are fixed inputs.
+
+    Args:
+        graph (CompiledGraph): Topology of the graph version.
+        node_percentages (list): Percent per node ordinal.
+        unlocked (bytearray, optional): Known-unlocked flags to start from;
+            they are never revoked. Defaults to "only Start unlocked".
+        seeds (iterable, optional): Ordinals to evaluate first. Defaults to all nodes.
+        newly_unlocked (list, optional): If given, every ordinal unlocked by this
+            call is appended to it.
+
+    Returns:
+        tuple: (unlocked bytearray indexed by ordinal, number of rule evaluations run)
+    """
+    node_count = len(graph)
+    unlocked = bytearray(node_count) if unlocked is None else bytearray(unlocked)
+    unlocked[0] = 1 # Start node is always unlocked
+
+    if seeds is None:
+        seeds = range(1, node_count)
+    queue = collections.deque()
+    queued = bytearray(node_count)
+    for i in seeds:
+        if not unlocked[i] and not queued[i]:
+            queued[i] = 1
+            queue.append(i)
+
+    dependents = graph.dependents
+    evaluations = 0
+    while queue:
+        i = queue.popleft()
+        queued[i] = 0
+        evaluations += 1
+        if not _can_unlock(graph, i, unlocked, node_percentages):
+            continue
+        unlocked[i] = 1
+        if newly_unlocked is not None:
+            newly_unlocked.append(i)
+        for d in dependents[i]:
+            if not unlocked[d] and not queued[d]:
+                queued[d] = 1
+                queue.append(d)
+
+    return unlocked, evaluations
+
+
+def _dependent_closure(graph, ordinals):
+    """All nodes that transitively depend on any of `ordinals` (excluding Start)."""
+    dependents = graph.dependents
+    region = set()
+    stack = [d for i in ordinals for d in dependents[i]]
+    while stack:
+        i = stack.pop()
+        if i in region or i == 0:
+            continue
+        region.add(i)
+        stack.extend(dependents[i])
+    return region
+
+
+def compute_exercise_toggle_update(compiled_graph, user_node_status_map, completed_exercise_ids, exercise_id):
+    """
+    Incrementally recomputes derived node state after a single exercise was
+    completed or un-completed. Starts from the user's persisted node statuses,
+    which must hold the result of the previous full or incremental computation
+    for this graph version, and only touches what the toggle can affect: the
+    owning sub node, the main nodes it rolls up into, and the nodes whose
+    unlock rule reads a percentage that crossed UNLOCK_PERCENT.
+
+    Args:
+        compiled_graph (CompiledGraph): Topology of the graph version.
+        user_node_status_map (dict): {node_id: UserNodeStatus} as persisted before the toggle.
+        completed_exercise_ids (set or int): Completed exercise IDs *after* the toggle,
+            or their completion bitset.
+        exercise_id (str): The toggled exercise.
+
+    Returns:
+        tuple: (node_status_updates, changed_node_ids)
+               - node_status_updates: {node_id: {'percent_complete', 'unlocked', 'discovered'}}
+                 for the changed nodes, as expected by update_user_node_status_bulk.
+               - changed_node_ids: List of node IDs whose derived fields changed.
+    """
+    graph = compiled_graph
+    e = graph.exercise_index.get(exercise_id)
+    if e is None:
+        return {}, []
+    node_count = len(graph)
+    index = graph.index
+
+    # --- Prior state, from persisted statuses ---
+    node_percentages = [0] * node_count
+    unlocked = bytearray(node_count)
+    discovered = bytearray(node_count)
+    for node_id, status in user_node_status_map.items():
+        i = index.get(node_id)
+        if not i: # Unknown node, or the 'Start' pseudo-node
+            continue
+        node_percentages[i] = status.percent_complete or 0
+        unlocked[i] = 1 if status.unlocked else 0
+        discovered[i] = 1 if status.discovered else 0
+    unlocked[0] = discovered[0] = 1
+
+    # --- Percentages: owning sub node, then the main nodes it rolls up into ---
+    old_percentages = {}
+    owner = graph.exercise_node[e]
+    if graph.types[owner] == TYPE_SUB:
+        new_percent = _sub_percent(graph, owner, graph.as_exercise_mask(completed_exercise_ids))
+        if new_percent != node_percentages[owner]:
+            old_percentages[owner] = node_percentages[owner]
+            node_percentages[owner] = new_percent
+            for m in graph.rollup_mains[graph.rollup_offsets[owner]:graph.rollup_offsets[owner + 1]]:
+                new_percent = _main_percent(graph, m, node_percentages)
+                if new_percent != node_percentages[m]:
+                    old_percentages[m] = node_percentages[m]
+                    node_percentages[m] = new_percent
+
+    # --- Unlocks: only percentages crossing the threshold can change them ---
+    crossed_up, crossed_down = [], []
+    for i, old_percent in old_percentages.items():
+        was_over = old_percent >= UNLOCK_PERCENT
+        is_over = node_percentages[i] >= UNLOCK_PERCENT
+        if is_over and not was_over:
+            crossed_up.append(i)
+        elif was_over and not is_over:
+            crossed_down.append(i)
+
+    flipped = []
+    evaluations = 0
+    if crossed_down:
+        # Anything downstream may lose its unlock: relock that region and re-derive it.
+        # Nodes outside the region never read a node inside it, so they keep their state.
+        region = _dependent_closure(graph, crossed_down)
+        before = {i: unlocked[i] for i in region}
+        for i in region:
+            unlocked[i] = 0
+        unlocked, evaluations = propagate_unlocks(graph, node_percentages, unlocked, seeds=region)
+        flipped = [i for i in region if unlocked[i] != before[i]]
+    elif crossed_up:
+        seeds = [d for i in crossed_up for d in graph.dependents[i]]
+        unlocked, evaluations = propagate_unlocks(
+            graph, node_percentages, unlocked, seeds=seeds, newly_unlocked=flipped)
+
+    engine_stats['incremental_runs'] += 1
+    engine_stats['incremental_evaluations'] += evaluations
+
+    # --- Discovery: the fog-of-war BFS only ever reveals unlocked nodes, so a
+    # node's discovered flag follows its unlocked flag (see _discovered_flags) ---
+    for i in flipped:
+        discovered[i] = unlocked[i]
+
+    node_status_updates = {}
+    for i in dict.fromkeys([*old_percentages, *flipped]):
+        node_status_updates[graph.ids[i]] = {
+            'percent_complete': node_percentages[i],
+            'unlocked': bool(unlocked[i]),
+            'discovered': bool(discovered[i]),
+        }
+    return node_status_updates, list(node_status_updates)
+
+
+def get_engine_stats():
+    """Returns a snapshot of the state engine counters."""
+    return dict(engine_stats)
+
+
+def _discovered_flags(unlocked):
     """
-    Determines discovered nodes based on Fog of War logic for a tree structure:
-    Starts with unlocked nodes. Explores via CHILD links, but STOPS exploration
-    down a path if it encounters a locked node.
+    Discovered flags per node ordinal, given the unlocked flags. The fog-of-war
+    walk starts from every unlocked node and only ever steps onto unlocked
+    nodes, so it reaches nothing beyond its starting set: the discovered
+    nodes are exactly the unlocked ones, plus Start.
     """
-    discovered = set()
-    nodes_to_process = collections.deque()
-
-    # Initialize discovered set ONLY with currently unlocked nodes.
-    # These are the only nodes initially visible.
-    for node_id, is_unlocked in unlocked_map.items():
-        # Ensure the node actually exists in the graph data we have
-        if is_unlocked and node_id in static_node_map:
-            if node_id not in discovered:
-                discovered.add(node_id)
-                # Add these initially discovered (unlocked) nodes to start the traversal.
-                nodes_to_process.append(node_id)
-
-    # Build adjacency list ONLY for CHILD links (both directions needed for traversal)
-    # Since it's a tree (mostly), target -> source might represent the parent link visually.
-    adj = collections.defaultdict(list)
-    for link in links_list_of_dicts:
-        source, target = link.get('source'), link.get('target')
-        link_type = link.get('type')
-        # Only consider CHILD links for discovery spread
-        # Ensure both source and target nodes are valid before adding edge
-        if link_type == 'CHILD' and source in static_node_map and target in static_node_map:
-             adj[source].append(target)
-             # For tree traversal, we need to go parent -> child and child -> parent along the CHILD link type
-             adj[target].append(source)
-
-    # --- BFS Traversal - STOPS at Locked Nodes ---
-    # Use 'processed' set to keep track of nodes already added to the queue, preventing cycles (though less likely in a tree) and redundant work.
-    processed = set(discovered) # Initialize with the starting unlocked nodes
-
-    while nodes_to_process:
-        current_node_id = nodes_to_process.popleft()
-
-        # Explore neighbors via CHILD links
-        for neighbor_id in adj.get(current_node_id, []):
-            # CRUCIAL CHECK: Is the neighbor UNLOCKED?
-            is_neighbor_unlocked = unlocked_map.get(neighbor_id, False)
-
-            # Check if neighbor exists in our map (sanity check)
-            if neighbor_id not in static_node_map: continue
-
-            # Only proceed if the neighbor is UNLOCKED and not already processed/queued
-            if is_neighbor_unlocked and neighbor_id not in processed:
-                discovered.add(neighbor_id) # Discover the unlocked neighbor
-                processed.add(neighbor_id)   # Mark as processed (i.e., added to queue)
-                nodes_to_process.append(neighbor_id) # Add to queue to explore *its* neighbors
-
-            # If neighbor is LOCKED or already processed, WE DO NOTHING.
-            # The traversal down this path stops here.
-
-    # Ensure Start is always discovered (it should be added initially if unlocked)
-    if "Start" in static_node_map:
-         discovered.add("Start")
-
-    return discovered
\ No newline at end of file
+    discovered = bytearray(unlocked)
+    discovered[0] = 1
+    return discovered
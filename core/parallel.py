@@ -0,0 +1,58 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+from flask import current_app
+
+# Opt-in: run the independent reads of a request concurrently on pooled connections.
+# The pool is shared by all request threads, so callers only use it for rare, slow
+# work (cold static-cache loads), never on every request.
+# Every call running on the pool holds its own connection while it runs, so the
+# engine's pool (pool_size + max_overflow) needs room for CONCURRENT_QUERY_WORKERS
+# connections per process on top of the request threads' own.
+CONCURRENT_QUERIES = os.environ.get("CONCURRENT_QUERIES", "False").lower() == "true"
+CONCURRENT_QUERY_WORKERS = int(os.environ.get("CONCURRENT_QUERY_WORKERS", 4))
+
+_executor = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=CONCURRENT_QUERY_WORKERS, thread_name_prefix="state-query"
+                )
+    return _executor
+
+
+def run_independent(*calls, concurrent=None):
+    """
+    Runs zero-argument callables that don't depend on each other and returns
+    their results in order. Exceptions are re-raised in the caller.
+
+    In concurrent mode (CONCURRENT_QUERIES, or `concurrent=True`) the first
+    call runs on the current thread and the others on a shared thread pool.
+    Each pooled call gets its own app context, hence its own session and
+    connection; it only sees committed data and must return plain values
+    rather than ORM objects. Only use it when the caller's session has no
+    pending writes the calls need to see.
+    """
+    if concurrent is None:
+        concurrent = CONCURRENT_QUERIES
+    if not concurrent or len(calls) < 2:
+        return [call() for call in calls]
+
+    app = current_app._get_current_object()
+
+    def in_app_context(call):
+        with app.app_context():  # Session is removed (connection returned) on exit
+            return call()
+
+    futures = [_get_executor().submit(in_app_context, call) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        wait(futures)  # Pooled calls never outlive the caller, even if it failed
+    return [first] + [future.result() for future in futures]
@@ -0,0 +1,108 @@
+import re
+from itertools import chain
+from threading import Lock
+from weakref import WeakKeyDictionary
+from flask import current_app
+from core import nodes as core_nodes
+
+# Placeholder for a per-user value in a node template; JSON-encoded as "\u0000<name>\u0000"
+_HOLE = re.compile(rb'"\\u0000([a-z]+)\\u0000"')
+_BOOLEANS = (b"false", b"true")
+_EMPTY_NOTES = b'""'
+
+_node_templates = WeakKeyDictionary()  # CompiledGraph -> templates, dropped with the graph
+_node_templates_lock = Lock()
+
+
+def _dumps(value):
+    # Same output as jsonify outside debug mode: compact, sorted keys
+    return current_app.json.dumps(value, separators=(",", ":"))
+
+
+def _hole(name):
+    return f"\x00{name}\x00"
+
+
+def _build_node_templates(graph):
+    """
+    Per node ordinal, the node's encoded JSON split around its per-user values:
+    (static segments, hole names), with one more segment than holes. Built
+    from core.nodes.format_node itself, so the layout always matches the dicts.
+    """
+    templates = [None]  # Start is encoded whole
+    for i in range(1, len(graph)):
+        node = core_nodes.format_node(
+            graph, i, _hole("percent"), _hole("unlocked"), _hole("discovered"), _hole("notes"),
+            [_hole("completed")] * (graph.ex_end[i] - graph.ex_start[i]))
+        parts = _HOLE.split(_dumps(node).encode("utf-8"))
+        templates.append((parts[0::2], parts[1::2]))
+    return _dumps(graph.start_node).encode("utf-8"), templates
+
+
+def _get_node_templates(graph):
+    templates = _node_templates.get(graph)
+    if templates is None:
+        with _node_templates_lock:
+            templates = _node_templates.get(graph)
+            if templates is None:
+                templates = _node_templates[graph] = _build_node_templates(graph)
+    return templates
+
+
+def _encode_nodes(nodes, graph):
+    """
+    Encodes the node list of compute_user_graph_state for `graph` by filling
+    the graph's node templates with the per-user values read from the dicts.
+    Returns None if the list doesn't have the graph's layout.
+    """
+    if len(nodes) != len(graph) or nodes[0] is not graph.start_node:
+        return None
+    start_json, templates = _get_node_templates(graph)
+    ids = graph.ids
+    out = [b"[", start_json]
+    for i in range(1, len(nodes)):
+        node = nodes[i]
+        popup = node['popup']
+        if node['id'] != ids[i] or len(popup['exercises']) != graph.ex_end[i] - graph.ex_start[i]:
+            return None
+        segments, holes = templates[i]
+        notes = popup['userNotes']
+        fields = {
+            b"percent": str(node['percent']).encode("ascii"),
+            b"unlocked": _BOOLEANS[node['unlocked']],
+            b"discovered": _BOOLEANS[node['discovered']],
+            b"notes": _EMPTY_NOTES if notes == '' else _dumps(notes).encode("utf-8"),
+        }
+        completed = iter([_BOOLEANS[ex['completed']] for ex in popup['exercises']])
+        values = [fields[hole] if hole != b"completed" else next(completed) for hole in holes]
+        out.append(b",")
+        out.extend(chain.from_iterable(zip(segments, values)))
+        out.append(segments[-1])
+    out.append(b"]")
+    return b"".join(out)
+
+
+def encode_state(state, compiled_graph=None):
+    """
+    Encodes a GET /data state dict as JSON bytes, like jsonify would.
+
+    The graph's user-independent parts are not serialized again: the shared
+    link list's pre-encoded JSON is spliced in as is, and every node is its
+    cached per-graph template with the user's values (percent, unlocked,
+    discovered, notes and exercise completion) filled in. Everything else is
+    encoded normally.
+    """
+    fragments = {}
+    if compiled_graph is not None:
+        if state.get("links") is compiled_graph.output_links:
+            fragments["links"] = compiled_graph.output_links_json
+        if state.get("nodes"):
+            fragments["nodes"] = _encode_nodes(state["nodes"], compiled_graph)
+
+    parts = []
+    for key in sorted(state):
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = _dumps(state[key]).encode("utf-8")
+        parts.append(_dumps(key).encode("utf-8") + b":" + fragment)
+    return b"{" + b",".join(parts) + b"}"
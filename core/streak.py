@@ -3,6 +3,7 @@ import os
 import json
 from datetime import datetime, timedelta
 from models import db, UserStreak, User 
+from core import data as core_data
 
 
 
@@ -12,10 +13,7 @@ def get_user_streak(user_id):
     try:
         streak_record = UserStreak.query.filter_by(user_id=user_id).first()
         if streak_record:
-            return {
-                "streak": streak_record.current_streak,
-                "last_used": streak_record.last_used_date.isoformat() if streak_record.last_used_date else ""
-            }
+            return format_streak(streak_record.current_streak, streak_record.last_used_date)
         else:
             
             return {"streak": 0, "last_used": ""}
@@ -23,13 +21,29 @@ def get_user_streak(user_id):
         print(f"Error fetching streak for user {user_id}: {e}")
         return {"streak": 0, "last_used": ""} 
 
+def format_streak(current_streak, last_used_date):
+    """Streak data dictionary, as returned by get_user_streak, for a streak record's values."""
+    return {
+        "streak": current_streak,
+        "last_used": last_used_date.isoformat() if last_used_date else ""
+    }
+
 def update_user_streak(user_id):
     """
     Updates the streak for a specific user based on the current date.
     Returns the updated streak data dictionary.
     """
+    return advance_user_streak(user_id)[0]
+
+def advance_user_streak(user_id):
+    """
+    Same as update_user_streak, but returns (streak data, changed), where
+    `changed` tells whether the streak record was created or moved to today
+    (the "streak advanced" event of the badge rules).
+    """
     today = datetime.utcnow().date()
     updated_streak_data = {"streak": 0, "last_used": ""} 
+    changed = False
 
     try:
         streak_record = UserStreak.query.filter_by(user_id=user_id).first()
@@ -38,6 +52,8 @@ def update_user_streak(user_id):
             
             streak_record = UserStreak(user_id=user_id, current_streak=1, last_used_date=today)
             db.session.add(streak_record)
+            core_data.bump_user_progress_version(user_id)
+            changed = True
             updated_streak_data = {"streak": 1, "last_used": today.isoformat()}
         else:
             last_date = streak_record.last_used_date
@@ -48,18 +64,22 @@ def update_user_streak(user_id):
                 
                 streak_record.current_streak += 1
                 streak_record.last_used_date = today
+                core_data.bump_user_progress_version(user_id)
+                changed = True
                 updated_streak_data = {"streak": streak_record.current_streak, "last_used": today.isoformat()}
             else:
                 
                 streak_record.current_streak = 1
                 streak_record.last_used_date = today
+                core_data.bump_user_progress_version(user_id)
+                changed = True
                 updated_streak_data = {"streak": 1, "last_used": today.isoformat()}
 
         
-        return updated_streak_data
+        return updated_streak_data, changed
 
     except Exception as e:
         db.session.rollback()
         print(f"Error updating streak for user {user_id}: {e}")
         
-        return get_user_streak(user_id) 
\ No newline at end of file
+        return get_user_streak(user_id), False 
\ No newline at end of file
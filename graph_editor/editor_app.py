@@ -1,5 +1,6 @@
 # graph_editor_app/editor_app.py
 import os
+import sys
 import uuid
 from flask import Flask, jsonify, request, abort
 from flask_sqlalchemy import SQLAlchemy
@@ -27,7 +28,7 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # This assumes models.py is in the SAME directory as editor_app.py
 # If it's elsewhere, adjust the import path accordingly.
 try:
-    from models import db, Graph, Node, NodeRelationship, Exercise, ExerciseCategory, UserNodeStatus, UserExerciseCompletion
+    from models import db, User, Graph, Node, NodeRelationship, Exercise, ExerciseCategory, UserNodeStatus, UserExerciseCompletion
     # Add any other models needed
 except ImportError as e:
      print(f"Error importing models: {e}")
@@ -43,21 +44,24 @@ db.init_app(app)
 # Import the ID generator
 from utils import generate_unique_id
 
+# The leaderboard counters are shared with the main app, one directory up;
+# appended so models and utils above still resolve to this directory's copies
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from core import leaderboard as core_leaderboard
+
 # --- Helper Functions ---
 
 def get_node_or_404(node_id):
-    """Fetches a node by ID or aborts with 404."""
-    # Use db.session.get for primary key lookups if available and efficient
-    node = db.session.get(Node, node_id)
-    # Fallback or alternative:
-    # node = Node.query.get(node_id) # .get() is often shorthand for PK lookup
+    """Fetches a node by its (external) ID or aborts with 404."""
+    # The id is a unique column; the primary key is the integer Node.pk
+    node = Node.query.filter_by(id=node_id).first()
     if not node:
         abort(404, description=f"Node with id '{node_id}' not found.")
     return node
 
 def get_exercise_or_404(exercise_id):
     """Fetches an exercise by ID or aborts with 404."""
-    exercise = db.session.get(Exercise, exercise_id)
+    exercise = Exercise.query.filter_by(id=exercise_id).first()
     if not exercise:
         abort(404, description=f"Exercise with id '{exercise_id}' not found.")
     return exercise
@@ -69,6 +73,33 @@ def get_graph_or_404(graph_id):
         abort(404, description=f"Graph with id '{graph_id}' not found.")
     return graph
 
+def bump_graph_version(graph_id):
+    """Increments the graph's version so the main app reloads its cached static data."""
+    # Not committed here; it rides along with the caller's transaction.
+    Graph.query.filter_by(id=graph_id).update(
+        {Graph.version: Graph.version + 1}, synchronize_session=False
+    )
+
+def bump_progress_versions(user_ids):
+    """Increments the users' progress versions so their /data snapshots and ETags go stale."""
+    # Not committed here either
+    if user_ids:
+        User.query.filter(User.id.in_(list(user_ids))).update(
+            {User.progress_version: User.progress_version + 1}, synchronize_session=False
+        )
+
+def remove_exercise_completions(exercise_pks):
+    """
+    Deletes the users' completions of the exercises, taking them off the
+    leaderboard counters and bumping the users' progress versions.
+    """
+    scores = core_leaderboard.exercise_scores(exercise_pks)
+    core_leaderboard.apply_score_changes(scores, {})
+    UserExerciseCompletion.query.filter(
+        UserExerciseCompletion.exercise_pk.in_(list(exercise_pks))
+    ).delete(synchronize_session=False)
+    bump_progress_versions(scores)
+
 # --- API Routes ---
 # Note: No '/api/editor' prefix here unless you add it manually to each route
 
@@ -91,10 +122,11 @@ def get_graph_nodes(graph_id):
         # Fetch only CHILD relationships where both parent and child are in this graph
         relationships = NodeRelationship.query.filter(
             NodeRelationship.relationship_type == 'CHILD',
-            NodeRelationship.child_node_id.in_([n.id for n in nodes])
+            NodeRelationship.child_pk.in_([n.pk for n in nodes])
         ).all()
 
-        parent_map = {rel.child_node_id: rel.parent_node_id for rel in relationships}
+        ids_by_pk = {n.pk: n.id for n in nodes}
+        parent_map = {ids_by_pk[rel.child_pk]: ids_by_pk.get(rel.parent_pk) for rel in relationships}
 
         nodes_data = [
             {
@@ -126,10 +158,10 @@ def get_node_details(node_id):
 
         # Find the parent relationship (CHILD type)
         parent_rel = NodeRelationship.query.filter_by(
-            child_node_id=node.id,
+            child_pk=node.pk,
             relationship_type='CHILD'
         ).first()
-        parent_id = parent_rel.parent_node_id if parent_rel else None
+        parent_id = parent_rel.parent_node.id if parent_rel else None
 
         node_data = {
             'id': node.id,
@@ -169,7 +201,7 @@ def create_node(graph_id):
     parent_id = data.get('parent_id') # Optional parent ID
 
     # Check if ID already exists (highly unlikely with UUID, but possible with other schemes)
-    existing_node = db.session.get(Node, new_node_id)
+    existing_node = Node.query.filter_by(id=new_node_id).first()
     if existing_node:
          abort(409, description=f"Generated Node ID '{new_node_id}' already exists. Please try again.") # 409 Conflict
 
@@ -183,27 +215,29 @@ def create_node(graph_id):
             pdf_link=data.get('pdf_link')
         )
         db.session.add(new_node)
+        db.session.flush() # Assigns new_node.pk
 
         # Handle parent relationship if provided
         if parent_id:
-            parent_node = db.session.get(Node, parent_id)
+            parent_node = Node.query.filter_by(id=parent_id).first()
             if not parent_node or parent_node.graph_id != graph_id:
                 db.session.rollback()
                 abort(400, description=f"Parent node '{parent_id}' not found in graph '{graph_id}'.")
 
             # Check if new node already has a parent (shouldn't happen on create, but good practice)
-            existing_parent = NodeRelationship.query.filter_by(child_node_id=new_node_id, relationship_type='CHILD').first()
+            existing_parent = NodeRelationship.query.filter_by(child_pk=new_node.pk, relationship_type='CHILD').first()
             if existing_parent:
                  db.session.rollback()
                  abort(409, description=f"Node '{new_node_id}' cannot be created with multiple parents.") # 409 Conflict
 
             parent_rel = NodeRelationship(
-                parent_node_id=parent_id,
-                child_node_id=new_node_id,
+                parent_node=parent_node,
+                child_node=new_node,
                 relationship_type='CHILD'
             )
             db.session.add(parent_rel)
 
+        bump_graph_version(graph_id)
         db.session.commit()
 
         # Fetch the created node details to return a complete object
@@ -237,10 +271,10 @@ def update_node(node_id):
             new_parent_id = data['parent_id'] # Could be an ID or null/None
 
             current_parent_rel = NodeRelationship.query.filter_by(
-                child_node_id=node_id,
+                child_pk=node.pk,
                 relationship_type='CHILD'
             ).first()
-            current_parent_id = current_parent_rel.parent_node_id if current_parent_rel else None
+            current_parent_id = current_parent_rel.parent_node.id if current_parent_rel else None
 
             # Only proceed if parent actually changed
             if new_parent_id != current_parent_id:
@@ -256,13 +290,13 @@ def update_node(node_id):
                         db.session.rollback()
                         abort(400, description="Node cannot be its own parent.")
 
-                    new_parent_node = db.session.get(Node, new_parent_id)
+                    new_parent_node = Node.query.filter_by(id=new_parent_id).first()
                     if not new_parent_node or new_parent_node.graph_id != node.graph_id:
                         db.session.rollback()
                         abort(400, description=f"New parent node '{new_parent_id}' not found in graph '{node.graph_id}'.")
 
                      # Double-check constraint before adding new relationship
-                    existing_parent_check = NodeRelationship.query.filter_by(child_node_id=node_id, relationship_type='CHILD').count()
+                    existing_parent_check = NodeRelationship.query.filter_by(child_pk=node.pk, relationship_type='CHILD').count()
                     if existing_parent_check > 0:
                         # This should not happen if the deletion worked, indicates potential issue
                         db.session.rollback()
@@ -272,8 +306,8 @@ def update_node(node_id):
 
                     print(f"Adding new parent link: {new_parent_id} -> {node_id}")
                     new_rel = NodeRelationship(
-                        parent_node_id=new_parent_id,
-                        child_node_id=node_id,
+                        parent_node=new_parent_node,
+                        child_node=node,
                         relationship_type='CHILD'
                     )
                     db.session.add(new_rel)
@@ -281,6 +315,7 @@ def update_node(node_id):
                     print(f"Setting node {node_id} as root (parent=None)")
 
 
+        bump_graph_version(node.graph_id)
         db.session.commit()
 
         # Fetch updated node details to return
@@ -304,17 +339,17 @@ def delete_node(node_id):
     try:
         # 1. Find relationships where this node is the PARENT (CHILD type)
         child_relationships = NodeRelationship.query.filter_by(
-            parent_node_id=node_id,
+            parent_pk=node.pk,
             relationship_type='CHILD'
         ).all()
         # Remove these relationships (makes children root nodes)
         for rel in child_relationships:
-            print(f"Removing parent link from child {rel.child_node_id} due to parent {node_id} deletion.")
+            print(f"Removing parent link from child {rel.child_node.id} due to parent {node_id} deletion.")
             db.session.delete(rel)
 
         # 2. Find relationship where this node is the CHILD (its parent link)
         parent_relationship = NodeRelationship.query.filter_by(
-            child_node_id=node_id,
+            child_pk=node.pk,
             relationship_type='CHILD'
         ).first()
         if parent_relationship:
@@ -324,15 +359,19 @@ def delete_node(node_id):
         # 3. Delete exercises associated with the node (assuming cascade delete works OR handle explicitly)
         # If cascade="all, delete-orphan" is set on Node.exercises relationship, this might be automatic.
         # Explicit deletion is safer if unsure.
-        # Exercise.query.filter_by(node_id=node_id).delete() # Uncomment if cascade is not reliable
+        # Exercise.query.filter_by(node_pk=node.pk).delete() # Uncomment if cascade is not reliable
+        # Their completions aren't cascaded; they come off the leaderboards with them
+        remove_exercise_completions([exercise.pk for exercise in node.exercises])
 
         # 4. Delete user statuses associated with the node (important!)
-        UserNodeStatus.query.filter_by(node_id=node_id).delete()
+        UserNodeStatus.query.filter_by(node_pk=node.pk).delete()
 
         # 5. Delete the node itself (Exercises might be deleted via cascade now)
         print(f"Deleting node {node_id}.")
+        graph_id = node.graph_id
         db.session.delete(node)
 
+        bump_graph_version(graph_id)
         db.session.commit()
         return jsonify({'status': 'success', 'message': f'Node {node_id} deleted successfully.'}), 200
 
@@ -370,7 +409,7 @@ def add_exercise_to_node(node_id):
 
     new_exercise_id = generate_unique_id()
     # Check if ID exists (unlikely with UUID)
-    existing_ex = db.session.get(Exercise, new_exercise_id)
+    existing_ex = Exercise.query.filter_by(id=new_exercise_id).first()
     if existing_ex:
         abort(409, description=f"Generated Exercise ID '{new_exercise_id}' already exists. Please try again.")
 
@@ -378,18 +417,19 @@ def add_exercise_to_node(node_id):
     try:
         new_exercise = Exercise(
             id=new_exercise_id,
-            node_id=node_id,
+            node=node,
             label=data['label'],
             points=int(data['points']), # Ensure points are integer
             optional=bool(data.get('optional', False)), # Ensure optional is boolean
             categories=categories_to_add # Assign validated category objects
         )
         db.session.add(new_exercise)
+        bump_graph_version(node.graph_id)
         db.session.commit()
 
         return jsonify({
             'id': new_exercise.id,
-            'node_id': new_exercise.node_id, # Include node_id for context
+            'node_id': node.id, # Include node_id for context
             'label': new_exercise.label,
             'points': new_exercise.points,
             'optional': new_exercise.optional,
@@ -412,6 +452,10 @@ def update_exercise(exercise_id):
         abort(400, description="No update data provided.")
 
     try:
+        # Points, the optional flag and categories decide what completions score
+        rescored = any(key in data for key in ('points', 'optional', 'categories'))
+        if rescored:
+            scores_before = core_leaderboard.exercise_scores([exercise.pk])
         if 'label' in data: exercise.label = data['label']
         if 'points' in data: exercise.points = int(data['points'])
         if 'optional' in data: exercise.optional = bool(data['optional'])
@@ -431,11 +475,18 @@ def update_exercise(exercise_id):
                  categories_to_set.append(valid_categories[cat_name])
             exercise.categories = categories_to_set # Replace existing categories
 
+        if rescored:
+            db.session.flush()
+            core_leaderboard.apply_score_changes(
+                scores_before, core_leaderboard.exercise_scores([exercise.pk])
+            )
+            bump_progress_versions(scores_before)
+        bump_graph_version(exercise.node.graph_id)
         db.session.commit()
 
         return jsonify({
             'id': exercise.id,
-            'node_id': exercise.node_id,
+            'node_id': exercise.node.id,
             'label': exercise.label,
             'points': exercise.points,
             'optional': exercise.optional,
@@ -456,9 +507,11 @@ def delete_exercise(exercise_id):
     try:
         # Manually delete related user completions first if cascade isn't set reliably
         # This is important if users might have completed the exercise
-        UserExerciseCompletion.query.filter_by(exercise_id=exercise_id).delete()
+        remove_exercise_completions([exercise.pk])
 
+        graph_id = exercise.node.graph_id
         db.session.delete(exercise)
+        bump_graph_version(graph_id)
         db.session.commit()
         return jsonify({'status': 'success', 'message': f'Exercise {exercise_id} deleted successfully.'}), 200
 
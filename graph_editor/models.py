@@ -19,6 +19,9 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    # Bumped by every write to the user's progress, including the editor's
+    # removal of completions (see core.data.bump_user_progress_version)
+    progress_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     # Relationships
     exercise_completions = db.relationship(
         "UserExerciseCompletion",
@@ -58,14 +61,18 @@ class Graph(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     description = db.Column(db.Text)
+    # Bumped on every write to the graph's nodes/exercises/relationships so
+    # per-process static caches know when to reload.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     nodes = db.relationship("Node", backref="graph", lazy=True)
 
 
 class Node(db.Model):
     __tablename__ = "nodes"
-    id = db.Column(
-        db.Text, primary_key=True
-    )  # Text primary keys might be less performant than integers for indexing/joins if very long/variable. Consider if UUIDs or integers are feasible.
+    # Integer surrogate key; every foreign key to a node references it
+    pk = db.Column(db.Integer, primary_key=True)
+    # External identifier (uuid hex or the JSON node id) used by the API, the editor and badge ids
+    id = db.Column(db.Text, unique=True, nullable=False)
     graph_id = db.Column(db.Integer, db.ForeignKey("graphs.id"), nullable=False)
     title = db.Column(db.Text, nullable=False)
     type = db.Column(db.String(10), nullable=False)
@@ -75,28 +82,28 @@ class Node(db.Model):
         "Exercise", backref="node", cascade="all, delete-orphan"
     )
 
-    # Add index for graph_id foreign key
-    __table_args__ = (Index("ix_nodes_graph_id", "graph_id"),)
+    # Index for the graph_id foreign key; including pk lets per-graph joins be answered from the index
+    __table_args__ = (Index("ix_nodes_graph_id_pk", "graph_id", "pk"),)
 
 
 # Junction table for node relationships
 class NodeRelationship(db.Model):
     __tablename__ = "node_relationships"
     relationship_id = db.Column(db.Integer, primary_key=True)
-    parent_node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
-    child_node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    parent_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
+    child_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     relationship_type = db.Column(
         db.String(15), nullable=False
     )  # 'CHILD' or 'PREREQUISITE'
 
     parent_node = db.relationship(
         "Node",
-        foreign_keys=[parent_node_id],
+        foreign_keys=[parent_pk],
         backref=db.backref("child_links", lazy="dynamic", cascade="all, delete-orphan"),
     )
     child_node = db.relationship(
         "Node",
-        foreign_keys=[child_node_id],
+        foreign_keys=[child_pk],
         backref=db.backref(
             "parent_links", lazy="dynamic", cascade="all, delete-orphan"
         ),
@@ -104,15 +111,17 @@ class NodeRelationship(db.Model):
 
     # Add indexes for foreign keys used in joins/lookups
     __table_args__ = (
-        Index("ix_node_relationships_parent_id", "parent_node_id"),
-        Index("ix_node_relationships_child_id", "child_node_id"),
+        Index("ix_node_relationships_parent_pk", "parent_pk"),
+        Index("ix_node_relationships_child_pk", "child_pk"),
     )
 
 
 class Exercise(db.Model):
     __tablename__ = "exercises"
-    id = db.Column(db.Text, primary_key=True)  # Consider integer/UUID if possible
-    node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    # Integer surrogate key, see Node
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Text, unique=True, nullable=False)
+    node_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     label = db.Column(db.Text, nullable=False)
     points = db.Column(db.Integer, default=10)
     optional = db.Column(db.Boolean, default=False)
@@ -122,8 +131,8 @@ class Exercise(db.Model):
         backref=db.backref("exercises", lazy="dynamic"),
     )
 
-    # Add index for node_id foreign key
-    __table_args__ = (Index("ix_exercises_node_id", "node_id"),)
+    # Index for the node_pk foreign key; including pk lets per-graph joins be answered from the index
+    __table_args__ = (Index("ix_exercises_node_pk_pk", "node_pk", "pk"),)
 
 
 class ExerciseCategory(db.Model):
@@ -137,16 +146,16 @@ exercise_category_map = db.Table(
     "exercise_category_map",
     db.metadata,
     db.Column("map_id", db.Integer, primary_key=True),
-    db.Column("exercise_id", db.Text, db.ForeignKey("exercises.id"), nullable=False),
+    db.Column("exercise_pk", db.Integer, db.ForeignKey("exercises.pk"), nullable=False),
     db.Column(
         "category_id",
         db.Integer,
         db.ForeignKey("exercise_categories.category_id"),
         nullable=False,
     ),
-    db.UniqueConstraint("exercise_id", "category_id", name="uq_exercise_category"),
+    db.UniqueConstraint("exercise_pk", "category_id", name="uq_exercise_category"),
     # Add individual indexes for lookups via either side
-    Index("ix_exercise_category_map_exercise_id", "exercise_id"),
+    Index("ix_exercise_category_map_exercise_pk", "exercise_pk"),
     Index("ix_exercise_category_map_category_id", "category_id"),
 )
 
@@ -165,6 +174,10 @@ class Badge(db.Model):
     title = db.Column(db.Text, nullable=False)
     description = db.Column(db.Text)
     image_path = db.Column(db.Text)
+    # Award rule (see core.badges.BadgeRules): earned once the user's `metric`
+    # reaches `threshold`. For 'main' badges the node is the id's 'main-' suffix.
+    metric = db.Column(db.Text)
+    threshold = db.Column(db.Integer)
 
 
 # --- User Progress Tables ---
@@ -174,13 +187,13 @@ class UserExerciseCompletion(db.Model):
     __tablename__ = "user_exercise_completion"
     completion_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    exercise_id = db.Column(db.Text, db.ForeignKey("exercises.id"), nullable=False)
+    exercise_pk = db.Column(db.Integer, db.ForeignKey("exercises.pk"), nullable=False)
     completed_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     __table_args__ = (
-        db.UniqueConstraint("user_id", "exercise_id", name="uq_user_exercise"),
+        db.UniqueConstraint("user_id", "exercise_pk", name="uq_user_exercise"),
         # Add individual indexes (even if covered by unique, sometimes useful depending on query)
         Index("ix_user_exercise_completion_user_id", "user_id"),
-        Index("ix_user_exercise_completion_exercise_id", "exercise_id"),
+        Index("ix_user_exercise_completion_exercise_pk", "exercise_pk"),
     )
 
 
@@ -227,14 +240,35 @@ class UserNodeStatus(db.Model):
     __tablename__ = "user_node_status"
     status_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    node_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     unlocked = db.Column(db.Boolean, default=False)
     discovered = db.Column(db.Boolean, default=False)
     percent_complete = db.Column(db.Integer, default=0)
     user_notes = db.Column(db.Text)
     __table_args__ = (
-        db.UniqueConstraint("user_id", "node_id", name="uq_user_node"),
-        Index("ix_user_node_status_user_id", "user_id"),
-        Index("ix_user_node_status_node_id", "node_id"),
+        db.UniqueConstraint("user_id", "node_pk", name="uq_user_node"),
+        # Covering index for the per-user status reads, see the main app's models.py
+        Index(
+            "ix_user_node_status_progress",
+            "user_id",
+            "node_pk",
+            postgresql_include=["percent_complete", "unlocked", "discovered"],
+        ),
+        Index("ix_user_node_status_node_pk", "node_pk"),
     )
     node = db.relationship("Node", backref=db.backref("user_statuses", lazy=True))
+
+
+class LeaderboardScore(db.Model):
+    __tablename__ = "leaderboard_scores"
+    score_id = db.Column(db.Integer, primary_key=True)
+    # 'global', 'graph:<graph_id>' or 'category:<name>' (see core.leaderboard)
+    board = db.Column(db.Text, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    # Counters kept up to date by the completion writes and the editor's exercise changes
+    xp = db.Column(db.Integer, nullable=False, default=0)
+    completions = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint("board", "user_id", name="uq_leaderboard_score"),
+        Index("ix_leaderboard_scores_user_id", "user_id"),
+    )
@@ -21,6 +21,8 @@ except ImportError as e:
     exit(1)
 
 from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import text
+from core.badges import rule_from_badge_id
 
 
 # --- Configuration ---
@@ -79,6 +81,105 @@ def load_json_file(filepath):
 
 # --- Migration Functions ---
 
+# Idempotent DDL for columns/indexes added after the initial schema.
+# db.create_all() only creates missing tables, so existing databases need these.
+SCHEMA_MIGRATIONS = [
+    "ALTER TABLE graphs ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS progress_version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE user_graph_state ADD COLUMN IF NOT EXISTS completion_bitmap BYTEA",
+    "ALTER TABLE user_graph_state ADD COLUMN IF NOT EXISTS completion_bitmap_version INTEGER",
+    "ALTER TABLE user_graph_state ADD COLUMN IF NOT EXISTS xp INTEGER",
+    "ALTER TABLE user_graph_state ADD COLUMN IF NOT EXISTS xp_graph_version INTEGER",
+    "ALTER TABLE badges ADD COLUMN IF NOT EXISTS metric TEXT",
+    "ALTER TABLE badges ADD COLUMN IF NOT EXISTS threshold INTEGER",
+    # Superseded by the composite (graph_id, pk) index, see INTEGER_KEY_MIGRATION
+    "DROP INDEX IF EXISTS ix_nodes_graph_id",
+]
+
+# Idempotent DDL on the integer key columns, applied after INTEGER_KEY_MIGRATION.
+KEY_INDEX_MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS ix_user_node_status_progress ON user_node_status "
+    "(user_id, node_pk) INCLUDE (percent_complete, unlocked, discovered)",
+    # Superseded by ix_user_node_status_progress, which leads with user_id
+    "DROP INDEX IF EXISTS ix_user_node_status_user_id",
+]
+
+# Converts nodes and exercises from text primary keys to integer surrogate keys.
+# The text ids stay as unique external identifiers; every table referencing them
+# switches to an integer column. Runs once, in the migration's transaction.
+INTEGER_KEY_MIGRATION = [
+    # Surrogate keys; SERIAL numbers the existing rows
+    "ALTER TABLE nodes ADD COLUMN pk SERIAL",
+    "ALTER TABLE exercises ADD COLUMN pk SERIAL",
+    # Integer references, filled from the text ones
+    "ALTER TABLE exercises ADD COLUMN node_pk INTEGER",
+    "UPDATE exercises e SET node_pk = n.pk FROM nodes n WHERE n.id = e.node_id",
+    "ALTER TABLE node_relationships ADD COLUMN parent_pk INTEGER, ADD COLUMN child_pk INTEGER",
+    "UPDATE node_relationships r SET parent_pk = p.pk, child_pk = c.pk FROM nodes p, nodes c "
+    "WHERE p.id = r.parent_node_id AND c.id = r.child_node_id",
+    "ALTER TABLE exercise_category_map ADD COLUMN exercise_pk INTEGER",
+    "UPDATE exercise_category_map m SET exercise_pk = e.pk FROM exercises e WHERE e.id = m.exercise_id",
+    "ALTER TABLE user_exercise_completion ADD COLUMN exercise_pk INTEGER",
+    "UPDATE user_exercise_completion c SET exercise_pk = e.pk FROM exercises e WHERE e.id = c.exercise_id",
+    "ALTER TABLE user_node_status ADD COLUMN node_pk INTEGER",
+    "UPDATE user_node_status s SET node_pk = n.pk FROM nodes n WHERE n.id = s.node_id",
+    # Dropping the text references also drops their foreign keys, unique constraints and indexes
+    "ALTER TABLE exercises DROP COLUMN node_id",
+    "ALTER TABLE node_relationships DROP COLUMN parent_node_id, DROP COLUMN child_node_id",
+    "ALTER TABLE exercise_category_map DROP COLUMN exercise_id",
+    "ALTER TABLE user_exercise_completion DROP COLUMN exercise_id",
+    "ALTER TABLE user_node_status DROP COLUMN node_id",
+    "DROP INDEX IF EXISTS ix_nodes_graph_id_id",
+    # Swap the primary keys
+    "ALTER TABLE nodes DROP CONSTRAINT nodes_pkey, ADD PRIMARY KEY (pk), ADD CONSTRAINT nodes_id_key UNIQUE (id)",
+    "ALTER TABLE exercises DROP CONSTRAINT exercises_pkey, ADD PRIMARY KEY (pk), "
+    "ADD CONSTRAINT exercises_id_key UNIQUE (id)",
+    # Constraints and indexes of the integer references, as declared in models.py
+    "ALTER TABLE exercises ALTER COLUMN node_pk SET NOT NULL, ADD FOREIGN KEY (node_pk) REFERENCES nodes (pk)",
+    "CREATE INDEX ix_nodes_graph_id_pk ON nodes (graph_id, pk)",
+    "CREATE INDEX ix_exercises_node_pk_pk ON exercises (node_pk, pk)",
+    "ALTER TABLE node_relationships ALTER COLUMN parent_pk SET NOT NULL, ALTER COLUMN child_pk SET NOT NULL, "
+    "ADD FOREIGN KEY (parent_pk) REFERENCES nodes (pk), ADD FOREIGN KEY (child_pk) REFERENCES nodes (pk)",
+    "CREATE INDEX ix_node_relationships_parent_pk ON node_relationships (parent_pk)",
+    "CREATE INDEX ix_node_relationships_child_pk ON node_relationships (child_pk)",
+    "ALTER TABLE exercise_category_map ALTER COLUMN exercise_pk SET NOT NULL, "
+    "ADD FOREIGN KEY (exercise_pk) REFERENCES exercises (pk), "
+    "ADD CONSTRAINT uq_exercise_category UNIQUE (exercise_pk, category_id)",
+    "CREATE INDEX ix_exercise_category_map_exercise_pk ON exercise_category_map (exercise_pk)",
+    "ALTER TABLE user_exercise_completion ALTER COLUMN exercise_pk SET NOT NULL, "
+    "ADD FOREIGN KEY (exercise_pk) REFERENCES exercises (pk), "
+    "ADD CONSTRAINT uq_user_exercise UNIQUE (user_id, exercise_pk)",
+    "CREATE INDEX ix_user_exercise_completion_exercise_pk ON user_exercise_completion (exercise_pk)",
+    "ALTER TABLE user_node_status ALTER COLUMN node_pk SET NOT NULL, "
+    "ADD FOREIGN KEY (node_pk) REFERENCES nodes (pk), ADD CONSTRAINT uq_user_node UNIQUE (user_id, node_pk)",
+    "CREATE INDEX ix_user_node_status_node_pk ON user_node_status (node_pk)",
+    # Cached static graphs carry the keys: make every process reload them
+    "UPDATE graphs SET version = version + 1",
+]
+
+def migrate_schema():
+    """Applies schema additions to an existing database."""
+    print("Migrating schema...")
+    # Tables added after the initial schema (user_graph_state, leaderboard_scores)
+    # must exist before SCHEMA_MIGRATIONS alters them; existing tables are left alone
+    db.create_all()
+    for statement in SCHEMA_MIGRATIONS:
+        db.session.execute(text(statement))
+    print(f"+ Applied {len(SCHEMA_MIGRATIONS)} schema statements.")
+
+    has_integer_keys = db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = 'nodes' AND column_name = 'pk'"
+    )).first()
+    if has_integer_keys:
+        print("- Nodes and exercises already have integer keys.")
+    else:
+        for statement in INTEGER_KEY_MIGRATION:
+            db.session.execute(text(statement))
+        print(f"+ Converted nodes and exercises to integer keys ({len(INTEGER_KEY_MIGRATION)} statements).")
+    for statement in KEY_INDEX_MIGRATIONS:
+        db.session.execute(text(statement))
+    print(f"+ Applied {len(KEY_INDEX_MIGRATIONS)} index statements.")
+
 def migrate_graphs():
     """Creates entries for the known graphs."""
     print("Migrating graphs...")
@@ -129,20 +230,24 @@ def migrate_nodes_and_exercises():
     exercise_category_mappings = [] # Store tuples (exercise_id, category_name)
     existing_categories = {cat.name: cat.category_id for cat in ExerciseCategory.query.all()}
     categories_to_add = {} # name -> ExerciseCategory object
+    # Nodes and exercises by their external id; references use their integer keys
+    nodes_by_id = {node.id: node for node in Node.query.all()}
+    exercises_by_id = {ex.id: ex for ex in Exercise.query.all()}
 
     for node_json in all_node_data:
         node_id = node_json['id']
         # Create Node object
-        existing_node = db.session.get(Node, node_id)
+        existing_node = nodes_by_id.get(node_id)
         if not existing_node:
-            nodes_to_add.append(Node(
+            nodes_by_id[node_id] = Node(
                 id=node_id,
                 graph_id=node_json['graph_id'],
                 title=node_json.get('title', 'Untitled Node'),
                 type=node_json.get('type', 'sub'),
                 popup_text=node_json.get('popup', {}).get('text'),
                 pdf_link=node_json.get('popup', {}).get('pdf_link')
-            ))
+            )
+            nodes_to_add.append(nodes_by_id[node_id])
         else:
              # Optionally update existing nodes if needed
              pass
@@ -151,15 +256,16 @@ def migrate_nodes_and_exercises():
         for ex_json in node_json.get('popup', {}).get('exercises', []):
             ex_id = ex_json.get('id')
             if not ex_id: continue
-            existing_ex = db.session.get(Exercise, ex_id)
+            existing_ex = exercises_by_id.get(ex_id)
             if not existing_ex:
-                exercises_to_add.append(Exercise(
+                exercises_by_id[ex_id] = Exercise(
                     id=ex_id,
-                    node_id=node_id,
+                    node=nodes_by_id[node_id],
                     label=ex_json.get('label', 'Exercise'),
                     points=ex_json.get('points', 10),
                     optional=ex_json.get('optional', False)
-                ))
+                )
+                exercises_to_add.append(exercises_by_id[ex_id])
                 # Handle categories for the new exercise
                 for cat_name in ex_json.get('categories', []):
                     if cat_name not in existing_categories and cat_name not in categories_to_add:
@@ -193,7 +299,7 @@ def migrate_nodes_and_exercises():
     if exercises_to_add:
         db.session.add_all(exercises_to_add)
         print(f"+ Added {len(exercises_to_add)} new exercises.")
-        db.session.flush()
+    db.session.flush() # Assigns the integer keys of the new nodes and exercises
 
     # Add exercise category mappings (handle potential duplicates if script run multiple times)
     print(f"  Processing {len(exercise_category_mappings)} exercise-category links...")
@@ -205,14 +311,14 @@ def migrate_nodes_and_exercises():
          if cat_id:
              # Check if mapping already exists might be needed depending on DB/ORM
              # For bulk insert, rely on UNIQUE constraint and IGNORE/ON CONFLICT
-             mappings_to_insert.append({'exercise_id': ex_id, 'category_id': cat_id})
+             mappings_to_insert.append({'exercise_pk': exercises_by_id[ex_id].pk, 'category_id': cat_id})
              processed_mapping_links += 1
          else:
              print(f"Warning: Category ID not found for '{cat_name}' when mapping exercise '{ex_id}'.")
     if mappings_to_insert:
         stmt = pg_insert(exercise_category_map).values(mappings_to_insert)
         stmt = stmt.on_conflict_do_nothing(
-            index_elements=['exercise_id', 'category_id'] 
+            index_elements=['exercise_pk', 'category_id'] 
         )
         db.session.execute(stmt) 
         print(f"+ Added/Ignored {processed_mapping_links} exercise-category mappings.")
@@ -220,30 +326,36 @@ def migrate_nodes_and_exercises():
     # Add relationships (handle potential duplicates)
     print(f"  Processing {len(relationships_to_add)} relationships...")
     rel_added_count = 0
+    existing_relationships = set(db.session.query(
+        NodeRelationship.parent_pk, NodeRelationship.child_pk, NodeRelationship.relationship_type
+    ).all())
     for rel in relationships_to_add:
-         # Check if relationship already exists
-        exists = NodeRelationship.query.filter_by(
-            parent_node_id=rel['parent'],
-            child_node_id=rel['child'],
-            relationship_type=rel['type']
-        ).first()
-        if not exists:
-             # Ensure parent and child nodes actually exist in the DB before adding rel
-             # Using get() is efficient if nodes were flushed or already committed
-            parent_exists = db.session.get(Node, rel['parent']) is not None
-            child_exists = db.session.get(Node, rel['child']) is not None
-            if parent_exists and child_exists:
-                 db.session.add(NodeRelationship(
-                     parent_node_id=rel['parent'],
-                     child_node_id=rel['child'],
-                     relationship_type=rel['type']
-                 ))
-                 rel_added_count += 1
-            else:
-                 print(f"Warning: Skipping relationship {rel['parent']} -> {rel['child']} ({rel['type']}) due to missing node.")
+        # Ensure parent and child nodes actually exist in the DB before adding rel
+        parent, child = nodes_by_id.get(rel['parent']), nodes_by_id.get(rel['child'])
+        if parent is None or child is None:
+            print(f"Warning: Skipping relationship {rel['parent']} -> {rel['child']} ({rel['type']}) due to missing node.")
+            continue
+        # Check if relationship already exists
+        key = (parent.pk, child.pk, rel['type'])
+        if key not in existing_relationships:
+            existing_relationships.add(key)
+            db.session.add(NodeRelationship(
+                parent_pk=parent.pk,
+                child_pk=child.pk,
+                relationship_type=rel['type']
+            ))
+            rel_added_count += 1
 
     print(f"+ Added {rel_added_count} new relationships.")
 
+    if nodes_to_add or exercises_to_add or rel_added_count:
+        # Make running app processes reload their cached static graphs
+        touched_graph_ids = {node_json['graph_id'] for node_json in all_node_data}
+        Graph.query.filter(Graph.id.in_(touched_graph_ids)).update(
+            {Graph.version: Graph.version + 1}, synchronize_session=False
+        )
+        print(f"+ Bumped version of {len(touched_graph_ids)} graphs.")
+
 
 
 def migrate_ctfs():
@@ -300,16 +412,27 @@ def migrate_badges():
 
     for badge_def in dynamic_badge_defs:
         existing = db.session.get(Badge, badge_def['id'])
+        metric, threshold = rule_from_badge_id(badge_def['id'])
         if not existing:
             badges_to_add.append(Badge(
                 id=badge_def['id'],
                 title=badge_def['title'],
                 description=badge_def['desc'],
-                image_path=badge_def['img']
+                image_path=badge_def['img'],
+                metric=metric,
+                threshold=threshold
             ))
         else:
              print(f"- Badge '{badge_def['id']}' already exists.")
 
+    # Badges created before award rules were stored get theirs from the id convention
+    backfilled = 0
+    for badge in Badge.query.filter(Badge.metric.is_(None)).all():
+        badge.metric, badge.threshold = rule_from_badge_id(badge.id)
+        backfilled += badge.metric is not None
+    if backfilled:
+        print(f"+ Filled in the award rule of {backfilled} existing Badges.")
+
     if badges_to_add:
         db.session.add_all(badges_to_add)
         print(f"+ Added {len(badges_to_add)} new Badges.")
@@ -337,6 +460,9 @@ if __name__ == "__main__":
         # Graph.query.delete()
         # db.session.commit()
 
+        migrate_schema()
+        db.session.commit() # Commit after schema changes
+
         migrate_graphs()
         db.session.commit() # Commit after graph creation
 
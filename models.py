@@ -20,6 +20,9 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     highest_level_popup_shown = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped by every write to the user's progress (see core.data.bump_user_progress_version)
+    # so materialized /data snapshots know when they are stale.
+    progress_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     # Relationships
     exercise_completions = db.relationship(
@@ -60,14 +63,18 @@ class Graph(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     description = db.Column(db.Text)
+    # Bumped on every write to the graph's nodes/exercises/relationships so
+    # per-process static caches know when to reload.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     nodes = db.relationship("Node", backref="graph", lazy=True)
 
 
 class Node(db.Model):
     __tablename__ = "nodes"
-    id = db.Column(
-        db.Text, primary_key=True
-    )  # Text primary keys might be less performant than integers for indexing/joins if very long/variable. Consider if UUIDs or integers are feasible.
+    # Integer surrogate key; every foreign key to a node references it
+    pk = db.Column(db.Integer, primary_key=True)
+    # External identifier (uuid hex or the JSON node id) used by the API, the editor and badge ids
+    id = db.Column(db.Text, unique=True, nullable=False)
     graph_id = db.Column(db.Integer, db.ForeignKey("graphs.id"), nullable=False)
     title = db.Column(db.Text, nullable=False)
     type = db.Column(db.String(10), nullable=False)
@@ -77,28 +84,28 @@ class Node(db.Model):
         "Exercise", backref="node", cascade="all, delete-orphan"
     )
 
-    # Add index for graph_id foreign key
-    __table_args__ = (Index("ix_nodes_graph_id", "graph_id"),)
+    # Index for the graph_id foreign key; including pk lets per-graph joins be answered from the index
+    __table_args__ = (Index("ix_nodes_graph_id_pk", "graph_id", "pk"),)
 
 
 # Junction table for node relationships
 class NodeRelationship(db.Model):
     __tablename__ = "node_relationships"
     relationship_id = db.Column(db.Integer, primary_key=True)
-    parent_node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
-    child_node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    parent_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
+    child_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     relationship_type = db.Column(
         db.String(15), nullable=False
     )  # 'CHILD' or 'PREREQUISITE'
 
     parent_node = db.relationship(
         "Node",
-        foreign_keys=[parent_node_id],
+        foreign_keys=[parent_pk],
         backref=db.backref("child_links", lazy="dynamic", cascade="all, delete-orphan"),
     )
     child_node = db.relationship(
         "Node",
-        foreign_keys=[child_node_id],
+        foreign_keys=[child_pk],
         backref=db.backref(
             "parent_links", lazy="dynamic", cascade="all, delete-orphan"
         ),
@@ -106,15 +113,17 @@ class NodeRelationship(db.Model):
 
     # Add indexes for foreign keys used in joins/lookups
     __table_args__ = (
-        Index("ix_node_relationships_parent_id", "parent_node_id"),
-        Index("ix_node_relationships_child_id", "child_node_id"),
+        Index("ix_node_relationships_parent_pk", "parent_pk"),
+        Index("ix_node_relationships_child_pk", "child_pk"),
     )
 
 
 class Exercise(db.Model):
     __tablename__ = "exercises"
-    id = db.Column(db.Text, primary_key=True)  # Consider integer/UUID if possible
-    node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    # Integer surrogate key, see Node
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Text, unique=True, nullable=False)
+    node_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     label = db.Column(db.Text, nullable=False)
     points = db.Column(db.Integer, default=10)
     optional = db.Column(db.Boolean, default=False)
@@ -124,8 +133,8 @@ class Exercise(db.Model):
         backref=db.backref("exercises", lazy="dynamic"),
     )
 
-    # Add index for node_id foreign key
-    __table_args__ = (Index("ix_exercises_node_id", "node_id"),)
+    # Index for the node_pk foreign key; including pk lets per-graph joins be answered from the index
+    __table_args__ = (Index("ix_exercises_node_pk_pk", "node_pk", "pk"),)
 
 
 class ExerciseCategory(db.Model):
@@ -139,16 +148,16 @@ exercise_category_map = db.Table(
     "exercise_category_map",
     db.metadata,
     db.Column("map_id", db.Integer, primary_key=True),
-    db.Column("exercise_id", db.Text, db.ForeignKey("exercises.id"), nullable=False),
+    db.Column("exercise_pk", db.Integer, db.ForeignKey("exercises.pk"), nullable=False),
     db.Column(
         "category_id",
         db.Integer,
         db.ForeignKey("exercise_categories.category_id"),
         nullable=False,
     ),
-    db.UniqueConstraint("exercise_id", "category_id", name="uq_exercise_category"),
+    db.UniqueConstraint("exercise_pk", "category_id", name="uq_exercise_category"),
     # Add individual indexes for lookups via either side
-    Index("ix_exercise_category_map_exercise_id", "exercise_id"),
+    Index("ix_exercise_category_map_exercise_pk", "exercise_pk"),
     Index("ix_exercise_category_map_category_id", "category_id"),
 )
 
@@ -167,6 +176,10 @@ class Badge(db.Model):
     title = db.Column(db.Text, nullable=False)
     description = db.Column(db.Text)
     image_path = db.Column(db.Text)
+    # Award rule (see core.badges.BadgeRules): earned once the user's `metric`
+    # reaches `threshold`. For 'main' badges the node is the id's 'main-' suffix.
+    metric = db.Column(db.Text)
+    threshold = db.Column(db.Integer)
 
 
 # --- User Progress Tables ---
@@ -176,13 +189,13 @@ class UserExerciseCompletion(db.Model):
     __tablename__ = "user_exercise_completion"
     completion_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    exercise_id = db.Column(db.Text, db.ForeignKey("exercises.id"), nullable=False)
+    exercise_pk = db.Column(db.Integer, db.ForeignKey("exercises.pk"), nullable=False)
     completed_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     __table_args__ = (
-        db.UniqueConstraint("user_id", "exercise_id", name="uq_user_exercise"),
+        db.UniqueConstraint("user_id", "exercise_pk", name="uq_user_exercise"),
         # Add individual indexes (even if covered by unique, sometimes useful depending on query)
         Index("ix_user_exercise_completion_user_id", "user_id"),
-        Index("ix_user_exercise_completion_exercise_id", "exercise_id"),
+        Index("ix_user_exercise_completion_exercise_pk", "exercise_pk"),
     )
 
 
@@ -229,14 +242,76 @@ class UserNodeStatus(db.Model):
     __tablename__ = "user_node_status"
     status_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    node_id = db.Column(db.Text, db.ForeignKey("nodes.id"), nullable=False)
+    node_pk = db.Column(db.Integer, db.ForeignKey("nodes.pk"), nullable=False)
     unlocked = db.Column(db.Boolean, default=False)
     discovered = db.Column(db.Boolean, default=False)
     percent_complete = db.Column(db.Integer, default=0)
     user_notes = db.Column(db.Text)
     __table_args__ = (
-        db.UniqueConstraint("user_id", "node_id", name="uq_user_node"),
-        Index("ix_user_node_status_user_id", "user_id"),
-        Index("ix_user_node_status_node_id", "node_id"),
+        db.UniqueConstraint("user_id", "node_pk", name="uq_user_node"),
+        # Covers get_user_progress, so on PostgreSQL the user's statuses in a
+        # graph are an index-only scan. user_notes is left out: it is unbounded
+        # text, and B-tree entries are limited to about a third of a page
+        Index(
+            "ix_user_node_status_progress",
+            "user_id",
+            "node_pk",
+            postgresql_include=["percent_complete", "unlocked", "discovered"],
+        ),
+        Index("ix_user_node_status_node_pk", "node_pk"),
     )
     node = db.relationship("Node", backref=db.backref("user_statuses", lazy=True))
+
+
+class UserGraphState(db.Model):
+    __tablename__ = "user_graph_state"
+    state_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    graph_id = db.Column(db.Integer, db.ForeignKey("graphs.id"), nullable=False)
+    # Graph version the user's stored node statuses (percent/unlocked/discovered)
+    # were derived from. Incremental updates are only valid while it matches.
+    derived_graph_version = db.Column(db.Integer, nullable=False, default=0)
+    # Materialized GET /data response (UTF-8 JSON), valid only for the graph
+    # and user progress versions it was built from.
+    snapshot = db.Column(db.LargeBinary)
+    snapshot_graph_version = db.Column(db.Integer)
+    snapshot_progress_version = db.Column(db.Integer)
+    # Opt-in compact copy of the user's completed exercises in the graph (see
+    # core.data.COMPLETION_BITMAPS): bit i is exercise ordinal i of the compiled
+    # graph. Valid only for the graph version it was built from.
+    completion_bitmap = db.Column(db.LargeBinary)
+    completion_bitmap_version = db.Column(db.Integer)
+    # XP counted for levels in this graph (see core.badges.graph_xp), kept up
+    # to date by the exercise and CTF write paths. NULL until first computed.
+    # Valid only for the graph version it was computed for, since graph edits
+    # can change exercise points or optional flags.
+    xp = db.Column(db.Integer)
+    xp_graph_version = db.Column(db.Integer)
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "graph_id", name="uq_user_graph_state"),
+        Index("ix_user_graph_state_user_id", "user_id"),
+    )
+
+
+class LeaderboardScore(db.Model):
+    __tablename__ = "leaderboard_scores"
+    score_id = db.Column(db.Integer, primary_key=True)
+    # 'global', 'graph:<graph_id>' or 'category:<name>' (see core.leaderboard)
+    board = db.Column(db.Text, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    # Counters kept up to date by the completion writes and the editor's exercise changes
+    xp = db.Column(db.Integer, nullable=False, default=0)
+    completions = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint("board", "user_id", name="uq_leaderboard_score"),
+        Index("ix_leaderboard_scores_user_id", "user_id"),
+    )
+
+
+# Ranking order of a board: top-K is a range scan, a rank a range count
+Index(
+    "ix_leaderboard_scores_rank",
+    LeaderboardScore.board,
+    LeaderboardScore.xp.desc(),
+    LeaderboardScore.user_id,
+)
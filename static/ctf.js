@@ -1,3 +1,5 @@
+import { applyStateDelta, fetchState } from './state.js';
+
 export function setupCtfHandlers() {
 
     // Make updateCtf globally available
@@ -33,7 +35,7 @@ export function setupCtfHandlers() {
       console.log(`Attempting to update CTF ${targetCtf.id} count to ${newCount}`);
   
       // --- Step 1: POST the intended update (full list) ---
-      fetch(`/ctfs?graph=${selectedGraph}`, {
+      fetch(`/ctfs?graph=${selectedGraph}&delta=1`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(ctfPayload) // Send the calculated intended state
@@ -47,18 +49,14 @@ export function setupCtfHandlers() {
       })
       .then(data => {
           if (data.status === 'ok') {
-              // --- Step 2: POST successful, now GET the updated state ---
-              console.log(`CTF update for index ${ctfIndex} confirmed. Fetching updated state...`);
-              return fetch(`/data?graph=${selectedGraph}`); // Chain the GET request
+              // --- Step 2: POST successful, apply the returned delta (or GET the state) ---
+              console.log(`CTF update for index ${ctfIndex} confirmed. Applying updated state...`);
+              return data.delta ? applyStateDelta(window.currentAppState, data.delta) : fetchState(selectedGraph);
           } else {
               throw new Error(data.error || "Unknown error saving CTF status");
           }
       })
-      .then(res => { // Handle the response from the GET request
-          if (!res.ok) { throw new Error(`State refresh error: ${res.statusText}`); }
-          return res.json();
-      })
-      .then(newState => { // newState is the full state from the GET request
+      .then(newState => { // newState is the full updated state
           console.log(`Updated state received after CTF update. Dispatching appDataUpdated.`);
           // Dispatch event with the NEW state from the GET request
           new Audio('/static/check.mp3').play();
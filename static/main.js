@@ -97,9 +97,9 @@ function updateUI(newState) {
         discoveredSet           // Pass the discovered Set
     );
 
-    // Update the sidebar content using data from newState
-    const currentXP = calculateTotalXP(newState.nodes, newState.ctfs);
-    const currentLevel = calculateLevelFromXP(currentXP); // Use the function defined above
+    // Update the sidebar content using data from newState (XP and level come from the server; older snapshots may lack them)
+    const currentXP = newState.xp ?? calculateTotalXP(newState.nodes, newState.ctfs);
+    const currentLevel = newState.level ?? calculateLevelFromXP(currentXP);
     updateSidebar( newState.nodes, newState.streak, newState.ctfs, discoveredSet, currentXP, currentLevel ); // Pass XP and level
 
 
@@ -150,8 +150,9 @@ fetch(`/data?graph=${selectedGraph}`)
     if (initialData === null) {
         return; // Exit if we were redirected
     }
-    const initialXP = calculateTotalXP(initialData.nodes, initialData.ctfs);
-    previousLevel = calculateLevelFromXP(initialXP); // Set initial previous level
+    // The server sends XP and level (numbered like highest_level_popup_shown); older snapshots may not
+    const initialXP = initialData.xp ?? calculateTotalXP(initialData.nodes, initialData.ctfs);
+    previousLevel = initialData.level ?? calculateLevelFromXP(initialXP); // Set initial previous level
     
     // Store initial state
     window.currentAppState = {
@@ -200,8 +201,8 @@ fetch(`/data?graph=${selectedGraph}`)
             const newState = event.detail;
 
             // --- Level Up Check ---
-            const newXP = calculateTotalXP(newState.nodes, newState.ctfs);
-            const newLevel = calculateLevelFromXP(newXP);
+            const newXP = newState.xp ?? calculateTotalXP(newState.nodes, newState.ctfs);
+            const newLevel = newState.level ?? calculateLevelFromXP(newXP);
             const highestShown = newState.highest_level_popup_shown || 0;
 
             if (newLevel > previousLevel && newLevel > highestShown) {
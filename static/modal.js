@@ -1,3 +1,5 @@
+import { applyStateDelta, fetchState } from './state.js';
+
 const urlParams = new URLSearchParams(window.location.search);
 let selectedGraph = urlParams.get('graph') || 'x'; // Get from URL or default to 'x'
 
@@ -98,7 +100,7 @@ export function initModal(/* Remove nodes, unlocked params if relying on global
                 notesSaveStatus.textContent = "Saving...";
 
                 // --- Step 1: POST the update ---
-                fetch(`/data?graph=${selectedGraph}`, {
+                fetch(`/data?graph=${selectedGraph}&delta=1`, {
                     method: 'POST', headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify(notesPayload)
                 })
@@ -108,19 +110,18 @@ export function initModal(/* Remove nodes, unlocked params if relying on global
                 })
                 .then(data => {
                     if (data.status === 'ok') {
-                        // --- Step 2: POST successful, now GET the updated state ---
-                        console.log("Notes update confirmed. Fetching updated state...");
+                        // --- Step 2: POST successful, apply the returned delta (or GET the state) ---
+                        console.log("Notes update confirmed. Applying updated state...");
+                        if (data.delta) {
+                            return applyStateDelta(window.currentAppState, data.delta);
+                        }
                         notesSaveStatus.textContent = "Refreshing..."; // Indicate refresh
-                        return fetch(`/data?graph=${selectedGraph}`); // Chain the GET request
+                        return fetchState(selectedGraph);
                     } else {
                         throw new Error(data.error || "Unknown error saving notes");
                     }
                  })
-                 .then(res => { // Handle the response from the GET request
-                     if (!res.ok) { throw new Error(`State refresh error: ${res.statusText}`); }
-                     return res.json();
-                 })
-                 .then(newState => { // newState is the full state from the GET request
+                 .then(newState => { // newState is the full updated state
                      console.log("Updated state received after notes save. Dispatching update.");
                      notesSaveStatus.textContent = "Saved!";
                      // Dispatch event with the NEW state from the GET request
@@ -165,7 +166,7 @@ function handleCheckboxChange(event) {
   let selectedGraph = urlParams.get('graph') || 'x';
 
   // --- Step 1: POST the update ---
-  fetch(`/data?graph=${selectedGraph}`, {
+  fetch(`/data?graph=${selectedGraph}&delta=1`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(updatePayload)
@@ -179,18 +180,14 @@ function handleCheckboxChange(event) {
   })
   .then(data => {
       if (data.status === 'ok') {
-          // --- Step 2: POST successful, now GET the updated state ---
-          console.log(`Exercise ${exerciseId} update confirmed. Fetching updated state...`);
-          return fetch(`/data?graph=${selectedGraph}`); // Chain the GET request
+          // --- Step 2: POST successful, apply the returned delta (or GET the state) ---
+          console.log(`Exercise ${exerciseId} update confirmed. Applying updated state...`);
+          return data.delta ? applyStateDelta(window.currentAppState, data.delta) : fetchState(selectedGraph);
       } else {
           throw new Error(data.error || "Unknown error saving exercise status");
       }
   })
-  .then(res => { // Handle the response from the GET request
-      if (!res.ok) { throw new Error(`State refresh error: ${res.statusText}`); }
-      return res.json();
-  })
-  .then(newState => { // newState is the full state from the GET request
+  .then(newState => { // newState is the full updated state
       // Backend successfully processed POST and returned the updated state via GET
       console.log("Updated state received. Dispatching appDataUpdated event.");
       // Dispatch event with the NEW state from the GET request
@@ -0,0 +1,42 @@
+// Merges a delta returned by POST /data or POST /ctfs (with ?delta=1) into a
+// full app state, giving the same state a follow-up GET /data would return.
+export function applyStateDelta(state, delta) {
+  const nodes = state.nodes.map(node => {
+    const changes = delta.nodes[node.id];
+    if (!changes) return node;
+    return { ...node, ...changes, popup: { ...node.popup, ...(changes.popup || {}) } };
+  });
+
+  const unlocked = { ...state.unlocked };
+  for (const [nodeId, isUnlocked] of Object.entries(delta.unlocked)) {
+    if (isUnlocked) { unlocked[nodeId] = true; } else { delete unlocked[nodeId]; }
+  }
+
+  const discovered = new Set(state.discovered);
+  for (const [nodeId, isDiscovered] of Object.entries(delta.discovered)) {
+    if (isDiscovered) { discovered.add(nodeId); } else { discovered.delete(nodeId); }
+  }
+
+  const changedCtfs = new Map(delta.ctfs.map(ctf => [ctf.id, ctf]));
+
+  return {
+    ...state,
+    nodes,
+    unlocked,
+    discovered: [...discovered],
+    ctfs: state.ctfs.map(ctf => changedCtfs.get(ctf.id) || ctf),
+    badges: [...state.badges, ...delta.new_badges],
+    abilities: delta.abilities,
+    streak: delta.streak,
+    xp: delta.xp,
+    level: delta.level,
+  };
+}
+
+// Full state refresh, for POST responses that carry no delta
+export function fetchState(graph) {
+  return fetch(`/data?graph=${graph}`).then(res => {
+    if (!res.ok) { throw new Error(`State refresh error: ${res.statusText}`); }
+    return res.json();
+  });
+}
@@ -1,5 +1,6 @@
 import pytest
 from flask import Flask
+from sqlalchemy import event
 from models import db as original_db
 #
 @pytest.fixture(scope='session') 
@@ -15,8 +16,27 @@ def test_app():
         original_db.create_all()
         yield app
         original_db.session.remove()
+
+
 @pytest.fixture(scope='function')
 def db_session(test_app):
     with test_app.app_context():
         yield original_db.session
-        original_db.session.rollback() 
\ No newline at end of file
+        original_db.session.rollback()
+
+
+@pytest.fixture(scope='function')
+def count_statements(db_session):
+    """Returns count_statements(func, *args, **kwargs) -> (func's result, SQL statements it executed)."""
+    def count_statements(func, *args, **kwargs):
+        statements = []
+        def record(conn, cursor, statement, *rest):
+            statements.append(statement)
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        return result, statements
+    return count_statements
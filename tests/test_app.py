@@ -0,0 +1,325 @@
+# test_app.py
+import os
+import itertools
+import pytest
+
+# The app reads its database from the environment at import time
+os.environ["DATABASE_URL"] = "sqlite:///:memory:"
+import app as app_module
+
+from core import data as core_data
+from core import nodes as core_nodes
+from core import badges as core_badges
+from core import parallel as core_parallel
+from core.ctfs import CTF_XP
+from models import db, User, Graph, Node, Exercise, NodeRelationship, UserGraphState, Ctf, Badge
+
+# --- Test Data ---
+GRAPH_X = (901, "rt_x")
+GRAPH_Y = (902, "rt_y")
+_user_ids = itertools.count(1)
+
+# --- Helper Functions ---
+
+def seed(db_session):
+    """
+    Graph rt_x: M1 -> S1 (e1, e2) -> S2 (e3); graph rt_y: a single sub node
+    (y_e1). One CTF, and badges for the first exercise and the first CTF.
+    """
+    db_session.add_all([Graph(id=GRAPH_X[0], name=GRAPH_X[1]), Graph(id=GRAPH_Y[0], name=GRAPH_Y[1])])
+    nodes = {
+        "x_M1": Node(id="x_M1", graph_id=GRAPH_X[0], title="M1", type="main"),
+        "x_S1": Node(id="x_S1", graph_id=GRAPH_X[0], title="S1", type="sub"),
+        "x_S2": Node(id="x_S2", graph_id=GRAPH_X[0], title="S2", type="sub"),
+        "y_S1": Node(id="y_S1", graph_id=GRAPH_Y[0], title="S1", type="sub"),
+    }
+    db_session.add_all(nodes.values())
+    db_session.flush()
+    for exercise_id, node_id in [("x_e1", "x_S1"), ("x_e2", "x_S1"), ("x_e3", "x_S2"), ("y_e1", "y_S1")]:
+        db_session.add(Exercise(id=exercise_id, node=nodes[node_id], label=exercise_id, points=10))
+    for parent, child in [("x_M1", "x_S1"), ("x_S1", "x_S2")]:
+        db_session.add(NodeRelationship(
+            parent_pk=nodes[parent].pk, child_pk=nodes[child].pk, relationship_type="CHILD"))
+    db_session.add(Ctf(id=1, title="CTF 1"))
+    for badge_id in ("exercises-1", "ctf-1"):
+        metric, threshold = core_badges.rule_from_badge_id(badge_id)
+        db_session.add(Badge(id=badge_id, title=badge_id, metric=metric, threshold=threshold))
+    db_session.commit()
+
+def reset_caches():
+    core_data.invalidate_static_graph_cache()
+    core_nodes.invalidate_state_memo()
+    core_badges.invalidate_badge_rules()
+    app_module._static_definitions_cache.invalidate()
+
+@pytest.fixture(scope='module')
+def flask_app():
+    flask_app = app_module.app
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        seed(db.session)
+    reset_caches()
+    yield flask_app
+    reset_caches()
+
+@pytest.fixture
+def login(flask_app):
+    """Creates a new user and returns a test client logged in as them."""
+    def login():
+        user_id = next(_user_ids)
+        with flask_app.app_context():
+            user = User(id=user_id, username=f"rt{user_id}", email=f"rt{user_id}@test.com")
+            user.set_password("pw")
+            db.session.add(user)
+            db.session.commit()
+        client = flask_app.test_client()
+        response = client.post("/login", data={"username": f"rt{user_id}", "password": "pw"})
+        assert response.status_code == 302
+        client.user_id = user_id
+        return client
+    return login
+
+def snapshot_versions(flask_app, user_id, graph_id):
+    """(snapshot graph version, snapshot progress version, user's progress version)."""
+    with flask_app.app_context():
+        state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+        progress_version = db.session.get(User, user_id).progress_version
+        if state is None or state.snapshot is None:
+            return None, None, progress_version
+        return state.snapshot_graph_version, state.snapshot_progress_version, progress_version
+
+def xp_counter(flask_app, user_id, graph_id):
+    """(XP counter, graph version it was computed for) of the user's state row."""
+    with flask_app.app_context():
+        state = UserGraphState.query.filter_by(user_id=user_id, graph_id=graph_id).first()
+        return state.xp, state.xp_graph_version
+
+def toggle(client, exercise_id, completed=True, graph=GRAPH_X[1], delta=False):
+    url = f"/data?graph={graph}" + ("&delta=1" if delta else "")
+    return client.post(url, json={"exercise_update": {"exercise_id": exercise_id, "completed": completed}})
+
+# --- Tests for state snapshots ---
+
+def test_get_does_not_write(flask_app, login):
+    client = login()
+    first = client.get(f"/data?graph={GRAPH_X[1]}")
+    assert first.status_code == 200
+    assert snapshot_versions(flask_app, client.user_id, GRAPH_X[0])[:2] == (None, None)
+    assert client.get(f"/data?graph={GRAPH_X[1]}").get_data() == first.get_data()
+
+def test_mutation_rebuilds_every_stale_snapshot(flask_app, login):
+    client = login()
+    toggle(client, "y_e1", graph=GRAPH_Y[1])
+    assert toggle(client, "x_e1").status_code == 200
+
+    for graph_id in (GRAPH_X[0], GRAPH_Y[0]):
+        _, snapshot_progress, progress = snapshot_versions(flask_app, client.user_id, graph_id)
+        assert snapshot_progress == progress
+    assert client.get(f"/data?graph={GRAPH_Y[1]}").get_json()['xp'] == 10
+
+def test_login_rebuilds_snapshots_of_edited_graphs(flask_app, login):
+    client = login()
+    toggle(client, "y_e1", graph=GRAPH_Y[1])
+    toggle(client, "x_e1")
+    with flask_app.app_context():
+        core_data.bump_graph_version(GRAPH_Y[0])
+        db.session.commit()
+        graph_version = db.session.get(Graph, GRAPH_Y[0]).version
+    x_before = snapshot_versions(flask_app, client.user_id, GRAPH_X[0])
+    client.get("/logout")
+    client.post("/login", data={"username": f"rt{client.user_id}", "password": "pw"})
+    assert snapshot_versions(flask_app, client.user_id, GRAPH_X[0]) == x_before # Still current
+    assert snapshot_versions(flask_app, client.user_id, GRAPH_Y[0])[0] == graph_version
+
+# --- Tests for concurrent reads ---
+
+def test_warm_caches_never_use_the_pool(flask_app, login, monkeypatch):
+    client = login()
+    client.get(f"/data?graph={GRAPH_X[1]}") # Warms the static caches
+    submitted = []
+    monkeypatch.setattr(core_parallel, "CONCURRENT_QUERIES", True)
+    monkeypatch.setattr(core_parallel, "_get_executor", lambda: submitted.append(1))
+    assert client.get(f"/data?graph={GRAPH_X[1]}").status_code == 200
+    assert submitted == []
+
+# --- Tests for conditional GET /data ---
+
+def test_matching_etag_is_not_modified(login):
+    client = login()
+    first = client.get(f"/data?graph={GRAPH_X[1]}")
+    etag = first.headers["ETag"]
+    again = client.get(f"/data?graph={GRAPH_X[1]}", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == etag
+
+def test_response_varies_on_cookie(login):
+    client = login()
+    response = client.get(f"/data?graph={GRAPH_X[1]}")
+    assert "Cookie" in response.headers["Vary"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+def test_toggle_changes_etag(login):
+    client = login()
+    etag = client.get(f"/data?graph={GRAPH_X[1]}").headers["ETag"]
+    toggle(client, "x_e1")
+    response = client.get(f"/data?graph={GRAPH_X[1]}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_graph_version_bump_changes_etag(flask_app, login):
+    client = login()
+    etag = client.get(f"/data?graph={GRAPH_Y[1]}").headers["ETag"]
+    with flask_app.app_context():
+        core_data.bump_graph_version(GRAPH_Y[0])
+        db.session.commit()
+    response = client.get(f"/data?graph={GRAPH_Y[1]}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_other_user_gets_own_etag(login):
+    alice, bob = login(), login()
+    etag = alice.get(f"/data?graph={GRAPH_X[1]}").headers["ETag"]
+    response = bob.get(f"/data?graph={GRAPH_X[1]}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+# --- Tests for state deltas ---
+
+def make_state(**changes):
+    node = {'id': "S1", 'percent': 0, 'unlocked': True, 'discovered': True,
+            'popup': {'userNotes': "", 'exercises': [{'id': "e1", 'completed': False}]}}
+    state = {
+        'nodes': [node, {**node, 'id': "S2", 'unlocked': False, 'discovered': False}],
+        'links': [{'source': "S1", 'target': "S2"}],
+        'unlocked': {"Start": True, "S1": True},
+        'discovered': ["Start", "S1"],
+        'ctfs': [{'id': 1, 'title': "CTF 1", 'completed': 0}, {'id': 2, 'title': "CTF 2", 'completed': 1}],
+        'badges': [{'id': "old", 'shown': True}],
+        'abilities': {"CTFs": 1}, 'streak': {'streak': 1, 'last_used': ""}, 'xp': 0, 'level': 1,
+    }
+    state.update(changes)
+    return state
+
+def test_delta_of_identical_states_is_empty():
+    delta = app_module._state_delta(make_state(), make_state())
+    assert (delta['nodes'], delta['unlocked'], delta['discovered'], delta['new_badges'], delta['ctfs']) == (
+        {}, {}, {}, [], [])
+
+def test_delta_carries_changed_node_fields():
+    new = make_state()
+    new['nodes'][0] = {**new['nodes'][0], 'percent': 100,
+                       'popup': {'userNotes': "", 'exercises': [{'id': "e1", 'completed': True}]}}
+    new['nodes'][1] = {**new['nodes'][1], 'unlocked': True, 'discovered': True}
+    delta = app_module._state_delta(make_state(), new)
+    assert delta['nodes'] == {
+        "S1": {'percent': 100, 'popup': {'exercises': [{'id': "e1", 'completed': True}]}},
+        "S2": {'unlocked': True, 'discovered': True},
+    }
+
+def test_delta_carries_unlock_and_discovery_flips():
+    old = make_state()
+    new = make_state(unlocked={"Start": True, "S2": True}, discovered=["Start", "S2"])
+    delta = app_module._state_delta(old, new)
+    assert delta['unlocked'] == {"S1": False, "S2": True}
+    assert delta['discovered'] == {"S1": False, "S2": True}
+
+def test_delta_carries_new_badges_and_changed_ctfs():
+    old = make_state()
+    new = make_state(
+        badges=[*old['badges'], {'id': "ctf-1", 'shown': False}],
+        ctfs=[{'id': 1, 'title': "CTF 1", 'completed': 1}, old['ctfs'][1]],
+        xp=30, level=1,
+    )
+    delta = app_module._state_delta(old, new)
+    assert delta['new_badges'] == [{'id': "ctf-1", 'shown': False}]
+    assert delta['ctfs'] == [{'id': 1, 'title': "CTF 1", 'completed': 1}]
+    assert delta['xp'] == 30
+
+@pytest.mark.parametrize("changes", [
+    lambda state: state['nodes'].pop(), # Node removed
+    lambda state: state['nodes'].append({**state['nodes'][0], 'id': "S3"}), # Node added
+    lambda state: state['links'].append({'source': "S2", 'target': "S1"}), # Link added
+    lambda state: state['ctfs'].pop(), # CTF removed
+    lambda state: state['ctfs'].append({'id': 3, 'title': "CTF 3", 'completed': 0}), # CTF added
+    lambda state: state['badges'].clear(), # Badge taken away
+])
+def test_no_delta_for_changes_it_cannot_carry(changes):
+    new = make_state()
+    changes(new)
+    assert app_module._state_delta(make_state(), new) is None
+
+def apply_state_delta(state, delta):
+    """Python port of static/state.js applyStateDelta."""
+    nodes = []
+    for node in state['nodes']:
+        changes = delta['nodes'].get(node['id'])
+        if changes:
+            node = {**node, **changes, 'popup': {**node['popup'], **changes.get('popup', {})}}
+        nodes.append(node)
+    unlocked = dict(state['unlocked'])
+    for node_id, is_unlocked in delta['unlocked'].items():
+        if is_unlocked:
+            unlocked[node_id] = True
+        else:
+            unlocked.pop(node_id, None)
+    discovered = set(state['discovered'])
+    for node_id, is_discovered in delta['discovered'].items():
+        (discovered.add if is_discovered else discovered.discard)(node_id)
+    changed_ctfs = {ctf['id']: ctf for ctf in delta['ctfs']}
+    return {
+        **state,
+        'nodes': nodes,
+        'unlocked': unlocked,
+        'discovered': sorted(discovered),
+        'ctfs': [changed_ctfs.get(ctf['id'], ctf) for ctf in state['ctfs']],
+        'badges': state['badges'] + delta['new_badges'],
+        'abilities': delta['abilities'],
+        'streak': delta['streak'],
+        'xp': delta['xp'],
+        'level': delta['level'],
+    }
+
+def test_applied_deltas_match_a_fresh_get(login):
+    client = login()
+    url = f"/data?graph={GRAPH_X[1]}"
+    state = client.get(url).get_json()
+
+    response = toggle(client, "x_e1", delta=True).get_json()
+    state = apply_state_delta(state, response['delta'])
+    response = toggle(client, "x_e2", delta=True).get_json()
+    state = apply_state_delta(state, response['delta'])
+    response = client.post(f"/ctfs?graph={GRAPH_X[1]}&delta=1", json=[{'id': 1, 'completed': 2}]).get_json()
+    state = apply_state_delta(state, response['delta'])
+
+    fresh = client.get(url).get_json()
+    fresh['discovered'] = sorted(fresh['discovered'])
+    assert state == fresh
+    assert {badge['id'] for badge in fresh['badges']} == {"exercises-1", "ctf-1"}
+    assert fresh['unlocked'].get("x_S2") # S1 reached 100%
+
+# --- Tests for the XP counter ---
+
+def test_xp_follows_graph_edits(flask_app, login):
+    client = login()
+    toggle(client, "y_e1", graph=GRAPH_Y[1])
+    assert client.get(f"/data?graph={GRAPH_Y[1]}").get_json()['xp'] == 10
+
+    with flask_app.app_context():
+        Exercise.query.filter_by(id="y_e1").first().points = 500
+        core_data.bump_graph_version(GRAPH_Y[0])
+        db.session.commit()
+        graph_version = db.session.get(Graph, GRAPH_Y[0]).version
+    try:
+        state = client.get(f"/data?graph={GRAPH_Y[1]}").get_json()
+        assert (state['xp'], state['level']) == (500, core_badges.shown_level(500))
+        assert xp_counter(flask_app, client.user_id, GRAPH_Y[0])[1] < graph_version # GET does not write
+
+        client.post(f"/ctfs?graph={GRAPH_Y[1]}", json=[{'id': 1, 'completed': 1}])
+        assert xp_counter(flask_app, client.user_id, GRAPH_Y[0]) == (500 + CTF_XP, graph_version)
+    finally:
+        with flask_app.app_context():
+            Exercise.query.filter_by(id="y_e1").first().points = 10
+            core_data.bump_graph_version(GRAPH_Y[0])
+            db.session.commit()
@@ -0,0 +1,212 @@
+# test_badges.py
+import pytest
+
+# Assuming test fixtures (test_app, db_session) are defined in conftest.py
+
+# --- Imports for the module being tested ---
+from core.badges import (
+    get_main_node_ids,
+    get_badge_rules,
+    invalidate_badge_rules,
+    rule_from_badge_id,
+    compute_badge_metrics,
+    evaluate_badges,
+    award_event_badges,
+    families_for_events,
+    reaches_main_completion,
+    BadgeRules,
+    calculate_level,
+    shown_level,
+    graph_xp,
+    LEVEL_THRESHOLDS,
+    EVENT_CTF_CHANGED,
+    EVENT_EXERCISE_COMPLETED,
+    EVENT_NODE_COMPLETED,
+    EVENT_STREAK_ADVANCED,
+)
+from core.graph import compile_graph
+from models import User, Graph, Node, Exercise, UserNodeStatus, Badge, UserBadge
+
+# --- Test Data ---
+GRAPH_ID = 601
+USER_ID = 88
+MAIN_COUNT = 30
+
+# --- Helper Functions ---
+
+def setup_graph(db_session):
+    """A graph of MAIN_COUNT main nodes with one sub each, plus badge definitions; flushes."""
+    db_session.add(Graph(id=GRAPH_ID, name="badge_graph"))
+    db_session.add(User(id=USER_ID, username="badger", email="badger@test.com", password_hash="x"))
+    static_nodes = []
+    for k in range(MAIN_COUNT):
+        db_session.add(Node(id=f"bm{k}", graph_id=GRAPH_ID, title=f"M{k}", type="main"))
+        sub = Node(id=f"bs{k}", graph_id=GRAPH_ID, title=f"S{k}", type="sub")
+        db_session.add(sub)
+        db_session.add(Exercise(id=f"bex{k}", node=sub, label=f"Ex {k}", points=10))
+        db_session.add(Badge(id=f"main-bm{k}", title=f"Main {k}", metric="main", threshold=100))
+        static_nodes.append({'id': f"bm{k}", 'title': f"M{k}", 'type': "main", 'popup': {'exercises': []}})
+        static_nodes.append({'id': f"bs{k}", 'title': f"S{k}", 'type': "sub", 'popup': {'exercises': [
+            {'id': f"bex{k}", 'points': 10, 'optional': False, 'categories': []}]}})
+    for badge_id in ("level-1", "exercises-2", "exercises-5", "ctf-1", "streak-3"):
+        metric, threshold = rule_from_badge_id(badge_id)
+        db_session.add(Badge(id=badge_id, title=badge_id, metric=metric, threshold=threshold))
+    db_session.flush()
+    invalidate_badge_rules()
+    get_badge_rules() # Loaded once per process, not per evaluation
+    return compile_graph(static_nodes, [], version=1)
+
+def badge_defs():
+    return {b.id: {'id': b.id, 'title': b.title, 'description': b.description, 'image_path': b.image_path}
+            for b in Badge.query.all()}
+
+def statuses(percent):
+    return {f"{prefix}{k}": UserNodeStatus(user_id=USER_ID, percent_complete=percent)
+            for k in range(MAIN_COUNT) for prefix in ("bm", "bs")}
+
+def main_node_event(compiled, status_map, defs):
+    """Badges awarded for a main node reaching 100%, with every input passed in."""
+    return award_event_badges(
+        USER_ID, GRAPH_ID, [EVENT_NODE_COMPLETED], None, None, status_map, None, compiled, defs)
+
+@pytest.fixture(autouse=True)
+def fresh_rules():
+    yield
+    invalidate_badge_rules()
+
+# --- Tests for badge evaluation ---
+
+def test_no_queries_when_nothing_new_is_earned(db_session, count_statements):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    metrics = compute_badge_metrics(GRAPH_ID, None, None, statuses(100), None, compiled, families=("main",))
+    awarded, statements = count_statements(evaluate_badges, USER_ID, metrics, set(defs), defs)
+    assert awarded == []
+    assert statements == []
+
+def test_no_per_node_or_per_badge_selects(db_session, count_statements):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    awarded, statements = count_statements(main_node_event, compiled, statuses(100), defs)
+    assert sorted(b['id'] for b in awarded) == sorted(f"main-bm{k}" for k in range(MAIN_COUNT))
+    # Only the writes for the awards themselves: nothing is looked up per node or badge
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert UserBadge.query.filter_by(user_id=USER_ID).count() == MAIN_COUNT
+
+def test_only_completed_main_nodes_earn_badges(db_session):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    status_map = statuses(50)
+    status_map["bm3"].percent_complete = 100
+    status_map["bs4"].percent_complete = 100 # Sub nodes have no badge
+    awarded = main_node_event(compiled, status_map, defs)
+    assert [b['id'] for b in awarded] == ["main-bm3"]
+
+def test_threshold_badges_from_rules(db_session):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    db_session.add(UserBadge(user_id=USER_ID, badge_id="exercises-2"))
+    db_session.flush()
+    awarded = award_event_badges(
+        USER_ID, GRAPH_ID, [EVENT_EXERCISE_COMPLETED, EVENT_CTF_CHANGED, EVENT_STREAK_ADVANCED],
+        {"streak": 3}, {1: 1}, None, {"bex0", "bex1", "bex2"}, compiled, defs)
+    # 30 + 30 XP is level 1; exercises-2 is already owned and exercises-5 not reached
+    assert [b['id'] for b in awarded] == ["level-1", "ctf-1", "streak-3"]
+
+# --- Tests for the rule engine ---
+
+def test_rule_from_badge_id():
+    assert rule_from_badge_id("level-15") == ("level", 15)
+    assert rule_from_badge_id("main-node-7") == ("main", 100)
+    assert rule_from_badge_id("streak-x") == (None, None)
+    assert rule_from_badge_id("custom") == (None, None)
+
+def test_threshold_tables_are_bisected():
+    rules = BadgeRules([("ctf-10", "ctf", 10), ("ctf-5", "ctf", 5), ("ctf-20", "ctf", 20),
+                        ("main-M1", "main", 100), ("odd", None, None)])
+    assert rules.thresholds["ctf"] == [5, 10, 20]
+    assert rules.earned("ctf", 4) == []
+    assert rules.earned("ctf", 10) == ["ctf-5", "ctf-10"]
+    assert rules.earned("streak", 100) == []
+    assert rules.earned_main({"M1": 100, "M2": 100}) == ["main-M1"]
+
+def test_only_present_metrics_are_evaluated(db_session):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    metrics = compute_badge_metrics(GRAPH_ID, None, {1: 1}, None, None, compiled, families=("ctf",))
+    assert metrics == {"ctf": 1}
+    awarded = evaluate_badges(USER_ID, metrics, None, defs)
+    assert [b['id'] for b in awarded] == ["ctf-1"]
+
+def test_awards_already_owned_are_skipped_by_the_insert(db_session, count_statements):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    db_session.add(UserBadge(user_id=USER_ID, badge_id="main-bm0"))
+    db_session.flush()
+    metrics = compute_badge_metrics(GRAPH_ID, None, None, statuses(100), None, compiled, families=("main",))
+    awarded, statements = count_statements(evaluate_badges, USER_ID, metrics, None, defs)
+    assert len(awarded) == MAIN_COUNT - 1
+    assert "main-bm0" not in {b['id'] for b in awarded}
+    assert len([s for s in statements if s.lstrip().upper().startswith("INSERT")]) == 1
+    assert UserBadge.query.filter_by(user_id=USER_ID).count() == MAIN_COUNT
+
+# --- Tests for event-driven evaluation ---
+
+def test_events_select_rule_families():
+    assert families_for_events([EVENT_EXERCISE_COMPLETED]) == ("level", "exercises")
+    assert families_for_events({EVENT_CTF_CHANGED, EVENT_STREAK_ADVANCED}) == ("level", "ctf", "streak")
+    assert families_for_events([EVENT_NODE_COMPLETED]) == ("main",)
+    assert families_for_events([]) == ()
+
+def test_event_evaluates_only_its_families(db_session):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    # Everything is earnable, but a streak event only looks at the streak
+    awarded = award_event_badges(
+        USER_ID, GRAPH_ID, [EVENT_STREAK_ADVANCED], {"streak": 3}, {1: 1}, statuses(100),
+        {"bex0", "bex1"}, compiled, defs)
+    assert [b['id'] for b in awarded] == ["streak-3"]
+    awarded = award_event_badges(
+        USER_ID, GRAPH_ID, [EVENT_EXERCISE_COMPLETED], {"streak": 3}, {}, statuses(100),
+        {"bex0", "bex1"}, compiled, defs)
+    assert [b['id'] for b in awarded] == ["exercises-2"]
+    # Awards are idempotent: repeating the event awards nothing
+    assert award_event_badges(
+        USER_ID, GRAPH_ID, [EVENT_EXERCISE_COMPLETED], None, {}, None, {"bex0", "bex1"}, compiled, defs) == []
+
+def test_event_loads_missing_inputs(db_session):
+    compiled = setup_graph(db_session)
+    defs = badge_defs()
+    awarded = award_event_badges(USER_ID, GRAPH_ID, [EVENT_CTF_CHANGED], compiled_graph=compiled, all_badge_defs_map=defs)
+    assert awarded == [] # No CTF completions stored
+    assert award_event_badges(USER_ID, None, [], all_badge_defs_map=defs) == []
+
+def test_reaches_main_completion(db_session):
+    compiled = setup_graph(db_session)
+    assert reaches_main_completion({"bm1": {'percent_complete': 100}}, GRAPH_ID, compiled)
+    assert not reaches_main_completion({"bs1": {'percent_complete': 100}}, GRAPH_ID, compiled)
+    assert not reaches_main_completion({"bm1": {'percent_complete': 50, 'unlocked': True}}, GRAPH_ID, compiled)
+    assert not reaches_main_completion({"bm1": {'discovered': True}}, GRAPH_ID)
+
+# --- Tests for the level table ---
+
+def test_level_table():
+    assert LEVEL_THRESHOLDS[:4] == (0, 50, 110, 180)
+    assert [calculate_level(xp) for xp in (0, 49, 50, 109, 110)] == [0, 0, 1, 1, 2]
+    assert calculate_level(10 ** 9) == 49
+    # The sidebar and highest_level_popup_shown count from level 1
+    assert [shown_level(xp) for xp in (0, 49, 50, 110)] == [1, 1, 2, 3]
+    assert shown_level(10 ** 9) == 51
+
+def test_graph_xp(db_session):
+    compiled = setup_graph(db_session)
+    assert graph_xp(compiled, {"bex0", "bex1"}, {1: 2, 2: 1}) == 20 + 90
+    assert graph_xp(compiled, compiled.exercise_mask({"bex0"}), {}) == 10
+
+# --- Tests for get_main_node_ids ---
+
+def test_main_node_ids_from_compiled_graph_or_db(db_session):
+    compiled = setup_graph(db_session)
+    expected = {f"bm{k}" for k in range(MAIN_COUNT)}
+    assert get_main_node_ids(GRAPH_ID, compiled) == expected
+    assert get_main_node_ids(GRAPH_ID) == expected
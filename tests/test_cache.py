@@ -0,0 +1,142 @@
+# test_cache.py
+import threading
+import time
+import pytest
+from core.cache import VersionedLRUCache
+
+# --- Tests for VersionedLRUCache ---
+
+def test_get_miss_on_empty_cache():
+    cache = VersionedLRUCache(max_bytes=100)
+    assert cache.get("a", 1) is None
+    assert cache.stats()['misses'] == 1
+
+def test_put_then_get_same_version():
+    cache = VersionedLRUCache(max_bytes=100)
+    cache.put("a", 1, "value-a", cost=10)
+    assert cache.get("a", 1) == "value-a"
+    assert cache.stats()['hits'] == 1
+
+def test_version_mismatch_is_a_miss():
+    """A newer version must not be served the old payload."""
+    cache = VersionedLRUCache(max_bytes=100)
+    cache.put("a", 1, "old", cost=10)
+    assert cache.get("a", 2) is None
+    cache.put("a", 2, "new", cost=10)
+    assert cache.get("a", 2) == "new"
+    assert cache.get("a", 1) is None
+    assert cache.stats()['bytes'] == 10
+
+def test_contains_checks_the_version_without_counting():
+    cache = VersionedLRUCache(max_bytes=100)
+    cache.put("a", 1, "value-a", cost=10)
+    assert cache.contains("a", 1)
+    assert not cache.contains("a", 2)
+    assert not cache.contains("b", 1)
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 0)
+
+def test_older_version_does_not_replace_newer():
+    cache = VersionedLRUCache(max_bytes=100)
+    cache.put("a", 2, "new", cost=10)
+    assert cache.put("a", 1, "old", cost=10) is False
+    assert cache.get("a", 2) == "new"
+
+def test_lru_eviction_over_budget():
+    cache = VersionedLRUCache(max_bytes=25)
+    cache.put("a", 1, "A", cost=10)
+    cache.put("b", 1, "B", cost=10)
+    cache.get("a", 1) # 'a' is now most recently used
+    cache.put("c", 1, "C", cost=10) # Over budget -> evict 'b'
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == "A"
+    assert cache.get("c", 1) == "C"
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 20
+
+def test_entry_larger_than_budget_is_not_cached():
+    cache = VersionedLRUCache(max_bytes=5)
+    assert cache.put("a", 1, "A", cost=10) is False
+    assert cache.get("a", 1) is None
+
+def test_invalidate_single_key_and_all():
+    cache = VersionedLRUCache(max_bytes=100)
+    cache.put("a", 1, "A", cost=10)
+    cache.put("b", 1, "B", cost=10)
+    cache.invalidate("a")
+    assert cache.get("a", 1) is None
+    assert cache.get("b", 1) == "B"
+    cache.invalidate()
+    assert cache.get("b", 1) is None
+    assert cache.stats()['entries'] == 0
+
+# --- Tests for get_or_load ---
+
+def test_get_or_load_caches_loader_result():
+    cache = VersionedLRUCache(max_bytes=100)
+    calls = []
+    def loader():
+        calls.append(1)
+        return "A", 10
+    assert cache.get_or_load("a", 1, loader) == "A"
+    assert cache.get_or_load("a", 1, loader) == "A"
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['loads']) == (1, 1, 1)
+
+def test_get_or_load_none_cost_is_not_cached():
+    cache = VersionedLRUCache(max_bytes=100)
+    calls = []
+    def loader():
+        calls.append(1)
+        return [], None
+    cache.get_or_load("a", 1, loader)
+    cache.get_or_load("a", 1, loader)
+    assert len(calls) == 2
+
+def test_get_or_load_propagates_errors_and_retries():
+    cache = VersionedLRUCache(max_bytes=100)
+    def failing_loader():
+        raise RuntimeError("db down")
+    with pytest.raises(RuntimeError):
+        cache.get_or_load("a", 1, failing_loader)
+    # The failed flight is cleared, so the next call loads again
+    assert cache.get_or_load("a", 1, lambda: ("A", 10)) == "A"
+
+def test_concurrent_misses_share_one_load():
+    cache = VersionedLRUCache(max_bytes=100)
+    calls = []
+    release = threading.Event()
+    def slow_loader():
+        calls.append(1)
+        release.wait(timeout=5)
+        return "A", 10
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("a", 1, slow_loader)))
+               for _ in range(8)]
+    for t in threads: t.start()
+    time.sleep(0.05) # Let every thread reach the in-flight load
+    release.set()
+    for t in threads: t.join(timeout=5)
+
+    assert results == ["A"] * 8
+    assert len(calls) == 1
+
+def test_slow_load_does_not_block_other_keys():
+    cache = VersionedLRUCache(max_bytes=100)
+    release = threading.Event()
+    def slow_loader():
+        release.wait(timeout=5)
+        return "A", 10
+
+    slow_thread = threading.Thread(target=lambda: cache.get_or_load("a", 1, slow_loader))
+    slow_thread.start()
+    time.sleep(0.05)
+    try:
+        # 'b' loads and is served while 'a' is still in flight
+        assert cache.get_or_load("b", 1, lambda: ("B", 10)) == "B"
+        assert slow_thread.is_alive()
+    finally:
+        release.set()
+        slow_thread.join(timeout=5)
+    assert cache.get("a", 1) == "A"
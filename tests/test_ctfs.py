@@ -11,7 +11,8 @@ from core.ctfs import (
     update_user_ctf_completion,
     get_combined_ctf_data_for_user
 )
-from models import User, Ctf, UserCtfCompletion, db as original_db
+from core.data import set_user_graph_xp
+from models import User, Graph, Ctf, UserCtfCompletion, UserGraphState, db as original_db
 
 # --- Test Data ---
 USER_ID_1 = 1
@@ -19,6 +20,8 @@ USER_ID_2 = 2
 CTF_ID_1 = 101
 CTF_ID_2 = 102
 CTF_ID_3 = 103
+CTF_ID_XP = 104
+GRAPH_ID_XP = 701
 
 # --- Helper Functions (Unchanged) ---
 
@@ -190,6 +193,19 @@ def test_update_completion_negative_delta_new(db_session):
     assert comp is None
     # Rollback happens automatically
 
+def test_update_completion_adds_xp_to_counters(db_session):
+    setup_user(db_session, USER_ID_2)
+    setup_ctf_defs(db_session, [(CTF_ID_XP, 'T4', 'D4', 'L4')])
+    db_session.add(Graph(id=GRAPH_ID_XP, name="ctf_xp_graph"))
+    db_session.flush()
+    set_user_graph_xp(USER_ID_2, GRAPH_ID_XP, 15, 1)
+    db_session.flush()
+
+    success = update_user_ctf_completion(USER_ID_2, CTF_ID_XP, 2) # Commits internally
+    assert success is True
+    state = db_session.query(UserGraphState).filter_by(user_id=USER_ID_2, graph_id=GRAPH_ID_XP).first()
+    assert state.xp == 15 + 2 * 30
+
 # --- Tests for get_combined_ctf_data_for_user ---
 
 def test_get_combined_data_no_ctfs(db_session):
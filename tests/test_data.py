@@ -0,0 +1,377 @@
+# test_data.py
+import pytest
+
+# Assuming test fixtures (test_app, db_session) are defined in conftest.py
+
+# --- Imports for the module being tested ---
+from core import data as core_data
+from core.data import (
+    get_cached_static_graph_data,
+    get_graph_version,
+    bump_graph_version,
+    get_exercise_graph_id,
+    get_derived_graph_version,
+    set_derived_graph_version,
+    lock_derived_graph_state,
+    update_user_exercise_completion,
+    get_user_progress_version,
+    bump_user_progress_version,
+    get_state_snapshot,
+    get_stale_snapshot_graph_ids,
+    store_state_snapshot,
+    update_user_node_status_bulk,
+    get_node_pks,
+    store_completion_bitmap,
+    get_user_progress,
+    get_user_state_inputs,
+    set_user_graph_xp,
+    add_user_xp,
+)
+from datetime import date
+from models import (User, Graph, Node, Exercise, NodeRelationship, UserExerciseCompletion, UserNodeStatus,
+                    UserStreak, UserCtfCompletion, Ctf, Badge, UserBadge)
+
+# --- Test Data ---
+GRAPH_ID = 501
+USER_ID = 77
+
+# --- Helper Functions ---
+
+def setup_graph(db_session, graph_id=GRAPH_ID):
+    """Adds a small main -> sub graph to the session, flushes."""
+    graph = Graph(id=graph_id, name=f"test_graph_{graph_id}")
+    db_session.add(graph)
+    db_session.flush()
+    main = Node(id=f"g{graph_id}_main", graph_id=graph_id, title="Main", type="main")
+    sub = Node(id=f"g{graph_id}_sub", graph_id=graph_id, title="Sub", type="sub")
+    db_session.add_all([main, sub])
+    db_session.add(Exercise(id=f"g{graph_id}_ex1", node=sub, label="Ex 1", points=10))
+    db_session.flush()
+    db_session.add(NodeRelationship(parent_pk=main.pk, child_pk=sub.pk, relationship_type="CHILD"))
+    db_session.flush()
+    return graph
+
+def node_pk(node_id):
+    return Node.query.filter_by(id=node_id).one().pk
+
+def exercise_pk(exercise_id):
+    return Exercise.query.filter_by(id=exercise_id).one().pk
+
+def setup_user(db_session, user_id=USER_ID):
+    user = User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@test.com", password_hash="x")
+    db_session.add(user)
+    db_session.flush()
+    return user
+
+@pytest.fixture(autouse=True)
+def clear_static_cache():
+    core_data.invalidate_static_graph_cache()
+    yield
+    core_data.invalidate_static_graph_cache()
+
+# --- Tests for graph versions ---
+
+def test_new_graph_starts_at_version_1(db_session):
+    setup_graph(db_session)
+    assert get_graph_version(GRAPH_ID) == 1
+
+def test_unknown_graph_version_is_zero(db_session):
+    assert get_graph_version(999999) == 0
+
+def test_bump_graph_version(db_session):
+    setup_graph(db_session)
+    bump_graph_version(GRAPH_ID)
+    bump_graph_version(GRAPH_ID)
+    assert get_graph_version(GRAPH_ID) == 3
+
+# --- Tests for get_cached_static_graph_data ---
+
+def test_cache_hit_returns_same_objects(db_session):
+    setup_graph(db_session)
+    nodes_1, links_1 = get_cached_static_graph_data(GRAPH_ID, 1)
+    nodes_2, links_2 = get_cached_static_graph_data(GRAPH_ID, 1)
+    assert len(nodes_1) == 2
+    assert links_1 == [{'source': f"g{GRAPH_ID}_main", 'target': f"g{GRAPH_ID}_sub", 'type': 'CHILD'}]
+    assert nodes_2 is nodes_1 # Served from cache, not rebuilt
+    assert links_2 is links_1
+
+def test_version_bump_reloads_graph(db_session):
+    setup_graph(db_session)
+    nodes_before, _ = get_cached_static_graph_data(GRAPH_ID)
+    # Simulate an editor write: add a node and bump the version
+    db_session.add(Node(id=f"g{GRAPH_ID}_sub2", graph_id=GRAPH_ID, title="Sub 2", type="sub"))
+    bump_graph_version(GRAPH_ID)
+    db_session.flush()
+
+    nodes_after, _ = get_cached_static_graph_data(GRAPH_ID)
+    assert len(nodes_before) == 2
+    assert len(nodes_after) == 3
+
+def test_stale_version_without_bump_keeps_cache(db_session):
+    setup_graph(db_session)
+    nodes_before, _ = get_cached_static_graph_data(GRAPH_ID)
+    db_session.add(Node(id=f"g{GRAPH_ID}_sub2", graph_id=GRAPH_ID, title="Sub 2", type="sub"))
+    db_session.flush()
+    # No version bump -> cached copy is still served
+    nodes_after, _ = get_cached_static_graph_data(GRAPH_ID)
+    assert nodes_after is nodes_before
+
+# --- Tests for derived state bookkeeping ---
+
+def test_exercise_graph_id(db_session):
+    setup_graph(db_session)
+    assert get_exercise_graph_id(f"g{GRAPH_ID}_ex1") == GRAPH_ID
+    assert get_exercise_graph_id("no-such-exercise") is None
+
+def test_derived_graph_version_roundtrip(db_session):
+    setup_graph(db_session)
+    assert get_derived_graph_version(USER_ID, GRAPH_ID) is None
+    set_derived_graph_version(USER_ID, GRAPH_ID, 1)
+    set_derived_graph_version(USER_ID, GRAPH_ID, 2) # Updates the same row
+    assert get_derived_graph_version(USER_ID, GRAPH_ID) == 2
+
+def test_lock_derived_graph_state_creates_and_locks_the_row(db_session):
+    setup_graph(db_session)
+    assert lock_derived_graph_state(USER_ID, GRAPH_ID) == 0 # Row created, never derived
+    set_derived_graph_version(USER_ID, GRAPH_ID, 3) # Updates the row the lock created
+    assert lock_derived_graph_state(USER_ID, GRAPH_ID) == 3
+
+def test_exercise_completion_can_be_staged_without_commit(db_session):
+    setup_graph(db_session)
+    assert update_user_exercise_completion(USER_ID, f"g{GRAPH_ID}_ex1", True, commit=False)
+    assert UserExerciseCompletion.query.filter_by(user_id=USER_ID).count() == 1
+    db_session.rollback()
+    assert UserExerciseCompletion.query.filter_by(user_id=USER_ID).count() == 0
+
+def test_exercise_completion_by_external_id(db_session):
+    setup_graph(db_session)
+    ex_id = f"g{GRAPH_ID}_ex1"
+    assert update_user_exercise_completion(USER_ID, ex_id, True, commit=False)
+    assert update_user_exercise_completion(USER_ID, ex_id, True, commit=False) # Already completed
+    completion = UserExerciseCompletion.query.filter_by(user_id=USER_ID).one()
+    assert completion.exercise_pk == exercise_pk(ex_id)
+    assert update_user_exercise_completion(USER_ID, ex_id, False, commit=False)
+    assert UserExerciseCompletion.query.filter_by(user_id=USER_ID).count() == 0
+
+# --- Tests for integer node keys ---
+
+def test_static_graph_keeps_external_ids(db_session):
+    setup_graph(db_session)
+    nodes, links, compiled = core_data.get_cached_static_graph(GRAPH_ID)
+    main_id, sub_id = f"g{GRAPH_ID}_main", f"g{GRAPH_ID}_sub"
+    assert links == [{'source': main_id, 'target': sub_id, 'type': 'CHILD'}]
+    assert compiled.node_pks == {main_id: node_pk(main_id), sub_id: node_pk(sub_id)}
+    sub = next(n for n in nodes if n['id'] == sub_id)
+    assert [ex['id'] for ex in sub['popup']['exercises']] == [f"g{GRAPH_ID}_ex1"]
+
+def test_node_pks_skip_unknown_ids(db_session):
+    setup_graph(db_session)
+    assert get_node_pks([f"g{GRAPH_ID}_main", "ghost"]) == {f"g{GRAPH_ID}_main": node_pk(f"g{GRAPH_ID}_main")}
+
+def test_bulk_upsert_ignores_unknown_nodes(db_session):
+    setup_graph(db_session)
+    assert update_user_node_status_bulk(USER_ID, {"ghost": {'percent_complete': 10}})
+    assert UserNodeStatus.query.filter_by(user_id=USER_ID).count() == 0
+
+# --- Tests for progress versions and state snapshots ---
+
+def test_progress_version_bumps(db_session):
+    setup_user(db_session)
+    assert get_user_progress_version(USER_ID) == 1
+    bump_user_progress_version(USER_ID)
+    assert get_user_progress_version(USER_ID) == 2
+
+def test_exercise_completion_bumps_progress_version(db_session):
+    setup_graph(db_session)
+    setup_user(db_session)
+    update_user_exercise_completion(USER_ID, f"g{GRAPH_ID}_ex1", True, commit=False)
+    assert get_user_progress_version(USER_ID) == 2
+
+def test_snapshot_served_only_for_matching_versions(db_session):
+    setup_graph(db_session)
+    setup_user(db_session)
+    assert store_state_snapshot(USER_ID, GRAPH_ID, 1, 1, b'{"nodes": []}')
+    assert get_state_snapshot(USER_ID, GRAPH_ID, 1, 1) == b'{"nodes": []}'
+    assert get_state_snapshot(USER_ID, GRAPH_ID, 2, 1) is None # Graph changed
+    assert get_state_snapshot(USER_ID, GRAPH_ID, 1, 2) is None # Progress changed
+
+def test_snapshot_replaced_in_place(db_session):
+    setup_graph(db_session)
+    setup_user(db_session)
+    set_derived_graph_version(USER_ID, GRAPH_ID, 1) # Row already exists
+    store_state_snapshot(USER_ID, GRAPH_ID, 1, 1, b"old")
+    store_state_snapshot(USER_ID, GRAPH_ID, 1, 2, b"new")
+    assert get_state_snapshot(USER_ID, GRAPH_ID, 1, 2) == b"new"
+    assert get_derived_graph_version(USER_ID, GRAPH_ID) == 1
+
+def test_stale_snapshot_graph_ids(db_session):
+    setup_graph(db_session)
+    setup_graph(db_session, GRAPH_ID + 1)
+    setup_user(db_session)
+    store_state_snapshot(USER_ID, GRAPH_ID, 1, 1, b"{}")
+    store_state_snapshot(USER_ID, GRAPH_ID + 1, 1, 1, b"{}")
+    assert get_stale_snapshot_graph_ids(USER_ID, 1) == []
+    assert sorted(get_stale_snapshot_graph_ids(USER_ID, 2)) == [GRAPH_ID, GRAPH_ID + 1]
+    bump_graph_version(GRAPH_ID + 1)
+    assert get_stale_snapshot_graph_ids(USER_ID, 1) == [GRAPH_ID + 1]
+
+# --- Tests for update_user_node_status_bulk ---
+
+def test_bulk_upsert_inserts_and_updates(db_session):
+    setup_graph(db_session)
+    main_id, sub_id = f"g{GRAPH_ID}_main", f"g{GRAPH_ID}_sub"
+    existing = UserNodeStatus(user_id=USER_ID, node_pk=node_pk(main_id), user_notes="keep me", percent_complete=10)
+    db_session.add(existing)
+    db_session.flush()
+
+    assert update_user_node_status_bulk(USER_ID, {
+        main_id: {'percent_complete': 50, 'unlocked': True, 'discovered': True},
+        sub_id: {'percent_complete': 100, 'unlocked': True, 'discovered': False},
+    })
+    # The already loaded object sees the new values, other columns are untouched
+    assert existing.percent_complete == 50
+    assert existing.user_notes == "keep me"
+    statuses = {s.node.id: s for s in UserNodeStatus.query.filter_by(user_id=USER_ID)}
+    assert statuses[sub_id].percent_complete == 100
+    assert statuses[sub_id].discovered is False
+
+def test_bulk_upsert_is_one_statement_per_batch(db_session, count_statements):
+    setup_graph(db_session)
+    node_pks = get_node_pks([f"g{GRAPH_ID}_main", f"g{GRAPH_ID}_sub"])
+    _, statements = count_statements(update_user_node_status_bulk, USER_ID, {
+        f"g{GRAPH_ID}_main": {'percent_complete': 1, 'unlocked': True, 'discovered': True},
+        f"g{GRAPH_ID}_sub": {'percent_complete': 2, 'unlocked': True, 'discovered': True},
+    }, node_pks)
+    assert len(statements) == 1
+    assert "ON CONFLICT" in statements[0]
+
+def test_bulk_upsert_partial_fields(db_session):
+    setup_graph(db_session)
+    node_id = f"g{GRAPH_ID}_main"
+    update_user_node_status_bulk(USER_ID, {node_id: {'percent_complete': 30, 'unlocked': True, 'discovered': True}})
+    update_user_node_status_bulk(USER_ID, {node_id: {'percent_complete': 40}})
+    status = UserNodeStatus.query.filter_by(user_id=USER_ID, node_pk=node_pk(node_id)).one()
+    assert (status.percent_complete, status.unlocked) == (40, True)
+
+# --- Tests for get_user_progress ---
+
+def test_user_progress_is_scoped_to_graph(db_session):
+    setup_graph(db_session)
+    setup_graph(db_session, graph_id=GRAPH_ID + 1)
+    for graph_id in (GRAPH_ID, GRAPH_ID + 1):
+        db_session.add(UserNodeStatus(user_id=USER_ID, node_pk=node_pk(f"g{graph_id}_sub"), percent_complete=100, user_notes="n"))
+        db_session.add(UserExerciseCompletion(user_id=USER_ID, exercise_pk=exercise_pk(f"g{graph_id}_ex1")))
+    db_session.flush()
+
+    status_map, completed = get_user_progress(USER_ID, GRAPH_ID)
+    assert set(status_map) == {f"g{GRAPH_ID}_sub"}
+    status = status_map[f"g{GRAPH_ID}_sub"]
+    assert (status.percent_complete, status.unlocked, status.discovered) == (100, False, False)
+    assert completed == {f"g{GRAPH_ID}_ex1"}
+
+# --- Tests for get_user_state_inputs ---
+
+def test_state_inputs_in_one_round_trip(db_session, count_statements):
+    setup_graph(db_session)
+    setup_graph(db_session, graph_id=GRAPH_ID + 1)
+    user = setup_user(db_session)
+    user.highest_level_popup_shown = 3
+    db_session.add(UserStreak(user_id=USER_ID, current_streak=4, last_used_date=date(2024, 5, 6)))
+    db_session.add(UserNodeStatus(user_id=USER_ID, node_pk=node_pk(f"g{GRAPH_ID}_sub"), percent_complete=100,
+                                  unlocked=True, discovered=False, user_notes="n"))
+    db_session.add(UserNodeStatus(user_id=USER_ID, node_pk=node_pk(f"g{GRAPH_ID + 1}_sub"), percent_complete=50))
+    db_session.add(UserExerciseCompletion(user_id=USER_ID, exercise_pk=exercise_pk(f"g{GRAPH_ID}_ex1")))
+    db_session.add(UserExerciseCompletion(user_id=USER_ID, exercise_pk=exercise_pk(f"g{GRAPH_ID + 1}_ex1")))
+    db_session.add(Ctf(id=9001, title="ctf"))
+    db_session.add(UserCtfCompletion(user_id=USER_ID, ctf_id=9001, completed_count=2))
+    db_session.add_all([Badge(id="test-b1", title="B1"), Badge(id="test-b2", title="B2")])
+    db_session.flush()
+    db_session.add(UserBadge(user_id=USER_ID, badge_id="test-b2", shown=True))
+    db_session.flush()
+    db_session.add(UserBadge(user_id=USER_ID, badge_id="test-b1"))
+    db_session.flush()
+
+    inputs, statements = count_statements(get_user_state_inputs, USER_ID, GRAPH_ID)
+    assert len(statements) == 1
+    assert inputs.highest_level_popup_shown == 3
+    assert inputs.streak == (4, date(2024, 5, 6))
+    assert set(inputs.node_status_map) == {f"g{GRAPH_ID}_sub"}
+    status = inputs.node_status_map[f"g{GRAPH_ID}_sub"]
+    assert (status.percent_complete, status.unlocked, status.discovered, status.user_notes) == (100, True, False, "n")
+    assert inputs.completed_exercise_ids == {f"g{GRAPH_ID}_ex1"}
+    assert inputs.ctf_completions == {9001: 2}
+    assert [(badge_id, shown) for badge_id, _, shown in inputs.user_badges] == [("test-b2", True), ("test-b1", False)]
+
+def test_state_inputs_for_new_user(db_session):
+    setup_graph(db_session)
+    setup_user(db_session)
+    inputs = get_user_state_inputs(USER_ID, GRAPH_ID)
+    assert inputs.streak is None
+    assert inputs.node_status_map == {} and inputs.completed_exercise_ids == set()
+    assert inputs.ctf_completions == {} and inputs.user_badges == []
+    assert inputs.xp is None
+
+def test_state_inputs_unknown_user(db_session):
+    assert get_user_state_inputs(999999, GRAPH_ID) is None
+
+# --- Tests for the XP counters ---
+
+def test_xp_counter_is_read_with_the_state_inputs(db_session, count_statements):
+    setup_graph(db_session)
+    setup_graph(db_session, graph_id=GRAPH_ID + 1)
+    setup_user(db_session)
+    set_user_graph_xp(USER_ID, GRAPH_ID, 40, 1)
+    db_session.flush()
+    inputs, statements = count_statements(get_user_state_inputs, USER_ID, GRAPH_ID, 1)
+    assert len(statements) == 1
+    assert inputs.xp == 40
+    assert get_user_state_inputs(USER_ID, GRAPH_ID + 1, 1).xp is None
+
+def test_xp_counter_of_another_graph_version_is_not_read(db_session):
+    setup_graph(db_session)
+    setup_user(db_session)
+    set_user_graph_xp(USER_ID, GRAPH_ID, 40, 1)
+    db_session.flush()
+    assert get_user_state_inputs(USER_ID, GRAPH_ID, 2).xp is None # Exercise points may have changed
+    assert get_user_state_inputs(USER_ID, GRAPH_ID).xp is None
+
+def test_add_user_xp_updates_every_computed_counter(db_session, count_statements):
+    setup_graph(db_session)
+    setup_graph(db_session, graph_id=GRAPH_ID + 1)
+    setup_graph(db_session, graph_id=GRAPH_ID + 2)
+    setup_user(db_session)
+    set_user_graph_xp(USER_ID, GRAPH_ID, 40, 1)
+    set_user_graph_xp(USER_ID, GRAPH_ID + 1, 0, 1)
+    set_derived_graph_version(USER_ID, GRAPH_ID + 2, 1) # A state row without a counter
+    db_session.flush()
+    _, statements = count_statements(add_user_xp, USER_ID, 60)
+    assert len([s for s in statements if s.lstrip().upper().startswith("UPDATE")]) == 1
+    assert [get_user_state_inputs(USER_ID, GRAPH_ID + k, 1).xp for k in range(3)] == [100, 60, None]
+
+# --- Tests for completion bitmaps ---
+
+def test_state_inputs_read_completion_bitmap(db_session, monkeypatch, count_statements):
+    monkeypatch.setattr(core_data, "COMPLETION_BITMAPS", True)
+    setup_graph(db_session)
+    setup_user(db_session)
+    _, _, compiled = core_data.get_cached_static_graph(GRAPH_ID)
+    store_completion_bitmap(USER_ID, GRAPH_ID, compiled, {f"g{GRAPH_ID}_ex1"})
+    db_session.flush()
+
+    inputs, statements = count_statements(get_user_state_inputs, USER_ID, GRAPH_ID, compiled.version)
+    assert len(statements) == 1
+    assert inputs.completed_exercise_ids is None
+    assert compiled.exercise_ids_in(inputs.completion_mask) == {f"g{GRAPH_ID}_ex1"}
+
+def test_stale_completion_bitmap_falls_back_to_rows(db_session, monkeypatch):
+    monkeypatch.setattr(core_data, "COMPLETION_BITMAPS", True)
+    setup_graph(db_session)
+    setup_user(db_session)
+    _, _, compiled = core_data.get_cached_static_graph(GRAPH_ID)
+    store_completion_bitmap(USER_ID, GRAPH_ID, compiled, set())
+    db_session.add(UserExerciseCompletion(user_id=USER_ID, exercise_pk=exercise_pk(f"g{GRAPH_ID}_ex1")))
+    db_session.flush()
+
+    inputs = get_user_state_inputs(USER_ID, GRAPH_ID, compiled.version + 1)
+    assert inputs.completion_mask is None
+    assert inputs.completed_exercise_ids == {f"g{GRAPH_ID}_ex1"}
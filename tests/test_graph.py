@@ -0,0 +1,149 @@
+# test_graph.py
+import pytest
+from core.graph import compile_graph, bit_positions, START_ID, TYPE_START, TYPE_MAIN, TYPE_SUB, TYPE_OTHER
+
+# --- Test Data ---
+
+def make_node(node_id, node_type, exercise_ids=()):
+    return {
+        'id': node_id, 'title': node_id, 'type': node_type,
+        'popup': {'text': '', 'pdf_link': None, 'exercises': [
+            {'id': ex_id, 'label': ex_id, 'points': 10, 'optional': False, 'categories': []}
+            for ex_id in exercise_ids
+        ]}
+    }
+
+NODES = [
+    make_node("M1", "main"),
+    make_node("S1", "sub", ["e1", "e2"]),
+    make_node("S2", "sub", ["e3"]),
+    make_node("X", "other"),
+]
+LINKS = [
+    {'source': "M1", 'target': "S1", 'type': 'CHILD'},
+    {'source': "S1", 'target': "S2", 'type': 'CHILD'},
+    {'source': "S1", 'target': "S2", 'type': 'CHILD'}, # Duplicate link
+    {'source': "S1", 'target': "X", 'type': 'PREREQUISITE'},
+    {'source': "ghost", 'target': "S2", 'type': 'PREREQUISITE'}, # Node of another graph
+]
+
+# --- Tests for CompiledGraph ---
+
+def test_start_is_ordinal_zero():
+    graph = compile_graph(NODES, LINKS)
+    assert graph.ids[0] == START_ID
+    assert graph.index["M1"] == 1
+    assert len(graph) == 5
+
+def test_type_codes():
+    graph = compile_graph(NODES, LINKS)
+    assert list(graph.types) == [TYPE_START, TYPE_MAIN, TYPE_SUB, TYPE_SUB, TYPE_OTHER]
+
+def test_adjacency_is_deduplicated_and_local():
+    graph = compile_graph(NODES, LINKS)
+    m1, s1, s2, x = (graph.index[i] for i in ("M1", "S1", "S2", "X"))
+    assert graph.children[m1] == (s1,)
+    assert graph.children[s1] == (s2,)
+    assert graph.parents[s2] == (s1,)
+    assert graph.prereqs[x] == (s1,)
+    assert graph.prereqs[s2] == () # 'ghost' is not part of the graph...
+    assert graph.missing_prereq[s2] == 1 # ...but is remembered
+
+def test_roots():
+    graph = compile_graph(NODES, LINKS)
+    assert [graph.ids[i] for i in graph.roots] == ["M1"]
+
+def test_exercise_ranges():
+    graph = compile_graph(NODES, LINKS)
+    s1 = graph.index["S1"]
+    ex_range = range(graph.ex_start[s1], graph.ex_end[s1])
+    assert [graph.exercise_ids[e] for e in ex_range] == ["e1", "e2"]
+    assert graph.exercise_node[graph.exercise_index["e3"]] == graph.index["S2"]
+    m1 = graph.index["M1"]
+    assert graph.ex_start[m1] == graph.ex_end[m1]
+
+def members_of(graph, main_id):
+    m = graph.index[main_id]
+    members = graph.main_members[graph.main_offsets[m]:graph.main_offsets[m + 1]]
+    return sorted(graph.ids[s] for s in members)
+
+def test_main_membership_stops_at_nested_mains():
+    nodes = [make_node("M1", "main"), make_node("S1", "sub"), make_node("M2", "main"),
+             make_node("S2", "sub"), make_node("X", "other"), make_node("S3", "sub")]
+    links = [
+        {'source': "M1", 'target': "S1", 'type': 'CHILD'},
+        {'source': "M1", 'target': "M2", 'type': 'CHILD'},
+        {'source': "M2", 'target': "S2", 'type': 'CHILD'},
+        {'source': "M1", 'target': "X", 'type': 'CHILD'},
+        {'source': "X", 'target': "S3", 'type': 'CHILD'}, # Reached through a non-sub node
+    ]
+    graph = compile_graph(nodes, links)
+    assert members_of(graph, "M1") == ["S1", "S3"]
+    assert members_of(graph, "M2") == ["S2"]
+    assert graph.main_ordinals == (graph.index["M1"], graph.index["M2"])
+
+def test_main_membership_counts_diamonds_once():
+    nodes = [make_node("M1", "main"), make_node("A", "sub"), make_node("B", "sub"), make_node("C", "sub")]
+    links = [
+        {'source': "M1", 'target': "A", 'type': 'CHILD'},
+        {'source': "M1", 'target': "B", 'type': 'CHILD'},
+        {'source': "A", 'target': "C", 'type': 'CHILD'},
+        {'source': "B", 'target': "C", 'type': 'CHILD'},
+    ]
+    graph = compile_graph(nodes, links)
+    assert members_of(graph, "M1") == ["A", "B", "C"]
+
+def test_rollup_index_is_reverse_of_membership():
+    nodes = [make_node("M1", "main"), make_node("S1", "sub"), make_node("M2", "main"), make_node("S2", "sub")]
+    links = [
+        {'source': "M1", 'target': "S1", 'type': 'CHILD'},
+        {'source': "M2", 'target': "S1", 'type': 'CHILD'}, # S1 rolls up into both mains
+        {'source': "M2", 'target': "S2", 'type': 'CHILD'},
+    ]
+    graph = compile_graph(nodes, links)
+    def rollup_of(node_id):
+        i = graph.index[node_id]
+        return sorted(graph.ids[m] for m in graph.rollup_mains[graph.rollup_offsets[i]:graph.rollup_offsets[i + 1]])
+    assert rollup_of("S1") == ["M1", "M2"]
+    assert rollup_of("S2") == ["M2"]
+    assert rollup_of("M1") == []
+
+def test_exercise_flags_and_categories():
+    nodes = [make_node("S1", "sub", ["e1", "e2"])]
+    nodes[0]['popup']['exercises'][0]['categories'] = ["Web"]
+    nodes[0]['popup']['exercises'][1]['optional'] = True
+    graph = compile_graph(nodes, [])
+    assert list(graph.exercise_optional) == [0, 1]
+    assert graph.exercise_categories == [("Web",), ()]
+
+def test_exercise_mask_roundtrip():
+    graph = compile_graph(NODES, LINKS)
+    mask = graph.exercise_mask({"e1", "e3", "other-graph"})
+    assert mask == 0b101 # Bits are exercise ordinals
+    assert graph.exercise_ids_in(mask) == {"e1", "e3"}
+    assert graph.exercise_ids_in(0) == set()
+
+def test_required_mask_and_points():
+    nodes = [make_node("S1", "sub", ["e1", "e2", "e3"])]
+    exercises = nodes[0]['popup']['exercises']
+    exercises[1]['optional'] = True
+    exercises[2]['points'] = 25
+    graph = compile_graph(nodes, [])
+    assert graph.required_mask == 0b101
+    assert graph.exercise_points_in(graph.required_mask) == 35
+    assert graph.as_exercise_mask({"e2"}) == graph.as_exercise_mask(0b010) == 0b010
+
+def test_bit_positions():
+    assert list(bit_positions(0)) == []
+    assert list(bit_positions((1 << 70) | (1 << 8) | 1)) == [0, 8, 70]
+
+def test_output_links_are_deduplicated_with_start_links():
+    graph = compile_graph(NODES, LINKS)
+    assert graph.output_links == [
+        {'source': "M1", 'target': "S1"},
+        {'source': "S1", 'target': "S2"},
+        {'source': "Start", 'target': "M1"},
+    ]
+    assert graph.output_links_json == (
+        b'[{"source":"M1","target":"S1"},{"source":"S1","target":"S2"},{"source":"Start","target":"M1"}]')
+    assert graph.start_node['id'] == START_ID
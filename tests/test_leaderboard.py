@@ -0,0 +1,173 @@
+# test_leaderboard.py
+import pytest
+
+# Assuming test fixtures (test_app, db_session) are defined in conftest.py
+
+# --- Imports for the module being tested ---
+from core import leaderboard as core_leaderboard
+from core.leaderboard import (
+    BOARD_GLOBAL,
+    graph_board,
+    category_board,
+    add_scores,
+    record_exercise_completion,
+    record_ctf_completions,
+    get_top,
+    get_rank,
+    invalidate_leaderboard_cache,
+    compute_user_scores,
+    exercise_scores,
+    apply_score_changes,
+)
+from core.data import update_user_exercise_completion
+from models import User, Graph, Node, Exercise, ExerciseCategory, LeaderboardScore
+
+# --- Test Data ---
+GRAPH_ID = 801
+USER_IDS = (91, 92, 93)
+
+# --- Helper Functions ---
+
+def setup_data(db_session):
+    """A graph with two required exercises (one in 'LbWeb') and an optional one, plus users; flushes."""
+    db_session.add(Graph(id=GRAPH_ID, name="leaderboard_graph"))
+    for user_id in USER_IDS:
+        db_session.add(User(id=user_id, username=f"lb{user_id}", email=f"lb{user_id}@test.com", password_hash="x"))
+    web = ExerciseCategory(name="LbWeb")
+    sub = Node(id="lb_sub", graph_id=GRAPH_ID, title="Sub", type="sub")
+    db_session.add_all([web, sub])
+    db_session.add(Exercise(id="lb_ex1", node=sub, label="Ex 1", points=10, categories=[web]))
+    db_session.add(Exercise(id="lb_ex2", node=sub, label="Ex 2", points=25))
+    db_session.add(Exercise(id="lb_opt", node=sub, label="Opt", points=40, optional=True))
+    db_session.flush()
+
+def scores_of(user_id):
+    return {s.board: (s.xp, s.completions) for s in LeaderboardScore.query.filter_by(user_id=user_id)}
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    invalidate_leaderboard_cache()
+    yield
+    invalidate_leaderboard_cache()
+
+# --- Tests for the incremental counters ---
+
+def test_exercise_completion_updates_every_board(db_session):
+    setup_data(db_session)
+    user_id = USER_IDS[0]
+    update_user_exercise_completion(user_id, "lb_ex1", True, commit=False)
+    update_user_exercise_completion(user_id, "lb_opt", True, commit=False)
+    assert scores_of(user_id) == {
+        BOARD_GLOBAL: (10, 2),
+        graph_board(GRAPH_ID): (10, 2), # Optional exercises count as completions only
+        category_board("LbWeb"): (10, 1),
+    }
+
+def test_one_upsert_for_all_boards(db_session, count_statements):
+    setup_data(db_session)
+    _, statements = count_statements(record_exercise_completion, USER_IDS[0], "lb_ex1", True)
+    # The exercise's metadata, then every board in a single upsert
+    assert [s.lstrip().split()[0].upper() for s in statements] == ["SELECT", "INSERT"]
+    assert len(scores_of(USER_IDS[0])) == 3
+
+def test_repeated_or_undone_completions(db_session):
+    setup_data(db_session)
+    user_id = USER_IDS[0]
+    update_user_exercise_completion(user_id, "lb_ex2", True, commit=False)
+    update_user_exercise_completion(user_id, "lb_ex2", True, commit=False) # Already completed
+    assert scores_of(user_id)[BOARD_GLOBAL] == (25, 1)
+    update_user_exercise_completion(user_id, "lb_ex2", False, commit=False)
+    update_user_exercise_completion(user_id, "lb_ex2", False, commit=False) # Already removed
+    assert scores_of(user_id)[BOARD_GLOBAL] == (0, 0)
+
+def test_ctf_completions_count_globally(db_session):
+    setup_data(db_session)
+    user_id = USER_IDS[1]
+    record_ctf_completions(user_id, 3, 30)
+    record_ctf_completions(user_id, -1, 30)
+    assert scores_of(user_id) == {BOARD_GLOBAL: (60, 2)}
+
+def test_rebuild_matches_incremental_counters(db_session):
+    setup_data(db_session)
+    user_id = USER_IDS[2]
+    for exercise_id in ("lb_ex1", "lb_ex2", "lb_opt"):
+        update_user_exercise_completion(user_id, exercise_id, True, commit=False)
+    update_user_exercise_completion(user_id, "lb_ex2", False, commit=False)
+    assert compute_user_scores([user_id], 30)[user_id] == scores_of(user_id)
+
+# --- Tests for editor changes to completed exercises ---
+
+def test_repricing_and_recategorising_moves_the_counters(db_session):
+    setup_data(db_session)
+    user_id = USER_IDS[0]
+    for exercise_id in ("lb_ex1", "lb_ex2"):
+        update_user_exercise_completion(user_id, exercise_id, True, commit=False)
+    exercise = Exercise.query.filter_by(id="lb_ex1").first()
+
+    before = exercise_scores([exercise.pk])
+    assert before == {user_id: {BOARD_GLOBAL: (10, 1), graph_board(GRAPH_ID): (10, 1), category_board("LbWeb"): (10, 1)}}
+    exercise.points = 15
+    exercise.categories = []
+    db_session.flush()
+    apply_score_changes(before, exercise_scores([exercise.pk]))
+    assert scores_of(user_id) == compute_user_scores([user_id], 30)[user_id] | {category_board("LbWeb"): (0, 0)}
+    assert scores_of(user_id)[BOARD_GLOBAL] == (40, 2)
+
+def test_removing_completions_takes_them_off_the_counters(db_session, count_statements):
+    setup_data(db_session)
+    for user_id in USER_IDS[:2]:
+        update_user_exercise_completion(user_id, "lb_ex2", True, commit=False)
+    exercise = Exercise.query.filter_by(id="lb_ex2").first()
+    scores = exercise_scores([exercise.pk])
+    assert set(scores) == set(USER_IDS[:2])
+    _, statements = count_statements(apply_score_changes, scores, {})
+    assert len(statements) == 1 # One upsert for every user and board
+    for user_id in USER_IDS[:2]:
+        assert scores_of(user_id)[BOARD_GLOBAL] == (0, 0)
+
+# --- Tests for top-K and ranks ---
+
+def test_top_and_rank(db_session):
+    setup_data(db_session)
+    board = graph_board(GRAPH_ID)
+    for user_id, xp in zip(USER_IDS, (50, 80, 50)):
+        add_scores(user_id, {board: (xp, 1)})
+    add_scores(USER_IDS[0], {category_board("LbWeb"): (0, 1)})
+    db_session.flush()
+
+    top = get_top(board, 2)
+    assert [(entry['rank'], entry['username'], entry['xp']) for entry in top] == [
+        (1, "lb92", 80), (2, "lb91", 50)] # Ties are broken by user id
+    assert get_rank(board, USER_IDS[2]) == {'rank': 3, 'xp': 50, 'completions': 1}
+    assert get_top(category_board("LbWeb")) == [] # Users without XP are not listed
+    assert get_rank(category_board("LbWeb"), USER_IDS[0]) is None # Nor ranked
+    assert get_rank(category_board("LbWeb"), USER_IDS[1]) is None
+
+def test_rank_agrees_with_top_when_a_user_has_no_xp(db_session):
+    setup_data(db_session)
+    board = graph_board(GRAPH_ID)
+    add_scores(USER_IDS[0], {board: (0, 1)}) # An optional exercise only
+    add_scores(USER_IDS[1], {board: (40, 1)})
+    add_scores(USER_IDS[2], {board: (40, 2)})
+    db_session.flush()
+
+    top = get_top(board)
+    assert [entry['username'] for entry in top] == ["lb92", "lb93"]
+    for user_id, entry in zip(USER_IDS[1:], top):
+        assert get_rank(board, user_id)['rank'] == entry['rank']
+    assert get_rank(board, USER_IDS[0]) is None
+
+def test_top_is_cached(db_session, monkeypatch):
+    monkeypatch.setattr(core_leaderboard, "LEADERBOARD_CACHE_SECONDS", 3600)
+    setup_data(db_session)
+    board = graph_board(GRAPH_ID)
+    add_scores(USER_IDS[0], {board: (10, 1)})
+    db_session.flush()
+    assert [entry['xp'] for entry in get_top(board)] == [10]
+
+    add_scores(USER_IDS[1], {board: (20, 1)})
+    db_session.flush()
+    assert [entry['xp'] for entry in get_top(board)] == [10] # Served from the cache
+    assert get_rank(board, USER_IDS[0])['rank'] == 2 # Ranks are always read
+    invalidate_leaderboard_cache()
+    assert [entry['xp'] for entry in get_top(board)] == [20, 10]
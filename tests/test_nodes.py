@@ -0,0 +1,281 @@
+# test_nodes.py
+import pytest
+
+# Assuming test fixtures (test_app, db_session) are defined in conftest.py
+
+# --- Imports for the module being tested ---
+from core.nodes import (
+    compute_user_graph_state,
+    propagate_unlocks,
+    compute_exercise_toggle_update,
+    compute_node_status_updates,
+    compute_graph_abilities,
+    get_engine_stats,
+    get_state_memo_stats,
+    invalidate_state_memo,
+)
+from core.graph import compile_graph
+from models import UserNodeStatus
+
+# --- Test Data ---
+USER_ID = 42
+GRAPH_ID = 1
+
+def make_node(node_id, node_type, exercise_ids=()):
+    return {
+        'id': node_id, 'title': node_id, 'type': node_type,
+        'popup': {'text': '', 'pdf_link': None, 'exercises': [
+            {'id': ex_id, 'label': ex_id, 'points': 10, 'optional': False, 'categories': []}
+            for ex_id in exercise_ids
+        ]}
+    }
+
+# M1 (main) -> S1 (sub) -> S2 (sub)
+#           -> M2 (main, requires S1) -> S3 (sub)
+NODES = [
+    make_node("M1", "main"),
+    make_node("S1", "sub", ["e1", "e2"]),
+    make_node("S2", "sub", ["e3"]),
+    make_node("M2", "main"),
+    make_node("S3", "sub", ["e4"]),
+]
+LINKS = [
+    {'source': "M1", 'target': "S1", 'type': 'CHILD'},
+    {'source': "S1", 'target': "S2", 'type': 'CHILD'},
+    {'source': "M1", 'target': "M2", 'type': 'CHILD'},
+    {'source': "S1", 'target': "M2", 'type': 'PREREQUISITE'},
+    {'source': "M2", 'target': "S3", 'type': 'CHILD'},
+]
+
+def node_by_id(nodes, node_id):
+    return next(n for n in nodes if n['id'] == node_id)
+
+# --- Tests for compute_user_graph_state ---
+
+def test_no_static_nodes(db_session):
+    assert compute_user_graph_state(USER_ID, GRAPH_ID, [], [], {}, set()) == ([], [], {}, set())
+
+def test_nothing_completed(db_session):
+    nodes, links, unlocked, discovered = compute_user_graph_state(
+        USER_ID, GRAPH_ID, NODES, LINKS, {}, set())
+    assert unlocked == {"Start": True, "M1": True, "S1": True}
+    assert discovered == {"Start", "M1", "S1"}
+    assert [n['id'] for n in nodes] == ["Start", "M1", "S1", "S2", "M2", "S3"]
+    assert all(n['percent'] == 0 for n in nodes if n['id'] != "Start")
+
+def test_half_sub_unlocks_children_and_prereq_dependents(db_session):
+    nodes, _, unlocked, discovered = compute_user_graph_state(
+        USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e1"})
+    assert set(unlocked) == {"Start", "M1", "S1", "S2", "M2", "S3"}
+    assert discovered == set(unlocked)
+    assert node_by_id(nodes, "S1")['percent'] == 50
+    # M1 averages S1 and S2 only: the descent stops at the nested main M2
+    assert node_by_id(nodes, "M1")['percent'] == 25
+    assert node_by_id(nodes, "M2")['percent'] == 0
+
+def test_exercise_completion_flags(db_session):
+    nodes, _, _, _ = compute_user_graph_state(
+        USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e2"})
+    exercises = node_by_id(nodes, "S1")['popup']['exercises']
+    assert [ex['completed'] for ex in exercises] == [False, True]
+
+def test_links_include_start_to_roots(db_session):
+    _, links, _, _ = compute_user_graph_state(
+        USER_ID, GRAPH_ID, NODES, LINKS, {}, set())
+    link_pairs = {(l['source'], l['target']) for l in links}
+    assert link_pairs == {("Start", "M1"), ("M1", "S1"), ("S1", "S2"), ("M1", "M2"), ("M2", "S3")}
+
+def test_precompiled_graph_gives_same_result(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    from_compiled = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e1"}, compiled)
+    on_the_fly = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e1"})
+    assert from_compiled[0] == on_the_fly[0]
+    assert from_compiled[2:] == on_the_fly[2:]
+
+def test_completion_bitset_gives_same_result(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    mask = compiled.exercise_mask({"e1", "e3"})
+    from_mask = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, mask, compiled)
+    from_ids = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e1", "e3"}, compiled)
+    assert from_mask == from_ids
+    assert compute_node_status_updates(compiled, {}, mask) == compute_node_status_updates(compiled, {}, {"e1", "e3"})
+
+def test_engine_stats_count_unlock_evaluations(db_session):
+    before = get_engine_stats()
+    compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, set())
+    after = get_engine_stats()
+    assert after['unlock_runs'] == before.get('unlock_runs', 0) + 1
+    assert after['unlock_evaluations'] > before.get('unlock_evaluations', 0)
+
+def test_compute_user_graph_state_does_not_write(db_session):
+    compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e1", "e3"})
+    assert not db_session.new and not db_session.dirty
+    assert UserNodeStatus.query.filter_by(user_id=USER_ID).count() == 0
+
+# --- Tests for the progress memo ---
+
+@pytest.fixture
+def memo():
+    invalidate_state_memo()
+    yield
+    invalidate_state_memo()
+
+def test_memo_shares_state_between_users_with_same_progress(db_session, memo):
+    compiled = compile_graph(NODES, LINKS, version=3)
+    before = get_state_memo_stats()
+    first = compute_user_graph_state(7, GRAPH_ID, NODES, LINKS, {}, {"e1"}, compiled)
+    runs = get_engine_stats()['unlock_runs']
+    second = compute_user_graph_state(8, GRAPH_ID, NODES, LINKS, {}, {"e1"}, compiled)
+    assert second == first
+    assert get_engine_stats()['unlock_runs'] == runs # Served from the memo
+    after = get_state_memo_stats()
+    assert after['hits'] == before['hits'] + 1
+    assert after['entries'] == 1
+    assert 0 < after['hit_rate'] <= 1
+
+def test_memo_overlays_notes_per_user(db_session, memo):
+    compiled = compile_graph(NODES, LINKS, version=3)
+    statuses = {"S1": UserNodeStatus(user_id=7, user_notes="mine")}
+    with_notes, _, _, _ = compute_user_graph_state(7, GRAPH_ID, NODES, LINKS, statuses, {"e1"}, compiled)
+    without_notes, _, _, _ = compute_user_graph_state(8, GRAPH_ID, NODES, LINKS, {}, {"e1"}, compiled)
+    assert node_by_id(with_notes, "S1")['popup']['userNotes'] == "mine"
+    assert node_by_id(without_notes, "S1")['popup']['userNotes'] == ""
+    assert node_by_id(with_notes, "M1") is node_by_id(without_notes, "M1")
+
+def test_memo_is_keyed_by_progress_and_version(db_session, memo):
+    compiled = compile_graph(NODES, LINKS, version=3)
+    _, _, unlocked_before, _ = compute_user_graph_state(7, GRAPH_ID, NODES, LINKS, {}, set(), compiled)
+    _, _, unlocked_after, _ = compute_user_graph_state(7, GRAPH_ID, NODES, LINKS, {}, {"e1"}, compiled)
+    assert unlocked_before != unlocked_after
+    renamed = [dict(n, title=n['id'].lower()) for n in NODES]
+    newer = compile_graph(renamed, LINKS, version=4)
+    nodes, _, _, _ = compute_user_graph_state(7, GRAPH_ID, renamed, LINKS, {}, {"e1"}, newer)
+    assert node_by_id(nodes, "M1")['title'] == "m1"
+
+def test_memoized_sets_are_per_call_copies(db_session, memo):
+    compiled = compile_graph(NODES, LINKS, version=3)
+    compute_user_graph_state(1, GRAPH_ID, NODES, LINKS, {}, set(), compiled) # Test user: everything unlocked
+    _, _, unlocked, discovered = compute_user_graph_state(7, GRAPH_ID, NODES, LINKS, {}, set(), compiled)
+    assert unlocked == {"Start": True, "M1": True, "S1": True}
+    assert discovered == {"Start", "M1", "S1"}
+
+# --- Tests for compute_node_status_updates ---
+
+def test_status_updates_for_new_user():
+    compiled = compile_graph(NODES, LINKS)
+    updates = compute_node_status_updates(compiled, {}, set())
+    # Untouched locked nodes have nothing to store
+    assert set(updates) == {"M1", "S1"}
+    assert updates["S1"] == {'percent_complete': 0, 'unlocked': True, 'discovered': True}
+
+def test_status_updates_only_include_changes(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = persisted_statuses({"e1"})
+    assert compute_node_status_updates(compiled, statuses, {"e1"}) == {}
+    updates = compute_node_status_updates(compiled, statuses, {"e1", "e2"})
+    assert set(updates) == {"S1", "M1"}
+    assert updates["S1"]['percent_complete'] == 100
+
+# --- Tests for propagate_unlocks ---
+
+def make_prereq_chain(length):
+    """Main nodes M0 -> M1 -> ... chained by prerequisites, listed in reverse order."""
+    nodes = [make_node(f"M{i}", "main") for i in reversed(range(length))]
+    links = [{'source': f"M{i}", 'target': f"M{i + 1}", 'type': 'PREREQUISITE'} for i in range(length - 1)]
+    return nodes, links
+
+def test_propagate_unlocks_deep_chain_is_linear():
+    nodes, links = make_prereq_chain(200)
+    compiled = compile_graph(nodes, links)
+    percentages = [100] * len(compiled)
+    unlocked, evaluations = propagate_unlocks(compiled, percentages)
+    assert all(unlocked)
+    # Every node is evaluated once up front and at most once more per unlocked dependency
+    assert evaluations <= 2 * len(compiled)
+
+def test_propagate_unlocks_respects_percent_threshold():
+    nodes, links = make_prereq_chain(3)
+    compiled = compile_graph(nodes, links)
+    percentages = [0] * len(compiled)
+    percentages[compiled.index["M0"]] = 50
+    unlocked, _ = propagate_unlocks(compiled, percentages)
+    assert [compiled.ids[i] for i in range(len(compiled)) if unlocked[i]] == ["Start", "M1", "M0"]
+
+def test_propagate_unlocks_from_existing_state():
+    compiled = compile_graph(NODES, LINKS)
+    percentages = [0] * len(compiled)
+    percentages[compiled.index["S1"]] = 100
+    start_state, _ = propagate_unlocks(compiled, [0] * len(compiled))
+    # Only S1's dependents need a look once S1 crosses the threshold
+    unlocked, evaluations = propagate_unlocks(
+        compiled, percentages, start_state, seeds=compiled.dependents[compiled.index["S1"]])
+    assert {compiled.ids[i] for i in range(len(compiled)) if unlocked[i]} == {"Start", "M1", "S1", "S2", "M2", "S3"}
+    assert evaluations == 3 # S2, M2, then S3
+
+# --- Tests for compute_exercise_toggle_update ---
+
+def persisted_statuses(completed_exercise_ids):
+    """UserNodeStatus objects as the full computation would have stored them."""
+    nodes, _, _, _ = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, completed_exercise_ids)
+    return {
+        n['id']: UserNodeStatus(user_id=USER_ID, percent_complete=n['percent'],
+                                unlocked=n['unlocked'], discovered=n['discovered'])
+        for n in nodes if n['id'] != "Start"
+    }
+
+def test_toggle_below_threshold_only_touches_rollup(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = persisted_statuses(set())
+    updates, changed = compute_exercise_toggle_update(compiled, statuses, {"e3"}, "e3")
+    # S2 is locked but its percent still changes, and so does its main M1
+    assert changed == ["S2", "M1"]
+    assert updates["S2"] == {'percent_complete': 100, 'unlocked': False, 'discovered': False}
+    assert updates["M1"]['percent_complete'] == 50
+
+def test_toggle_crossing_threshold_unlocks_frontier(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = persisted_statuses(set())
+    updates, changed = compute_exercise_toggle_update(compiled, statuses, {"e1"}, "e1")
+    assert set(changed) == {"S1", "M1", "S2", "M2", "S3"}
+    assert updates["S3"] == {'percent_complete': 0, 'unlocked': True, 'discovered': True}
+
+def test_untoggle_relocks_downstream(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = persisted_statuses({"e1"})
+    updates, changed = compute_exercise_toggle_update(compiled, statuses, set(), "e1")
+    assert set(changed) == {"S1", "M1", "S2", "M2", "S3"}
+    assert updates["M2"] == {'percent_complete': 0, 'unlocked': False, 'discovered': False}
+    assert updates["S1"] == {'percent_complete': 0, 'unlocked': True, 'discovered': True}
+
+def test_toggle_matches_full_recompute(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = persisted_statuses({"e1", "e3"})
+    updates, _ = compute_exercise_toggle_update(compiled, statuses, {"e1", "e3", "e2"}, "e2")
+    for node_id, fields in updates.items():
+        statuses[node_id] = UserNodeStatus(**fields)
+    expected = persisted_statuses({"e1", "e2", "e3"})
+    view = lambda m: {k: (v.percent_complete, v.unlocked, v.discovered) for k, v in m.items()}
+    assert view(statuses) == view(expected)
+
+def test_toggle_unknown_exercise_is_a_no_op(db_session):
+    compiled = compile_graph(NODES, LINKS)
+    assert compute_exercise_toggle_update(compiled, {}, {"zzz"}, "zzz") == ({}, [])
+
+# --- Tests for compute_graph_abilities ---
+
+def test_graph_abilities_count_required_exercises_per_category():
+    nodes = [make_node("S1", "sub", ["e1", "e2", "e3"])]
+    exercises = nodes[0]['popup']['exercises']
+    exercises[0]['categories'] = ["Web", "Crypto"]
+    exercises[1]['categories'] = ["Web"]
+    exercises[2]['categories'] = ["Web"]
+    exercises[2]['optional'] = True # Optional exercises don't count
+    compiled = compile_graph(nodes, [])
+    abilities = compute_graph_abilities(USER_ID, compiled, {"e1", "e2", "e3", "other-graph"}, {1: 2, 2: 1})
+    assert abilities == {"Web": 2, "Crypto": 1, "CTFs": 3}
+
+# --- Tests for discovery ---
+
+def test_discovery_matches_unlocked_nodes(db_session):
+    _, _, unlocked, discovered = compute_user_graph_state(USER_ID, GRAPH_ID, NODES, LINKS, {}, {"e3"})
+    assert discovered == set(unlocked) == {"Start", "M1", "S1"}
@@ -0,0 +1,39 @@
+# test_parallel.py
+import threading
+import pytest
+from flask import current_app
+from core.parallel import run_independent
+
+# --- Tests for run_independent ---
+
+def test_serial_by_default(test_app):
+    threads = []
+    results = run_independent(lambda: threads.append(threading.current_thread()) or 1,
+                              lambda: threads.append(threading.current_thread()) or 2)
+    assert results == [1, 2]
+    assert threads == [threading.current_thread()] * 2
+
+def test_concurrent_keeps_order_and_uses_pool(test_app):
+    release = threading.Event()
+    def slow():
+        release.wait(timeout=5)
+        return "slow"
+    def fast():
+        release.set() # Only returns before slow() times out if both run at once
+        return threading.current_thread().name
+    with test_app.app_context():
+        results = run_independent(slow, fast, concurrent=True)
+    assert results[0] == "slow"
+    assert results[1].startswith("state-query")
+
+def test_pooled_calls_get_an_app_context(test_app):
+    with test_app.app_context():
+        results = run_independent(lambda: None, lambda: current_app.name, concurrent=True)
+    assert results[1] == test_app.name
+
+def test_errors_are_raised_in_caller(test_app):
+    def failing():
+        raise RuntimeError("db down")
+    with test_app.app_context():
+        with pytest.raises(RuntimeError):
+            run_independent(lambda: 1, failing, concurrent=True)
@@ -0,0 +1,60 @@
+# test_response.py
+import json
+import pytest
+from core.graph import compile_graph
+from core.nodes import compute_user_graph_state
+from core.response import encode_state
+from models import UserNodeStatus
+
+NODES = [
+    {'id': "M1", 'title': "M1", 'type': "main", 'popup': {'text': '', 'pdf_link': None, 'exercises': []}},
+    {'id': "S1", 'title': "Sécurité", 'type': "sub", 'popup': {'text': '', 'pdf_link': None, 'exercises': [
+        {'id': "e1", 'label': "e1", 'points': 10, 'optional': False, 'categories': ["Web"]}]}},
+]
+LINKS = [{'source': "M1", 'target': "S1", 'type': 'CHILD'}]
+
+def make_state(compiled, statuses=None):
+    nodes, links, unlocked, discovered = compute_user_graph_state(7, 1, NODES, LINKS, statuses or {}, {"e1"}, compiled)
+    return {"nodes": nodes, "links": links, "unlocked": unlocked, "discovered": sorted(discovered),
+            "streak": {"streak": 0, "last_used": ""}, "current_graph": "x"}
+
+# --- Tests for encode_state ---
+
+def test_encoded_state_matches_jsonify(test_app):
+    compiled = compile_graph(NODES, LINKS)
+    state = make_state(compiled)
+    with test_app.app_context():
+        encoded = encode_state(state, compiled)
+        expected = test_app.json.response(state).get_data().rstrip(b"\n")
+    assert encoded == expected
+    assert json.loads(encoded) == json.loads(json.dumps(state))
+
+def test_links_are_spliced_from_the_compiled_graph(test_app):
+    compiled = compile_graph(NODES, LINKS)
+    state = make_state(compiled)
+    assert state["links"] is compiled.output_links
+    compiled.output_links_json = b'"spliced"' # Proves the pre-encoded bytes are used
+    with test_app.app_context():
+        assert json.loads(encode_state(state, compiled))["links"] == "spliced"
+        # A link list that isn't the graph's own is encoded normally
+        state["links"] = list(state["links"])
+        assert json.loads(encode_state(state, compiled))["links"] == state["links"]
+
+def test_nodes_are_filled_in_templates(test_app):
+    compiled = compile_graph(NODES, LINKS)
+    statuses = {"M1": UserNodeStatus(user_notes='a "quoted" note ✓'), "S1": UserNodeStatus(user_notes=None)}
+    state = make_state(compiled, statuses)
+    with test_app.app_context():
+        encoded = encode_state(state, compiled)
+        assert encoded == test_app.json.response(state).get_data().rstrip(b"\n")
+    nodes = json.loads(encoded)["nodes"]
+    assert nodes[1]["popup"]["userNotes"] == 'a "quoted" note ✓'
+    assert nodes[2]["popup"]["userNotes"] is None
+    assert nodes[2]["popup"]["exercises"][0]["completed"] is True
+
+def test_nodes_not_built_for_the_graph_are_encoded_normally(test_app):
+    compiled = compile_graph(NODES, LINKS)
+    state = make_state(compiled)
+    state["nodes"] = state["nodes"][:2] # Not the graph's layout
+    with test_app.app_context():
+        assert encode_state(state, compiled) == test_app.json.response(state).get_data().rstrip(b"\n")